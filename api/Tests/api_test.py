@@ -1,26 +1,35 @@
-import requests
 import pytest
 import json
-from src.pg import destroy_db, create_table, init_connection, close_connection
+from pg import get_session, delete_meme, compact_votes, StoredImage, VoteEvent, VoteRollupState
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import select, delete, text
 import httpx
 import random
 import hashlib
 import base64
+import asyncio
+import time
+import threading
+import tracemalloc
+from Tests.conftest import ASGIStreamingTransport
 
-api_url = "http://localhost:3000"
+# The api runs in the test process and the images are served by a local server, see conftest.py.
+# All tests of a worker share the event loop of the api
+pytestmark = pytest.mark.asyncio(loop_scope="session")
 
-example_image_url = "https://upload.wikimedia.org/wikipedia/commons/2/2c/Rotating_earth_%28large%29.gif"
-example2_image_url = "https://upload.wikimedia.org/wikipedia/commons/thumb/d/db/Cocos_nucifera_%28coconut%29_5_%2838507429165%29.jpg/250px-Cocos_nucifera_%28coconut%29_5_%2838507429165%29.jpg"
+example_image = "earth.gif"
+example2_image = "coconut.jpg"
 
 
 # ------------------------------------ #
 #          Helper functions            #
 # ------------------------------------ #
 
-async def create_meme(url: str, caption: str) -> dict:
+async def create_meme(client: httpx.AsyncClient, url: str, caption: str) -> dict:
     """Helper function that creates a meme sends it to the api
 
     Args:
+        client (httpx.AsyncClient): The client of the api
         url (str): A url to an image
         caption (str): A caption
 
@@ -32,28 +41,31 @@ async def create_meme(url: str, caption: str) -> dict:
         "url": url,
         "caption": caption
     }
-    response = requests.post(f"{api_url}/api/meme/", json=json)
+    response = await client.post("/api/meme/", json=json)
     assert response.status_code == 200
     assert response.json()["status"] == "success"
     return response.json()
 
-async def get_meme_by_id(id : int) -> dict:
+async def get_meme_by_id(client: httpx.AsyncClient, id : int) -> dict:
     """Helper function that retrieves a meme by its id
 
     Args:
+        client (httpx.AsyncClient): The client of the api
         id (int): The id of the meme
 
     Returns:
         dict: The response from the api
     """
-    response = requests.get(f"{api_url}/api/meme/{id}")
+    response = await client.get(f"/api/meme/{id}")
     assert response.status_code == 200
     return response.json()
 
-async def createTestMemes(size : int) -> list:
+async def createTestMemes(client: httpx.AsyncClient, url: str, size : int) -> list:
     """Creates a number of test memes and sends them to the api
 
     Args:
+        client (httpx.AsyncClient): The client of the api
+        url (str): A url to the image of the memes
         size (int): The number of memes to create
 
     Returns:
@@ -63,7 +75,7 @@ async def createTestMemes(size : int) -> list:
     captions = []
     for i in range(size):
         captions.append(f"Caption {i}")
-        await create_meme(example_image_url, captions[i])
+        await create_meme(client, url, captions[i])
     return captions
 
 # ------------------------------------ #
@@ -71,102 +83,190 @@ async def createTestMemes(size : int) -> list:
 # ------------------------------------ #
 
 
-@pytest.mark.asyncio
-async def test_create_meme_url():
+async def test_create_meme_url(client, image_server):
     """Tests the '/api/meme/' endpoint by creating a meme with a url to an image
     """
 
-    await init_connection()
-    await destroy_db()
-    await create_table()
-    assert create_meme(example_image_url, "Cat")
-    await close_connection()
+    assert await create_meme(client, image_server.url(example_image), "Cat")
 
-@pytest.mark.asyncio
-async def test_create_meme_invalid_url():
+async def test_create_meme_invalid_url(client):
     """Tests the '/api/meme/' endpoint by creating a meme with an invalid url
     """
 
-    await init_connection()
-    await destroy_db()
-    await create_table()
-    response = requests.post(f"{api_url}/api/meme/", json={"url": "invalid_url", "caption": "Cat"})
+    response = await client.post("/api/meme/", json={"url": "invalid_url", "caption": "Cat"})
     assert response.status_code == 200
     assert response.json()["status"] == "error"
-    await close_connection()
 
 
-@pytest.mark.asyncio
-async def test_create_meme_image():
+async def test_create_meme_image(client, image_server):
     """Tests the '/api/meme/' endpoint by creating a meme without a url but with a base64 encoded image
     """
 
-    await init_connection()
-    await destroy_db()
-    await create_table()
+    encoded_image = base64.b64encode(image_server.content(example_image)).decode("utf-8")
 
-    encoded_image = base64.b64encode(requests.get(example_image_url).content).decode("utf-8")
-
-    response = requests.post(f"{api_url}/api/meme/", json={"caption": "Cat", "image": encoded_image})
+    response = await client.post("/api/meme/", json={"caption": "Cat", "image": encoded_image})
     assert response.status_code == 200
     assert response.json()["status"] == "success"
-    await close_connection()
 
-@pytest.mark.asyncio
-async def test_get_meme_by_id():
+async def test_get_meme_by_id(client, image_server):
     """Tests the '/api/meme/{id}' endpoint by creating a meme and then retrieving it
     """
 
-    await init_connection()
-    await destroy_db()
-    await create_table()
-    
-    await create_meme(example_image_url, "Cat")
-    
-    response = requests.get(f"{api_url}/api/meme/1")
+    await create_meme(client, image_server.url(example_image), "Cat")
+
+    response = await client.get("/api/meme/1")
     assert response.status_code == 200
     json = response.json()
     assert json["status"] == "success"
     assert json["data"]["caption"] == "Cat"
-    await close_connection()
 
-@pytest.mark.asyncio
-async def test_get_nonexistent_meme():
+async def test_get_nonexistent_meme(client):
     """Tests the '/api/meme/{id}' endpoint by trying to retrieve a meme that does not exist
     """
 
-    await init_connection()
-    await destroy_db()
-    await create_table()
+    response = await client.get("/api/meme/1")
 
-    async with httpx.AsyncClient() as client:
-        response = await client.get(f"{api_url}/api/meme/1")
-    
     assert response.status_code == 200
     json = response.json()
     assert json["status"] == "error"
-    await close_connection()
+
+async def get_coalescing_stats(client: httpx.AsyncClient, name: str) -> dict:
+    """Helper function that returns the coalescing statistics of an operation
+
+    Args:
+        client (httpx.AsyncClient): The client of the api
+        name (str): The name of the operation, e.g. 'meme_reads'
+
+    Returns:
+        dict: The statistics of the operation
+    """
+
+    response = await client.get("/api/meme/stats/coalescing/")
+    assert response.status_code == 200
+    return next(stats for stats in response.json()["data"] if stats["name"] == name)
+
+async def test_concurrent_reads_coalesced(client, image_server, app, monkeypatch):
+    """Tests that concurrent reads of the same meme share one database query and are counted by the '/api/meme/stats/coalescing/' endpoint
+    """
+
+    await create_meme(client, image_server.url(example_image), "Cat")
+
+    # Slow down the query so all reads arrive while the first one is still running
+    queries = []
+    get_meme_by_id = app.db.get_meme_by_id
+    async def slow_get_meme_by_id(id):
+        queries.append(id)
+        await asyncio.sleep(0.3)
+        return await get_meme_by_id(id)
+    monkeypatch.setattr(app.db, "get_meme_by_id", slow_get_meme_by_id)
+
+    before = await get_coalescing_stats(client, "meme_reads")
+    responses = await asyncio.gather(*[client.get("/api/meme/1") for _ in range(20)])
+    after = await get_coalescing_stats(client, "meme_reads")
+
+    for response in responses:
+        assert response.status_code == 200
+        assert response.json()["data"]["caption"] == "Cat"
+
+    assert queries == [1]
+    assert after["calls"] - before["calls"] == 20
+    assert after["coalesced"] - before["coalesced"] >= 19
+
+async def test_concurrent_downloads_coalesced(client, image_server, app, monkeypatch):
+    """Tests that concurrent creations with the same url download the image only once
+    """
+
+    downloads = []
+    get_url_content = app.get_url_content
+    def slow_get_url_content(url):
+        downloads.append(url)
+        time.sleep(0.3)
+        return get_url_content(url)
+    monkeypatch.setattr(app, "get_url_content", slow_get_url_content)
+
+    url = image_server.url(example_image)
+    before = await get_coalescing_stats(client, "url_downloads")
+    responses = await asyncio.gather(*[client.post("/api/meme/", json={"url": url, "caption": f"Cat {i}"}) for i in range(5)])
+    after = await get_coalescing_stats(client, "url_downloads")
+
+    for response in responses:
+        assert response.status_code == 200
+        assert response.json()["status"] == "success"
+
+    assert downloads == [url]
+    assert after["coalesced"] - before["coalesced"] == 4
+
+    # All memes share the downloaded image
+    for id in range(1, 6):
+        meme = await get_meme_by_id(client, id)
+        assert base64.b64decode(meme["data"]["image"]) == image_server.content(example_image)
+
+async def test_concurrent_ocr_coalesced(client, image_server, app, monkeypatch):
+    """Tests that concurrent creations without a caption that use the same image run OCR only once
+    """
+
+    runs = []
+    def slow_get_text_from_image(image):
+        runs.append(hashlib.sha256(image).hexdigest())
+        time.sleep(0.3)
+        return "SMILE"
+    monkeypatch.setattr(app, "get_text_from_image", slow_get_text_from_image)
+
+    before = await get_coalescing_stats(client, "ocr_runs")
+    responses = await asyncio.gather(*[client.post("/api/meme/", json={"url": image_server.url("smile.jpg"), "caption": ""}) for _ in range(5)])
+    after = await get_coalescing_stats(client, "ocr_runs")
+
+    for response in responses:
+        assert response.status_code == 200
+        assert response.json()["status"] == "success"
+
+    assert runs == [hashlib.sha256(image_server.content("smile.jpg")).hexdigest()]
+    assert after["calls"] - before["calls"] == 5
+    assert after["coalesced"] - before["coalesced"] == 4
+    for id in range(1, 6):
+        assert (await get_meme_by_id(client, id))["data"]["caption"] == "SMILE"
+
+# Idempotency
+
+async def test_create_meme_idempotency_key(client, image_server):
+    """Tests the '/api/meme/' endpoint by sending the same request twice with an Idempotency-Key. Only one meme should be created and the second response should be replayed
+    """
+
+    headers = {"Idempotency-Key": "test-key"}
+    body = {"url": image_server.url(example_image), "caption": "Cat"}
+
+    first, second = await asyncio.gather(
+        client.post("/api/meme/", json=body, headers=headers),
+        client.post("/api/meme/", json=body, headers=headers)
+    )
+    third = await client.post("/api/meme/", json=body, headers=headers)
+
+    for response in (first, second, third):
+        assert response.status_code == 200
+        assert response.json() == {"status": "success", "data": {"id": 1}}
+    assert third.headers["Idempotent-Replayed"] == "true"
+
+    other = await client.post("/api/meme/", json={"url": image_server.url(example_image), "caption": "Dog"}, headers=headers)
+    assert other.status_code == 422
+
+    res = await get_meme_by_id(client, 2)
+    assert res["status"] == "error"
 
 # Image
 
-@pytest.mark.asyncio
-async def test_image_integrity_url():
+async def test_image_integrity_url(client, image_server):
     """Tests the integrity of the image data stored in the database by comparing the hash of the original image with the hash of the stored image when the image is provided via a url
     """
 
-    await init_connection()
-    await destroy_db()
-    await create_table()
+    await create_meme(client, image_server.url(example_image), "Cat")
 
-    await create_meme(example_image_url, "Cat")
-
-    original_image = requests.get(example_image_url).content
+    original_image = image_server.content(example_image)
     assert original_image is not None
 
     original_hash = hashlib.md5(original_image).hexdigest()
 
-    res = await get_meme_by_id(1)
-    assert res["status"] == "success"  
+    res = await get_meme_by_id(client, 1)
+    assert res["status"] == "success"
     assert res["data"]["image"] is not None
     encoded_img = res["data"]["image"]
     image_bytes = base64.b64decode(encoded_img)
@@ -175,27 +275,20 @@ async def test_image_integrity_url():
 
     assert original_hash == hash_stored_image
 
-    await close_connection()
-
-@pytest.mark.asyncio
-async def test_image_integrity_base64():
+async def test_image_integrity_base64(client, image_server):
     """Tests the integrity of the image data stored in the database by comparing the hash of the original image with the hash of the stored image when the image is provided as base64 encoded data
     """
 
-    await init_connection()
-    await destroy_db()
-    await create_table()
-
-    original_image = requests.get(example_image_url).content
+    original_image = image_server.content(example_image)
 
     original_hash = hashlib.md5(original_image).hexdigest()
 
     encoded_image = base64.b64encode(original_image).decode("utf-8")
 
-    response = requests.post(f"{api_url}/api/meme/", json={"caption": "Cat", "image": encoded_image})   
+    response = await client.post("/api/meme/", json={"caption": "Cat", "image": encoded_image})
 
-    res = await get_meme_by_id(1)
-    assert res["status"] == "success"  
+    res = await get_meme_by_id(client, 1)
+    assert res["status"] == "success"
     assert res["data"]["image"] is not None
     encoded_img = res["data"]["image"]
     image_bytes = base64.b64decode(encoded_img)
@@ -203,125 +296,193 @@ async def test_image_integrity_base64():
 
     assert original_hash == hash_stored_image
 
-    await close_connection()
-
-@pytest.mark.asyncio
-async def test_create_meme_url_and_image():
-    """Tests the '/api/meme/' endpoint by trying to create a meme with both a url and an image
+async def test_image_integrity_large_image(client):
+    """Tests that an image that is larger than one chunk of the streamed response is returned unchanged and that the announced Content-Length is correct
     """
 
-    await init_connection()
-    await destroy_db()
-    await create_table()
+    original_image = random.randbytes(1_000_001)
+    encoded_image = base64.b64encode(original_image).decode("utf-8")
+    response = await client.post("/api/meme/", json={"caption": "Noise", "image": encoded_image})
+    assert response.json()["status"] == "success"
 
+    response = await client.get("/api/meme/1")
+    assert response.status_code == 200
+    assert int(response.headers["Content-Length"]) == len(response.content)
+    assert response.json()["data"]["caption"] == "Noise"
+    assert base64.b64decode(response.json()["data"]["image"]) == original_image
 
-    image_hash = hashlib.md5(requests.get(example_image_url).content).hexdigest()
+async def test_create_meme_url_and_image(client, image_server):
+    """Tests the '/api/meme/' endpoint by trying to create a meme with both a url and an image
+    """
 
+    image_hash = hashlib.md5(image_server.content(example_image)).hexdigest()
 
-    response = requests.post(f"{api_url}/api/meme/", json={"url": example_image_url, "image": "base64encodedimage", "caption": "Cat"})
+    response = await client.post("/api/meme/", json={"url": image_server.url(example_image), "image": "base64encodedimage", "caption": "Cat"})
     assert response.status_code == 200
     assert response.json()["status"] == "success"
 
-    meme = await get_meme_by_id(1)
+    meme = await get_meme_by_id(client, 1)
     hash = hashlib.md5(base64.b64decode(meme["data"]["image"])).hexdigest()
     assert hash == image_hash
 
-    await close_connection()
+# Image storage
+
+async def get_stored_images() -> list:
+    """Helper function that returns all rows of the content-addressed image table
+    """
+
+    async with get_session() as session:
+        async with session.begin():
+            result = await session.execute(select(StoredImage.hash, StoredImage.refcount))
+            return result.all()
+
+async def test_same_image_stored_once(client, image_server):
+    """Tests that memes with the same image content share a single stored image, whether the image is provided via a url or as base64 encoded data
+    """
+
+    original_image = image_server.content(example_image)
+    encoded_image = base64.b64encode(original_image).decode("utf-8")
+
+    await create_meme(client, image_server.url(example_image), "Cat")
+    await create_meme(client, image_server.url(example_image), "Dog")
+    response = await client.post("/api/meme/", json={"caption": "Bird", "image": encoded_image})
+    assert response.json()["status"] == "success"
+
+    images = await get_stored_images()
+    assert len(images) == 1
+    assert images[0].hash == hashlib.sha256(original_image).hexdigest()
+    assert images[0].refcount == 3
+
+async def test_delete_meme_releases_image(client, image_server):
+    """Tests that the stored image is only deleted once the last meme using it is deleted
+    """
+
+    await create_meme(client, image_server.url(example_image), "Cat")
+    await create_meme(client, image_server.url(example_image), "Dog")
+
+    assert await delete_meme(1)
+    images = await get_stored_images()
+    assert len(images) == 1
+    assert images[0].refcount == 1
+
+    assert await delete_meme(2)
+    assert len(await get_stored_images()) == 0
+    assert not await delete_meme(2)
+
+async def test_get_transcode_stats(client, image_server, app, monkeypatch):
+    """Tests the '/api/meme/stats/' endpoint by creating a transcoded meme, and that the uploaded JPEG is returned to
+    clients that do not accept WebP when it was kept
+    """
+
+    monkeypatch.setattr(app, "TRANSCODE_IMAGES", True)
+
+    response = await client.post("/api/meme/", json={"url": image_server.url(example2_image), "caption": "Coconut", "keep_original": True})
+    assert response.status_code == 200
+    assert response.json()["status"] == "success"
+
+    meme = await get_meme_by_id(client, 1)
+    assert meme["data"]["image_type"] == "image/webp"
+    assert meme["data"]["bytes_saved"] > 0
+    assert base64.b64decode(meme["data"]["image"])[8:12] == b"WEBP"
+
+    response = await client.get("/api/meme/1", headers={"Accept": "image/jpeg"})
+    assert response.status_code == 200
+    original = response.json()
+    assert original["data"]["image_type"] == "image/jpeg"
+    assert base64.b64decode(original["data"]["image"]) == image_server.content(example2_image)
+
+    response = await client.get("/api/meme/stats/")
+    assert response.status_code == 200
+    json = response.json()
+    assert json["status"] == "success"
+    assert json["data"]["transcoded"] == 1
+    assert json["data"]["bytes_saved"] == meme["data"]["bytes_saved"]
+
+# Rendering
+
+async def test_get_rendered_meme(client, image_server):
+    """Tests the '/api/meme/{id}/rendered' endpoint by rendering a meme twice in JPEG and once in WebP
+    """
+
+    await create_meme(client, image_server.url(example2_image), "Top text | Bottom text")
+
+    first = await client.get("/api/meme/1/rendered", params={"width": 200})
+    assert first.status_code == 200
+    assert first.headers["content-type"] == "image/jpeg"
+    assert first.content[:3] == b"\xff\xd8\xff"
+
+    second = await client.get("/api/meme/1/rendered", params={"width": 200})
+    assert second.content == first.content
+
+    webp = await client.get("/api/meme/1/rendered", params={"width": 200}, headers={"Accept": "image/webp"})
+    assert webp.headers["content-type"] == "image/webp"
+    assert webp.content[8:12] == b"WEBP"
+
+    missing = await client.get("/api/meme/2/rendered")
+    assert missing.json()["error"] == "Meme not found"
 
 # ------------------------------------ #
 #              Votes                   #
 # ------------------------------------ #
 
-@pytest.mark.asyncio
-async def test_upvote_meme():
+async def test_upvote_meme(client, image_server):
     """Tests the '/api/meme/{id}/vote/' endpoint by creating a meme, upvoting it and then retrieving it to check the upvotes
     """
 
-    await init_connection()
-    await destroy_db()
-    await create_table()
-
+    await create_meme(client, image_server.url(example_image), "Cat")
 
-    await create_meme(example_image_url, "Cat")
+    response = await client.post("/api/meme/1/vote/", json={"type": "upvote"})
 
-    async with httpx.AsyncClient() as client:
-        response = await client.post(f"{api_url}/api/meme/1/vote/", json={"type": "upvote"})
-    
     assert response.status_code == 200
     json = response.json()
     assert json["status"] == "success"
-    res = await get_meme_by_id(1)
+    res = await get_meme_by_id(client, 1)
     assert res["data"]["upvotes"] == 1
-    await close_connection()
 
-@pytest.mark.asyncio
-async def test_multiple_upvotes():
+async def test_multiple_upvotes(client, image_server):
     """Tests the '/api/meme/{id}/vote/' endpoint by creating a meme, upvoting it multiple times and then retrieving it to check the upvotes
     """
 
-    await init_connection()
-    await destroy_db()
-    await create_table()
-
-    await create_meme(example_image_url, "Cat")
+    await create_meme(client, image_server.url(example_image), "Cat")
 
     for i in range(10):
-        async with httpx.AsyncClient() as client:
-            response = await client.post(f"{api_url}/api/meme/1/vote/", json={"type": "upvote"})
-            assert response.status_code == 200
-            assert response.json()["status"] == "success"
+        response = await client.post("/api/meme/1/vote/", json={"type": "upvote"})
+        assert response.status_code == 200
+        assert response.json()["status"] == "success"
 
-    res = await get_meme_by_id(1)
+    res = await get_meme_by_id(client, 1)
     assert res["data"]["upvotes"] == 10
 
-    await close_connection()
-
-@pytest.mark.asyncio
-async def test_upvote_nonexistent_meme():
+async def test_upvote_nonexistent_meme(client):
     """Tests the '/api/meme/{id}/vote/' endpoint by trying to upvote a meme that does not exist
     """
 
-    await init_connection()
-    await destroy_db()
-    await create_table()
+    response = await client.post("/api/meme/1/vote/", json={"type": "upvote"})
 
-    async with httpx.AsyncClient() as client:
-        response = await client.post(f"{api_url}/api/meme/1/vote/", json={"type": "upvote"})
-    
     assert response.status_code == 200
     json = response.json()
     assert json["status"] == "error"
     assert json["error"] == "Meme not found"
-    await close_connection()
 
 
-@pytest.mark.asyncio
-async def test_downvote_meme():
+async def test_downvote_meme(client, image_server):
     """ Tests the '/api/meme/{id}/vote/' endpoint by creating a meme, upvoting it and then downvoting it
     """
 
-    await init_connection()
-    await destroy_db()
-    await create_table()
-
-    await create_meme(example_image_url, "Cat")
+    await create_meme(client, image_server.url(example_image), "Cat")
 
     for i in range(10):
-        async with httpx.AsyncClient() as client:
-            response = await client.post(f"{api_url}/api/meme/1/vote/", json={"type": "upvote"})
-            assert response.status_code == 200
-            assert response.json()["status"] == "success"
-
-    async with httpx.AsyncClient() as client:
-        response = await client.post(f"{api_url}/api/meme/1/vote/", json={"type": "downvote"})
+        response = await client.post("/api/meme/1/vote/", json={"type": "upvote"})
         assert response.status_code == 200
         assert response.json()["status"] == "success"
 
-    res = await get_meme_by_id(1)
+    response = await client.post("/api/meme/1/vote/", json={"type": "downvote"})
+    assert response.status_code == 200
+    assert response.json()["status"] == "success"
+
+    res = await get_meme_by_id(client, 1)
     assert res["data"]["upvotes"] == 9
 
-    await close_connection()
-    
 
 
 
@@ -329,150 +490,430 @@ async def test_downvote_meme():
 #              Top  10 memes           #
 # ------------------------------------ #
 
-@pytest.mark.asyncio
-async def test_get_top_memes():
+async def test_get_top_memes(client, image_server):
     """Tests the '/api/top/' endpoint by creating 16 memes, upvoting the first 10 and then retrieving the top 10
     """
 
-    await init_connection()
-    await destroy_db()
-    await create_table()
-
-    print("-------------------------------------")
     # Create 16 memes
-    captions = await createTestMemes(16)
+    captions = await createTestMemes(client, image_server.url(example_image), 16)
 
     # Upvote the first 10
     for i in range(16):
         for j in range(i):
-            async with httpx.AsyncClient() as client:
-                response = await client.post(f"{api_url}/api/meme/{i+1}/vote/", json={"type": "upvote"})
-                assert response.status_code == 200
-                assert response.json()["status"] == "success"
+            response = await client.post(f"/api/meme/{i+1}/vote/", json={"type": "upvote"})
+            assert response.status_code == 200
+            assert response.json()["status"] == "success"
 
     # Get top 10
-    async with httpx.AsyncClient() as client:
-        response = await client.get(f"{api_url}/api/meme/top/")
-        assert response.status_code == 200
-        json = response.json()
-        assert json["status"] == "success"
-        data = json["data"]
-        assert len(data) == 10
-        for i in range(10):
-            # Number one should be the last one
-            assert data[i]["caption"] == captions[15-i]
-
-    await close_connection()
-
-@pytest.mark.asyncio
-async def test_get_top_memes_empty_db():
+    response = await client.get("/api/meme/top/")
+    assert response.status_code == 200
+    json = response.json()
+    assert json["status"] == "success"
+    data = json["data"]
+    assert len(data) == 10
+    for i in range(10):
+        # Number one should be the last one
+        assert data[i]["caption"] == captions[15-i]
+
+async def test_get_top_memes_empty_db(client):
     """Tests the '/api/top/' endpoint by trying to retrieve the top 10 memes from an empty database
     """
 
-    await init_connection()
-    await destroy_db()
-    await create_table()
+    response = await client.get("/api/meme/top/")
+    assert response.status_code == 200
+    json = response.json()
+    assert json["status"] == "success"
+    data = json["data"]
+    assert len(data) == 0
+
+
+async def test_stream_top_memes(client, image_server, app):
+    """Tests the '/api/meme/top/stream' endpoint by subscribing to the stream, upvoting a meme and waiting for the diff
+    """
+
+    await createTestMemes(client, image_server.url(example_image), 2)
+    # The ranking is refreshed in the background after a meme is created, refresh it now so the snapshot contains both memes
+    await app.top_memes.refresh()
 
-    async with httpx.AsyncClient() as client:
-        response = await client.get(f"{api_url}/api/meme/top/")
+    async def next_event(lines) -> tuple[str, object]:
+        event = None
+        async for line in lines:
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: "):
+                return event, json.loads(line[len("data: "):])
+
+    async with client.stream("GET", "/api/meme/top/stream") as response:
         assert response.status_code == 200
-        json = response.json()
-        assert json["status"] == "success"
-        data = json["data"]
-        assert len(data) == 0
+        assert response.headers["content-type"].startswith("text/event-stream")
+        lines = response.aiter_lines()
+
+        event, data = await asyncio.wait_for(next_event(lines), 10)
+        assert event == "snapshot"
+        assert [entry["id"] for entry in data] == [1, 2]
+
+        vote = await client.post("/api/meme/2/vote/", json={"type": "upvote"})
+        assert vote.json()["status"] == "success"
 
-    await close_connection()
+        event, data = await asyncio.wait_for(next_event(lines), 10)
+        assert event == "diff"
+        assert data["changed"] == [{"id": 2, "rank": 1, "upvotes": 1}, {"id": 1, "rank": 2, "upvotes": 0}]
+        assert data["removed"] == []
+
+async def test_vote_listener_reconnects(client, app, monkeypatch):
+    """Tests that the connection that listens for the votes of other workers is reopened when the database closes it,
+    also if the database cannot be reached at first, and that the votes announced afterwards still reach the leaderboard
+    """
+
+    async def wait_for_listener():
+        while app.vote_listener is None:
+            await asyncio.sleep(0.01)
+        return app.vote_listener
+
+    listener = await asyncio.wait_for(wait_for_listener(), 10)
+
+    # The first two attempts to reconnect fail
+    attempts = []
+    listen = app.db.listen
+    async def unreliable_listen(*args):
+        attempts.append(time.perf_counter())
+        if len(attempts) <= 2:
+            raise OSError("Connection refused")
+        return await listen(*args)
+    monkeypatch.setattr(app.db, "listen", unreliable_listen)
+    monkeypatch.setattr(app, "LISTEN_RETRY_DELAY", 0.05)
+
+    async with get_session() as session:
+        await session.execute(text("SELECT pg_terminate_backend(:pid)"), {"pid": listener.get_server_pid()})
+
+    async def wait_for_new_listener():
+        while app.vote_listener is None or app.vote_listener is listener:
+            await asyncio.sleep(0.01)
+        return app.vote_listener
+
+    new_listener = await asyncio.wait_for(wait_for_new_listener(), 10)
+    assert listener.is_closed()
+    assert len(attempts) == 3
+    # The delay doubles after every failed attempt
+    assert attempts[2] - attempts[1] >= 0.1
+
+    # Another worker announces a vote
+    invalidated = asyncio.Event()
+    monkeypatch.setattr(app.top_memes, "invalidate", invalidated.set)
+    async with get_session() as session:
+        await session.execute(text("SELECT pg_notify(:channel, '1')"), {"channel": app.db.VOTES_CHANNEL})
+        await session.commit()
+    await asyncio.wait_for(invalidated.wait(), 10)
+    assert app.vote_listener is new_listener
+
+
+# ------------------------------------ #
+#              Trending                #
+# ------------------------------------ #
+
+async def add_vote_events(votes: list[tuple[int, int, int, timedelta]]):
+    """Helper function that appends vote events with a given age to the vote event log. The compactor state is
+    reset in the same transaction so the backdated events are rolled up even if the compactor of the api already ran
+
+    Args:
+        votes (list): (meme id, delta, count, age) tuples
+    """
+
+    now = datetime.now(timezone.utc)
+    async with get_session() as session:
+        async with session.begin():
+            await session.execute(delete(VoteRollupState))
+            for meme_id, delta, count, age in votes:
+                session.add_all([VoteEvent(meme_id=meme_id, delta=delta, created_at=now - age) for _ in range(count)])
+            await session.commit()
+
+async def test_get_trending_memes(client, image_server):
+    """Tests the '/api/meme/trending/{window}/' endpoints with votes from the last hour and from three days ago
+    """
+
+    await createTestMemes(client, image_server.url(example_image), 3)
+    await add_vote_events([
+        (1, 1, 5, timedelta(minutes=1)),
+        (2, 1, 9, timedelta(days=3)),
+        (3, 1, 2, timedelta(minutes=1)),
+        (3, -1, 1, timedelta(minutes=1))
+    ])
+    await compact_votes()
+
+    response = await client.get("/api/meme/trending/day/")
+    data = response.json()["data"]
+    assert [(meme["id"], meme["score"]) for meme in data] == [(1, 5), (3, 1)]
+
+    response = await client.get("/api/meme/trending/week/")
+    data = response.json()["data"]
+    assert [(meme["id"], meme["score"]) for meme in data] == [(2, 9), (1, 5), (3, 1)]
+
+async def test_get_hot_memes(client, image_server):
+    """Tests the '/api/meme/hot/' endpoint. Recent votes should outweigh more votes from several days ago
+    """
+
+    await createTestMemes(client, image_server.url(example_image), 2)
+    await add_vote_events([
+        (1, 1, 20, timedelta(days=4)),
+        (2, 1, 5, timedelta(minutes=1))
+    ])
+    await compact_votes()
+
+    response = await client.get("/api/meme/hot/")
+    data = response.json()["data"]
+    assert [meme["id"] for meme in data] == [2, 1]
+    assert data[0]["score"] == pytest.approx(5, rel=0.01)
 
 
 # ------------------------------------ #
 #              Random                  #
 # ------------------------------------ #
 
-@pytest.mark.asyncio
-async def test_get_random_meme():
+async def test_get_random_meme(client, image_server):
     """Tests the '/api/meme/random/' endpoint by creating 10 memes and then retrieving a random one
     """
 
-    await init_connection()
-    await destroy_db()
-    await create_table()
+    captions = await createTestMemes(client, image_server.url(example_image), 10)
+
+    response = await client.get("/api/meme/random/")
+    assert response.status_code == 200
+    json = response.json()
+    assert json["status"] == "success"
+    data = json["data"]
+    assert data["caption"] in captions
+
 
-    captions = await createTestMemes(10)
 
-    async with httpx.AsyncClient() as client:
-        response = await client.get(f"{api_url}/api/meme/random/")
-        assert response.status_code == 200
-        json = response.json()
-        assert json["status"] == "success"
-        data = json["data"]
-        assert data["caption"] in captions
+# ------------------------------------ #
+#           Near-duplicates            #
+# ------------------------------------ #
+
+async def test_get_similar_memes(client, image_server):
+    """Tests the '/api/meme/{id}/similar' endpoint by creating two memes with the same image and one with a different image
+    """
+
+    await create_meme(client, image_server.url(example_image), "Cat")
+    await create_meme(client, image_server.url(example_image), "Dog")
+    await create_meme(client, image_server.url(example2_image), "Coconut")
+
+    response = await client.get("/api/meme/1/similar")
+    assert response.status_code == 200
+    json = response.json()
+    assert json["status"] == "success"
+    assert json["data"] == [{"id": 2, "distance": 0}]
+
+async def test_create_meme_reject_duplicate(client, image_server):
+    """Tests the '/api/meme/' endpoint by creating the same meme twice with the 'reject' duplicate policy
+    """
+
+    await create_meme(client, image_server.url(example_image), "Cat")
+
+    response = await client.post("/api/meme/", json={"url": image_server.url(example_image), "caption": "Cat", "on_duplicate": "reject"})
+    assert response.status_code == 200
+    assert response.json()["status"] == "error"
+    assert response.json()["error"] == "Meme is a duplicate of meme 1"
+
+async def test_create_meme_reject_duplicate_of_other_worker(client, image_server, app):
+    """Tests that a near-duplicate of a meme that another worker created after the index of this worker was loaded is rejected
+    """
 
-    await close_connection()
+    await create_meme(client, image_server.url(example2_image), "Coconut")
+    response = await client.get("/api/meme/1/similar")
+    assert response.json()["data"] == []
+    assert app.similarity_index_loaded
 
+    # Another worker stores the meme directly in the database, so this worker only learns about it from there
+    phash = app.similarity.dhash(image_server.content(example_image))
+    id = await app.db.create_meme("", "Cat", image_server.content(example_image), "image/gif", phash=phash)
+
+    response = await client.post("/api/meme/", json={"url": image_server.url(example_image), "caption": "Cat", "on_duplicate": "reject"})
+    assert response.status_code == 200
+    assert response.json()["status"] == "error"
+    assert response.json()["error"] == f"Meme is a duplicate of meme {id}"
+
+async def test_create_meme_reuse_caption(client, image_server):
+    """Tests the '/api/meme/' endpoint by creating a near-duplicate without a caption. The caption of the original should be reused and the memes linked
+    """
+
+    await create_meme(client, image_server.url(example_image), "Cat")
+
+    response = await client.post("/api/meme/", json={"url": image_server.url(example_image), "on_duplicate": "reuse_caption"})
+    assert response.status_code == 200
+    assert response.json()["status"] == "success"
+
+    res = await get_meme_by_id(client, 2)
+    assert res["data"]["caption"] == "Cat"
+    assert res["data"]["original_id"] == 1
 
 
 # ------------------------------------ #
 #              OCR                     #
 # ------------------------------------ #
 
-@pytest.mark.asyncio
-async def test_create_image_ocr_en():
+async def test_get_admission_stats(client, image_server):
+    """Tests the '/api/meme/stats/admission/' endpoint by checking that a meme with a caption does not enter the OCR queue
+    """
+
+    before = (await client.get("/api/meme/stats/admission/")).json()
+    await create_meme(client, image_server.url(example_image), "Cat")
+    after = (await client.get("/api/meme/stats/admission/")).json()
+
+    assert before["status"] == "success"
+    assert after["data"]["name"] == "ocr"
+    assert after["data"]["admitted"] == before["data"]["admitted"]
+    assert after["data"]["running"] <= after["data"]["concurrency"]
+
+async def test_create_meme_ocr_queue_full(client, image_server, app, monkeypatch):
+    """Tests that a meme without a caption is rejected with '503 Service Unavailable' while the OCR queue is full,
+    and that memes with a caption and reads are still served meanwhile
+    """
+
+    monkeypatch.setattr(app, "ocr_queue", app.admission.AdmissionQueue("ocr", 1, 0))
+
+    # Blocks the only OCR slot until the test releases it
+    release = threading.Event()
+    def slow_get_text_from_image(image):
+        release.wait(10)
+        return "SMILE"
+    monkeypatch.setattr(app, "get_text_from_image", slow_get_text_from_image)
+
+    blocking = asyncio.create_task(client.post("/api/meme/", json={"url": image_server.url("smile.jpg")}))
+    try:
+        while app.ocr_queue.running == 0:
+            assert not blocking.done()
+            await asyncio.sleep(0.01)
+
+        response = await client.post("/api/meme/", json={"url": image_server.url("spoe.jpg")})
+        assert response.status_code == 503
+        assert response.json()["status"] == "error"
+        assert int(response.headers["Retry-After"]) >= 1
+
+        response = await client.post("/api/meme/", json={"url": image_server.url(example_image), "caption": "Cat"})
+        assert response.status_code == 200
+        assert response.json()["status"] == "success"
+        id = response.json()["data"]["id"]
+
+        meme = await get_meme_by_id(client, id)
+        assert meme["data"]["caption"] == "Cat"
+        assert not blocking.done()
+    finally:
+        release.set()
+
+    response = await blocking
+    assert response.status_code == 200
+    assert response.json()["status"] == "success"
+
+    stats = (await client.get("/api/meme/stats/admission/")).json()["data"]
+    assert (stats["admitted"], stats["rejected"], stats["running"]) == (1, 1, 0)
+
+async def test_create_image_ocr_en(client, image_server):
     """
     Tests the '/api/meme/' endpoint by creating a meme with an image that contains text. The api should extract the text and store it as the caption
     """
 
-    ocr_image_url = "https://www.slidecow.com/wp-content/uploads/2018/04/Setting-Up-The-Slide-Text-1000x563.jpg"
     expected_caption = "SMILE"
 
-    await init_connection()
-    await destroy_db()
-    await create_table()
-
-    response = requests.post(f"{api_url}/api/meme/", json={"url": ocr_image_url})
+    response = await client.post("/api/meme/", json={"url": image_server.url("smile.jpg")})
     assert response.status_code == 200
     assert response.json()["status"] == "success"
 
-    res = await get_meme_by_id(1)
+    res = await get_meme_by_id(client, 1)
     assert res["status"] == "success"
     assert res["data"]["caption"] == expected_caption
 
-    await close_connection()
-
-@pytest.mark.asyncio
-async def test_create_image_ocr_de():
+async def test_create_image_ocr_de(client, image_server):
     """
     Tests the '/api/meme/' endpoint by creating a meme with an image that contains text. The api should extract the text and store it as the caption
     """
 
-    ocr_image_url = "https://www.w24.at/assets/uploads/mobile/230411_w24_offmaz_spoe_pic.jpg"
     expected_caption = "spö"
 
-    await init_connection()
-    await destroy_db()
-    await create_table()
-
-    response = requests.post(f"{api_url}/api/meme/", json={"url": ocr_image_url, "ocr_language": "de"})
+    response = await client.post("/api/meme/", json={"url": image_server.url("spoe.jpg"), "ocr_language": "de"})
     assert response.status_code == 200
     assert response.json()["status"] == "success"
 
-    res = await get_meme_by_id(1)
+    res = await get_meme_by_id(client, 1)
     assert res["status"] == "success"
     assert res["data"]["caption"].lower() == expected_caption
 
-    await close_connection()
-
-@pytest.mark.asyncio
-async def test_create_image_ocr_no_text():
+async def test_create_image_ocr_no_text(client, image_server):
 
-    blank_url = "https://mrwallpaper.com/images/thumbnail/blank-white-portrait-nao34hhkturs9lod.jpg"
-
-    await init_connection()
-    await destroy_db()
-    await create_table()
-
-    response = requests.post(f"{api_url}/api/meme/", json={"url": blank_url})
+    response = await client.post("/api/meme/", json={"url": image_server.url("blank.jpg")})
 
     assert response.status_code == 200
     assert response.json()["status"] == "error"
     assert "Failed to extract" in response.json()["error"]
 
+# ------------------------------------ #
+#              Profiling               #
+# ------------------------------------ #
+
+async def test_profile_meme_creation(client, image_server, app, tmp_path):
+    """Tests that a request with the header 'X-Profile: 1' is profiled and its stages are written to the profile directory,
+    while requests without the header are not profiled
+    """
+
+    profiled_app = app.profiling.ProfilingMiddleware(app.app, sample_rate=0, profile_dir=str(tmp_path), slow_seconds=0)
+    async with httpx.AsyncClient(transport=ASGIStreamingTransport(profiled_app), base_url="http://testserver", timeout=30) as profiled:
+        response = await profiled.post("/api/meme/", json={"url": image_server.url(example_image), "caption": "Cat"}, headers={"X-Profile": "1"})
+        assert response.status_code == 200
+        assert response.json()["status"] == "success"
+        name = response.headers["X-Profile-Id"]
+
+        response = await profiled.get("/api/meme/1")
+        assert response.status_code == 200
+        assert "X-Profile-Id" not in response.headers
+
+    with open(tmp_path / f"{name}.json") as f:
+        report = json.load(f)
+    assert (report["method"], report["path"], report["status"], report["stopped_by"]) == ("POST", "/api/meme/", 200, "response")
+    stages = [stage["name"] for stage in report["stages"]]
+    for expected in ("download", "phash", "store"):
+        assert expected in stages
+    assert all(stage["duration"] >= 0 and stage["peak"] >= 0 for stage in report["stages"])
+    assert (tmp_path / f"{name}.folded").exists()
+    assert sorted(path.name for path in tmp_path.iterdir()) == sorted([f"{name}.json", f"{name}.folded"])
+
+async def test_profile_event_stream(client, image_server, app, tmp_path):
+    """Tests that profiling an event stream stops once its headers are sent, so other requests can be profiled while the stream is open
+    """
+
+    profiled_app = app.profiling.ProfilingMiddleware(app.app, sample_rate=0, profile_dir=str(tmp_path), slow_seconds=0)
+    async with httpx.AsyncClient(transport=ASGIStreamingTransport(profiled_app), base_url="http://testserver", timeout=30) as profiled:
+        async with profiled.stream("GET", "/api/meme/top/stream", headers={"X-Profile": "1"}) as response:
+            assert response.status_code == 200
+            name = response.headers["X-Profile-Id"]
+            assert not app.profiling.profiling_active
+            assert not tracemalloc.is_tracing()
+
+            response = await profiled.post("/api/meme/", json={"url": image_server.url(example_image), "caption": "Cat"}, headers={"X-Profile": "1"})
+            assert response.status_code == 200
+            assert "X-Profile-Id" in response.headers
+
+    with open(tmp_path / f"{name}.json") as f:
+        report = json.load(f)
+    assert (report["path"], report["status"], report["stopped_by"]) == ("/api/meme/top/stream", 200, "event-stream")
+
+async def test_profile_max_duration(client, image_server, app, tmp_path, monkeypatch):
+    """Tests that profiling stops after the maximum duration while the request keeps running, and that the running stage is reported as unfinished
+    """
+
+    get_url_content = app.get_url_content
+    def slow_get_url_content(url):
+        time.sleep(0.5)
+        return get_url_content(url)
+    monkeypatch.setattr(app, "get_url_content", slow_get_url_content)
+
+    profiled_app = app.profiling.ProfilingMiddleware(app.app, sample_rate=0, profile_dir=str(tmp_path), slow_seconds=0, max_seconds=0.1)
+    async with httpx.AsyncClient(transport=ASGIStreamingTransport(profiled_app), base_url="http://testserver", timeout=30) as profiled:
+        response = await profiled.post("/api/meme/", json={"url": image_server.url(example_image), "caption": "Cat"}, headers={"X-Profile": "1"})
+        assert response.status_code == 200
+        assert response.json()["status"] == "success"
+        name = response.headers["X-Profile-Id"]
+
+    assert not app.profiling.profiling_active
+    with open(tmp_path / f"{name}.json") as f:
+        report = json.load(f)
+    assert report["stopped_by"] == "max-duration"
+    assert report["duration"] < 0.5
+    assert [(stage["name"], stage.get("unfinished", False)) for stage in report["stages"]] == [("download", True)]
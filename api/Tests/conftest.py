@@ -0,0 +1,249 @@
+"""
+Contains the fixtures of the test harness. The api runs in the test process and is called through an ASGI transport,
+the test images are served by a local http server, and every pytest-xdist worker uses its own postgres schema, so the
+tests run in parallel without a separately running api, internet access or interfering with each other
+"""
+
+import asyncio
+import io
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import httpx
+import pytest
+import pytest_asyncio
+from PIL import Image, ImageDraw, ImageFont
+
+# The modules of the api import each other by name
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+
+def pytest_configure(config):
+    """Gives every pytest-xdist worker its own postgres schema. Runs before the test modules import the storage backends
+    """
+
+    worker = getattr(config, "workerinput", {}).get("workerid", "main")
+    os.environ["CMG_DATABASE_SCHEMA"] = f"test_{worker}"
+
+
+# ------------------------------------ #
+#             Test images              #
+# ------------------------------------ #
+
+def encode_image(image: Image.Image, format: str, **options) -> bytes:
+    out = io.BytesIO()
+    image.save(out, format, **options)
+    return out.getvalue()
+
+def create_animated_image() -> bytes:
+    """Creates an animated GIF of a disc with a band that moves from left to right
+    """
+
+    frames = []
+    for i in range(8):
+        frame = Image.new("RGB", (160, 160), "black")
+        draw = ImageDraw.Draw(frame)
+        draw.ellipse((10, 10, 150, 150), fill=(40, 90, 200))
+        draw.rectangle((20 + i * 15, 30, 45 + i * 15, 130), fill=(60, 170, 70))
+        frames.append(frame)
+    return encode_image(frames[0], "GIF", save_all=True, append_images=frames[1:], duration=100, loop=0)
+
+def create_photo() -> bytes:
+    """Creates a JPEG with a diagonal gradient and a few shapes
+    """
+
+    image = Image.linear_gradient("L").rotate(45).resize((250, 250)).convert("RGB")
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((20, 150, 110, 230), fill=(150, 90, 30))
+    draw.ellipse((140, 20, 230, 110), fill=(240, 240, 200))
+    return encode_image(image, "JPEG", quality=90)
+
+def create_text_image(text: str) -> bytes:
+    """Creates a JPEG with black text on a white background for the OCR tests
+    """
+
+    import render
+
+    image = Image.new("RGB", (1000, 563), "white")
+    if text:
+        draw = ImageDraw.Draw(image)
+        font = ImageFont.truetype(render.FONT_PATH, 160)
+        draw.text((500, 280), text, fill="black", font=font, anchor="mm")
+    return encode_image(image, "JPEG", quality=95)
+
+
+class ImageServer:
+    """Serves the test images over http on a free port, so the api downloads them like images from the internet
+    """
+
+    def __init__(self, images: dict[str, tuple[bytes, str]]):
+        """
+        Args:
+            images (dict): The content and the mime type of every image by file name
+        """
+
+        self.images = images
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                image = images.get(handler.path.lstrip("/"))
+                if image is None:
+                    handler.send_error(404)
+                    return
+                handler.send_response(200)
+                handler.send_header("Content-Type", image[1])
+                handler.send_header("Content-Length", str(len(image[0])))
+                handler.end_headers()
+                handler.wfile.write(image[0])
+
+            def log_message(handler, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, name="image-server", daemon=True)
+
+    def url(self, name: str) -> str:
+        return f"http://127.0.0.1:{self.server.server_port}/{name}"
+
+    def content(self, name: str) -> bytes:
+        return self.images[name][0]
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# ------------------------------------ #
+#            ASGI transport            #
+# ------------------------------------ #
+
+class ASGIResponseStream(httpx.AsyncByteStream):
+    """The body of a response that is still being sent by the app
+    """
+
+    def __init__(self, messages: asyncio.Queue, task: asyncio.Task, disconnected: asyncio.Event):
+        self.messages = messages
+        self.task = task
+        self.disconnected = disconnected
+
+    async def __aiter__(self):
+        while True:
+            message = await self.messages.get()
+            if message is None:
+                return
+            yield message.get("body", b"")
+            if not message.get("more_body", False):
+                return
+
+    async def aclose(self):
+        # Tells the app that the client went away, e.g. when a test leaves an event stream
+        self.disconnected.set()
+        try:
+            await asyncio.wait_for(asyncio.shield(self.task), 5)
+        except asyncio.TimeoutError:
+            # Before Python 3.11, asyncio.TimeoutError is not the builtin TimeoutError
+            self.task.cancel()
+
+
+class ASGIStreamingTransport(httpx.AsyncBaseTransport):
+    """Calls an ASGI app in the current event loop. Unlike httpx.ASGITransport, the response is returned as soon as
+    its headers are sent, so endless responses such as Server-Sent Events can be read while they are streamed
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        body = await request.aread()
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": request.method,
+            "scheme": request.url.scheme,
+            "path": request.url.path,
+            "raw_path": request.url.raw_path.split(b"?")[0],
+            "query_string": request.url.query,
+            "root_path": "",
+            "headers": [(key.lower(), value) for key, value in request.headers.raw],
+            "server": (request.url.host, request.url.port or 80),
+            "client": ("127.0.0.1", 50000)
+        }
+
+        messages: asyncio.Queue = asyncio.Queue()
+        disconnected = asyncio.Event()
+        body_sent = False
+
+        async def receive():
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            await messages.put(message)
+
+        task = asyncio.create_task(self.app(scope, receive, send))
+        # None marks the end of the messages, also if the app failed
+        task.add_done_callback(lambda _: messages.put_nowait(None))
+
+        start = await messages.get()
+        if start is None:
+            task.result()
+            raise RuntimeError("The app did not send a response")
+
+        return httpx.Response(start["status"], headers=start.get("headers", []), stream=ASGIResponseStream(messages, task, disconnected))
+
+
+# ------------------------------------ #
+#               Fixtures               #
+# ------------------------------------ #
+
+@pytest.fixture(scope="session")
+def image_server():
+    """Serves the test images. Use image_server.url(name) to get the url of an image
+    """
+
+    server = ImageServer({
+        "earth.gif": (create_animated_image(), "image/gif"),
+        "coconut.jpg": (create_photo(), "image/jpeg"),
+        "smile.jpg": (create_text_image("SMILE"), "image/jpeg"),
+        "spoe.jpg": (create_text_image("SPÖ"), "image/jpeg"),
+        "blank.jpg": (create_text_image(""), "image/jpeg")
+    })
+    server.start()
+    yield server
+    server.stop()
+
+@pytest_asyncio.fixture(scope="session", loop_scope="session")
+async def app():
+    """Starts the api once per worker, including its background tasks
+    """
+
+    # Imported here, after pytest_configure has selected the schema of the worker
+    import main
+    import pg
+
+    pg.engine.echo = False
+    await main.db.create_table()
+    async with main.app.router.lifespan_context(main.app):
+        yield main
+    await main.db.close_connection()
+
+@pytest_asyncio.fixture(loop_scope="session")
+async def client(app):
+    """Provides a client for the api with an empty database
+    """
+
+    await app.db.clear_db()
+    app.similarity_index_loaded = False
+    app.top_memes.invalidate()
+
+    async with httpx.AsyncClient(transport=ASGIStreamingTransport(app.app), base_url="http://testserver", timeout=30) as client:
+        yield client
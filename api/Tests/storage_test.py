@@ -0,0 +1,358 @@
+import pytest
+import pytest_asyncio
+import hashlib
+import base64
+from datetime import datetime, timedelta, timezone
+from src import pg, sqlite
+
+# The same tests run against every storage backend. The postgres backend needs the database of the api tests,
+# the sqlite backend stores its files in a temporary directory
+
+
+@pytest_asyncio.fixture(params=["postgres", "sqlite"])
+async def db(request, tmp_path, monkeypatch):
+    """Provides an empty storage backend
+    """
+
+    backend = pg if request.param == "postgres" else sqlite
+    if backend is sqlite:
+        monkeypatch.setattr(sqlite, "DATA_DIR", str(tmp_path))
+
+    await backend.init_connection()
+    await backend.create_table()
+    await backend.clear_db()
+    yield backend
+    await backend.close_connection()
+
+
+# ------------------------------------ #
+#                Memes                 #
+# ------------------------------------ #
+
+@pytest.mark.asyncio
+async def test_create_and_get_meme(db):
+    """Tests that a meme is stored with all its fields and can be retrieved by its id
+    """
+
+    id = await db.create_meme("https://example.com/cat.png", "Cat", b"cat image", "image/png", phash=42, bytes_saved=0)
+    assert id == 1
+
+    meme = await db.get_meme_by_id(id)
+    assert meme.id == 1
+    assert meme.url == "https://example.com/cat.png"
+    assert meme.caption == "Cat"
+    assert meme.upvotes == 0
+    assert meme.stored_image.data == b"cat image"
+    assert meme.image_type == "image/png"
+    assert meme.original_hash is None
+    assert meme.original_id is None
+    assert db.get_phash(meme) == 42
+
+    assert await db.get_meme_by_id(2) is None
+    assert await db.create_meme("", "Dog", b"dog image", "image/png") == 2
+
+@pytest.mark.asyncio
+async def test_clear_db(db):
+    """Tests that clearing the database deletes all memes and images and restarts the ids
+    """
+
+    id = await db.create_meme("", "Cat", b"cat image", "image/png")
+    await db.upvote_meme(id)
+
+    await db.clear_db()
+    assert await db.get_meme_by_id(id) is None
+    assert await db.get_image(hashlib.sha256(b"cat image").hexdigest()) is None
+    assert await db.get_top_ten_ranks() == []
+    assert await db.create_meme("", "Dog", b"dog image", "image/png") == 1
+
+@pytest.mark.asyncio
+async def test_image_stored_once(db):
+    """Tests that memes with the same image share it and that the image is deleted with the last meme that uses it
+    """
+
+    first = await db.create_meme("https://example.com/cat.png", "Cat", b"cat image", "image/png")
+    second = await db.create_meme("", "Another cat", b"cat image", "image/png")
+    hash = hashlib.sha256(b"cat image").hexdigest()
+
+    assert (await db.get_meme_by_id(first)).image_hash == (await db.get_meme_by_id(second)).image_hash == hash
+    assert await db.get_image_by_url("https://example.com/cat.png") == b"cat image"
+
+    assert await db.delete_meme(first)
+    assert await db.get_image(hash) == (b"cat image", "image/png")
+
+    assert await db.delete_meme(second)
+    assert await db.get_image(hash) is None
+    assert await db.get_image_by_url("https://example.com/cat.png") is None
+    assert not await db.delete_meme(second)
+
+@pytest.mark.asyncio
+async def test_original_image(db):
+    """Tests that the uploaded image is kept next to the transcoded image and counted in the transcoding statistics
+    """
+
+    id = await db.create_meme("https://example.com/cat.png", "Cat", b"small", "image/webp", None, None, b"large image", "image/png", 6)
+
+    meme = await db.get_meme_by_id(id)
+    assert meme.stored_image.data == b"small"
+    assert meme.bytes_saved == 6
+    assert await db.get_image(meme.original_hash) == (b"large image", "image/png")
+    # The url points to the image as it was downloaded
+    assert await db.get_image_by_url("https://example.com/cat.png") == b"large image"
+    assert await db.get_total_bytes_saved() == (1, 6)
+
+@pytest.mark.asyncio
+async def test_list_memes(db):
+    """Tests listing all memes, memes by ids and a random meme
+    """
+
+    assert await db.get_random_meme() is None
+
+    for i in range(3):
+        await db.create_meme("", f"Caption {i}", f"image {i}".encode("utf-8"), "image/png")
+
+    assert sorted(meme.caption for meme in await db.get_all_memes()) == ["Caption 0", "Caption 1", "Caption 2"]
+    assert [meme.id for meme in await db.get_memes_by_ids([3, 5, 1])] == [3, 1]
+    assert await db.get_memes_by_ids([]) == []
+    assert (await db.get_random_meme()).id in (1, 2, 3)
+
+@pytest.mark.asyncio
+async def test_phashes(db):
+    """Tests that perceptual hashes that do not fit into a signed 64 bit integer are returned unchanged
+    """
+
+    large = (1 << 64) - 1
+    await db.create_meme("", "Large", b"large", "image/png", phash=large)
+    await db.create_meme("", "Small", b"small", "image/png", phash=7)
+    await db.create_meme("", "None", b"none", "image/png")
+
+    assert await db.get_all_phashes() == [(1, large), (2, 7)]
+    assert await db.get_all_phashes(1) == [(2, 7)]
+    assert await db.get_phashes_by_ids([1, 3, 4]) == {1: large}
+
+# ------------------------------------ #
+#                Votes                 #
+# ------------------------------------ #
+
+@pytest.mark.asyncio
+async def test_votes(db):
+    """Tests upvotes and downvotes. The upvotes never drop below 0
+    """
+
+    id = await db.create_meme("", "Cat", b"cat", "image/png")
+
+    assert await db.upvote_meme(id)
+    assert await db.upvote_meme(id)
+    assert await db.downvote_meme(id)
+    assert (await db.get_meme_by_id(id)).upvotes == 1
+
+    assert await db.downvote_meme(id)
+    assert await db.downvote_meme(id)
+    assert (await db.get_meme_by_id(id)).upvotes == 0
+
+    assert not await db.upvote_meme(id + 1)
+    assert not await db.downvote_meme(id + 1)
+
+@pytest.mark.asyncio
+async def test_top_ten(db):
+    """Tests that the top 10 are ordered by upvotes and then by id
+    """
+
+    for i in range(12):
+        id = await db.create_meme("", f"Caption {i}", f"image {i}".encode("utf-8"), "image/png")
+        for _ in range(i % 4):
+            await db.upvote_meme(id)
+
+    ranks = await db.get_top_ten_ranks()
+    assert ranks == [(4, 3), (8, 3), (12, 3), (3, 2), (7, 2), (11, 2), (2, 1), (6, 1), (10, 1), (1, 0)]
+    assert [(meme.id, meme.upvotes) for meme in await db.get_top_ten_memes()] == ranks
+
+@pytest.mark.asyncio
+async def test_trending_and_hot(db, monkeypatch):
+    """Tests that votes are rolled up into the trending and hot rankings
+    """
+
+    monkeypatch.setattr(db, "VOTE_ROLLUP_LAG", timedelta(0))
+
+    first = await db.create_meme("", "First", b"first", "image/png")
+    second = await db.create_meme("", "Second", b"second", "image/png")
+    await db.upvote_meme(first)
+    for _ in range(3):
+        await db.upvote_meme(second)
+    await db.downvote_meme(second)
+
+    await db.compact_votes()
+    # Events are only rolled up once
+    await db.compact_votes()
+
+    since = datetime.now(timezone.utc) - timedelta(hours=1)
+    assert await db.get_trending_ranks(since) == [(second, 2), (first, 1)]
+    assert await db.get_trending_ranks(since, limit=1) == [(second, 2)]
+
+    hot = await db.get_hot_ranks()
+    assert [id for id, _ in hot] == [second, first]
+    assert hot[0][1] == pytest.approx(2, rel=0.01)
+    assert hot[1][1] == pytest.approx(1, rel=0.01)
+
+    await db.delete_meme(second)
+    assert [id for id, _ in await db.get_hot_ranks()] == [first]
+
+# ------------------------------------ #
+#         Renderings and keys          #
+# ------------------------------------ #
+
+@pytest.mark.asyncio
+async def test_rendered_images(db):
+    """Tests that renderings are cached per size, style and format and deleted with their meme
+    """
+
+    id = await db.create_meme("", "Cat", b"cat", "image/png")
+    assert await db.get_rendered_image(id, 0, "classic", "JPEG") is None
+
+    await db.store_rendered_image(id, 0, "classic", "JPEG", b"rendered", "image/jpeg")
+    # The first rendering is kept
+    await db.store_rendered_image(id, 0, "classic", "JPEG", b"other", "image/jpeg")
+    assert await db.get_rendered_image(id, 0, "classic", "JPEG") == (b"rendered", "image/jpeg")
+    assert await db.get_rendered_image(id, 0, "classic", "WEBP") is None
+
+    await db.delete_meme(id)
+    assert await db.get_rendered_image(id, 0, "classic", "JPEG") is None
+
+@pytest.mark.asyncio
+async def test_idempotency_keys(db):
+    """Tests claiming, completing, releasing and expiring idempotency keys
+    """
+
+    ttl = timedelta(hours=1)
+    lease = timedelta(minutes=5)
+
+    assert await db.claim_idempotency_key("key", "fingerprint", ttl, lease) == (True, None)
+
+    claimed, record = await db.claim_idempotency_key("key", "fingerprint", ttl, lease)
+    assert not claimed
+    assert record.fingerprint == "fingerprint"
+    assert record.status_code is None
+
+    await db.complete_idempotency_key("key", 200, {"status": "success", "data": {"id": 1}})
+    claimed, record = await db.claim_idempotency_key("key", "fingerprint", ttl, lease)
+    assert not claimed
+    assert record.status_code == 200
+    assert record.response == {"status": "success", "data": {"id": 1}}
+
+    # Completed keys are not released
+    await db.release_idempotency_key("key")
+    assert not (await db.claim_idempotency_key("key", "fingerprint", ttl, lease))[0]
+
+    await db.claim_idempotency_key("released", "fingerprint", ttl, lease)
+    await db.release_idempotency_key("released")
+    assert (await db.claim_idempotency_key("released", "fingerprint", ttl, lease))[0]
+
+    # Expired keys are deleted and can be claimed again
+    assert (await db.claim_idempotency_key("expired", "fingerprint", timedelta(seconds=-1), lease))[0]
+    assert await db.delete_expired_idempotency_keys() == 1
+    assert (await db.claim_idempotency_key("expired", "fingerprint", ttl, lease))[0]
+
+
+# ------------------------------------ #
+#              Migration               #
+# ------------------------------------ #
+
+@pytest.mark.asyncio
+async def test_migrate_base64_images():
+    """Tests that a postgres database of the first version, which stored the base64 encoded image in every meme, is migrated
+    without losing memes or images
+    """
+
+    png = b"\x89PNG\r\n\x1a\nshared image"
+    jpeg = b"\xff\xd8\xffsingle image"
+
+    await pg.init_connection()
+    await pg.create_table()
+    await pg.destroy_db()
+    try:
+        async with pg.get_session() as session:
+            await session.execute(pg.text("CREATE TABLE memes (id SERIAL PRIMARY KEY, url VARCHAR, image VARCHAR, caption VARCHAR, upvotes INTEGER)"))
+            await session.execute(pg.text("CREATE INDEX ix_memes_id ON memes (id)"))
+            for url, image, caption, upvotes in [
+                ("https://example.com/cat.png", png, "Cat", 3),
+                ("", png, "Same cat", 0),
+                ("", jpeg, "Dog", 1)
+            ]:
+                await session.execute(
+                    pg.text("INSERT INTO memes (url, image, caption, upvotes) VALUES (:url, :image, :caption, :upvotes)"),
+                    {"url": url, "image": base64.b64encode(image).decode("utf-8"), "caption": caption, "upvotes": upvotes}
+                )
+            await session.commit()
+
+        await pg.create_table()
+
+        png_hash = hashlib.sha256(png).hexdigest()
+        jpeg_hash = hashlib.sha256(jpeg).hexdigest()
+        async with pg.get_session() as session:
+            images = (await session.execute(pg.select(pg.StoredImage.hash, pg.StoredImage.content_type, pg.StoredImage.refcount))).all()
+            assert sorted(images) == sorted([(png_hash, "image/png", 2), (jpeg_hash, "image/jpeg", 1)])
+            columns = await session.execute(pg.text("SELECT column_name FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = 'memes'"))
+            assert "image" not in columns.scalars().all()
+
+        cat = await pg.get_meme_by_id(1)
+        assert (cat.caption, cat.upvotes, cat.image_hash, cat.image_type, cat.bytes_saved) == ("Cat", 3, png_hash, "image/png", 0)
+        assert cat.image == base64.b64encode(png).decode("utf-8")
+        assert (await pg.get_meme_by_id(3)).image_type == "image/jpeg"
+        assert await pg.get_image_by_url("https://example.com/cat.png") == png
+
+        # The migrated table works like a new one and the migration is not repeated
+        assert await pg.create_meme("", "Bird", png, "image/png") == 4
+        await pg.create_table()
+        assert await pg.delete_meme(1)
+        assert await pg.delete_meme(2)
+        assert await pg.get_image(png_hash) == (png, "image/png")
+        assert await pg.delete_meme(4)
+        assert await pg.get_image(png_hash) is None
+    finally:
+        await pg.destroy_db()
+        await pg.create_table()
+        await pg.close_connection()
+
+
+# ------------------------------------ #
+#          Export and import           #
+# ------------------------------------ #
+
+@pytest.mark.asyncio
+async def test_export_import_round_trip(tmp_path, monkeypatch):
+    """Tests that importing an archive created by the export tool into an empty postgres database restores every meme, image and url
+    """
+
+    from Tools import exportMemes, importMemes
+
+    # The images are exported in several pages
+    monkeypatch.setattr(exportMemes, "IMAGE_BATCH_SIZE", 2)
+
+    await pg.init_connection()
+    await pg.create_table()
+    await pg.clear_db()
+
+    await pg.create_meme("https://example.com/cat.png", "Cat", b"cat image", "image/png", phash=(1 << 63) + 5)
+    await pg.create_meme("", "Same cat", b"cat image", "image/png", original_id=1)
+    await pg.create_meme("https://example.com/dog.jpg", "Dog", b"dog", "image/webp", original_image=b"dog image", original_content_type="image/jpeg", bytes_saved=6)
+    await pg.upvote_meme(3)
+    await pg.delete_meme(2)
+    await pg.create_meme("", "Bird", b"bird image", "image/gif")
+
+    async def dump():
+        async with pg.get_session() as session:
+            memes = (await session.execute(pg.select(*exportMemes.MEME_COLUMNS).order_by(pg.Meme.id))).all()
+            images = (await session.execute(pg.select(pg.StoredImage.hash, pg.StoredImage.data, pg.StoredImage.content_type, pg.StoredImage.refcount).order_by(pg.StoredImage.hash))).all()
+            urls = (await session.execute(pg.select(pg.ImageUrl.url, pg.ImageUrl.hash).order_by(pg.ImageUrl.url))).all()
+        return memes, images, urls
+
+    exported = await dump()
+    archive = str(tmp_path / "memes.tar.gz")
+    await exportMemes.export_memes(archive)
+
+    await pg.clear_db()
+    await importMemes.import_memes(archive)
+    assert await dump() == exported
+
+    # New memes continue after the imported ids
+    assert await pg.create_meme("", "Fish", b"fish image", "image/png") == 5
+    await pg.close_connection()
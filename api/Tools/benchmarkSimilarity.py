@@ -0,0 +1,49 @@
+"""
+A tool that benchmarks the perceptual hash index used to detect near-duplicate memes. The index is filled with random hashes and queried with hashes that are a few bits away from stored ones.
+"""
+
+import random
+import time
+from sys import argv
+from src.similarity import HashIndex, HASH_BITS
+
+
+def flip_bits(hash: int, count: int) -> int:
+    for bit in random.sample(range(HASH_BITS), count):
+        hash ^= 1 << bit
+    return hash
+
+def main():
+    size : int = int(argv[1]) if len(argv) > 1 else 1_000_000
+    max_distance : int = int(argv[2]) if len(argv) > 2 else 4
+    queries = 10_000
+
+    random.seed(0)
+    hashes = [random.getrandbits(HASH_BITS) for _ in range(size)]
+
+    index = HashIndex(max_distance)
+    start = time.perf_counter()
+    for id, hash in enumerate(hashes):
+        index.add(id, hash)
+    elapsed = time.perf_counter() - start
+    print(f"Inserted {size} hashes in {elapsed:.2f}s")
+
+    # Half of the queries are near-duplicates of a stored hash, the other half are random
+    targets = [random.randrange(size) for _ in range(queries // 2)]
+    probes = [flip_bits(hashes[id], random.randint(0, max_distance)) for id in targets]
+    probes += [random.getrandbits(HASH_BITS) for _ in range(queries - len(probes))]
+
+    found = 0
+    start = time.perf_counter()
+    for i, probe in enumerate(probes):
+        matches = index.query(probe)
+        if i < len(targets) and any(id == targets[i] for id, _ in matches):
+            found += 1
+    elapsed = time.perf_counter() - start
+
+    print(f"Ran {queries} queries in {elapsed:.2f}s ({elapsed / queries * 1e6:.1f}us per query)")
+    print(f"Found {found}/{len(targets)} near-duplicates")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+A tool that measures the latency of the storage operations the api uses most, without the api in between. It deletes all data of the selected backend,
+so run it against a development database only. The postgres backend uses the database configured in src/pg.py, the sqlite backend a temporary directory.
+
+Usage: python -m Tools.benchmarkStorage [postgres|sqlite, default postgres] [memes, default 200]
+"""
+
+import asyncio
+import os
+import tempfile
+import time
+from sys import argv
+from src import pg, sqlite
+
+# The size of the image of every meme
+IMAGE_SIZE = 100 * 1024
+
+
+async def measure(name: str, operation, count: int):
+    """Runs an operation `count` times and prints the mean and the 95th percentile latency
+    """
+
+    timings = []
+    for i in range(count):
+        start = time.perf_counter()
+        await operation(i)
+        timings.append(time.perf_counter() - start)
+
+    timings.sort()
+    print(f"{name:<18} mean {sum(timings) / count * 1000:7.3f}ms, p95 {timings[int(count * 0.95)] * 1000:7.3f}ms")
+
+async def run(db, count: int):
+    await db.init_connection()
+    await db.destroy_db()
+    await db.create_table()
+
+    ids = []
+
+    async def create(i):
+        ids.append(await db.create_meme("", f"Benchmark {i}", os.urandom(IMAGE_SIZE), "image/png", phash=i))
+
+    await measure("create_meme", create, count)
+    await measure("get_meme_by_id", lambda i: db.get_meme_by_id(ids[i]), count)
+    await measure("upvote_meme", lambda i: db.upvote_meme(ids[i]), count)
+    await measure("get_top_ten_ranks", lambda i: db.get_top_ten_ranks(), count)
+    await measure("get_top_ten_memes", lambda i: db.get_top_ten_memes(), count)
+    await measure("get_random_meme", lambda i: db.get_random_meme(), count)
+    await measure("delete_meme", lambda i: db.delete_meme(ids[i]), count)
+
+    await db.close_connection()
+
+def main():
+    name : str = argv[1] if len(argv) > 1 else "postgres"
+    count : int = int(argv[2]) if len(argv) > 2 else 200
+
+    if name == "postgres":
+        pg.engine.echo = False
+        asyncio.run(run(pg, count))
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        sqlite.DATA_DIR = directory
+        asyncio.run(run(sqlite, count))
+
+
+if __name__ == "__main__":
+    main()
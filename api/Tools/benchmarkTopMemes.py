@@ -0,0 +1,59 @@
+"""
+A tool that benchmarks the '/api/meme/top/' endpoint with large images. Ten memes with incompressible images of the given size are created through the api
+and upvoted, then the endpoint is requested repeatedly. Run it against an empty database, otherwise memes with more upvotes may be measured instead.
+
+Usage: python -m Tools.benchmarkTopMemes [image size in MB, default 2] [requests, default 50]
+"""
+
+import base64
+import io
+import os
+import time
+from sys import argv
+import requests
+from PIL import Image
+
+api_url = "http://localhost:3000"
+
+
+def create_large_image(size: int) -> bytes:
+    """Creates a PNG of random noise that is about `size` bytes large
+    """
+
+    side = max(1, int((size / 3) ** 0.5))
+    image = Image.frombytes("RGB", (side, side), os.urandom(side * side * 3))
+    out = io.BytesIO()
+    image.save(out, "PNG", compress_level=1)
+    return out.getvalue()
+
+def main():
+    size : int = int(float(argv[1]) * 1024 * 1024) if len(argv) > 1 else 2 * 1024 * 1024
+    count : int = int(argv[2]) if len(argv) > 2 else 50
+
+    session = requests.Session()
+    for i in range(10):
+        image = base64.b64encode(create_large_image(size)).decode("utf-8")
+        response = session.post(f"{api_url}/api/meme/", json={"image": image, "caption": f"Benchmark {i}"})
+        assert response.json()["status"] == "success", response.text
+        session.post(f"{api_url}/api/meme/{response.json()['data']['id']}/vote/", json={"type": "upvote"})
+
+    # Warm up
+    session.get(f"{api_url}/api/meme/top/")
+
+    timings = []
+    body_size = 0
+    for _ in range(count):
+        start = time.perf_counter()
+        response = session.get(f"{api_url}/api/meme/top/")
+        body_size = len(response.content)
+        timings.append(time.perf_counter() - start)
+
+    timings.sort()
+    total = sum(timings)
+    print(f"Fetched the top 10 memes {count} times, {body_size / 1024 / 1024:.1f}MB per response")
+    print(f"Mean {total / count * 1000:.1f}ms, median {timings[count // 2] * 1000:.1f}ms, p95 {timings[int(count * 0.95)] * 1000:.1f}ms")
+    print(f"Throughput {body_size * count / total / 1024 / 1024:.0f}MB/s")
+
+
+if __name__ == "__main__":
+    main()
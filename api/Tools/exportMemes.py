@@ -0,0 +1,105 @@
+"""
+A tool that exports all memes into a tar archive: every distinct image once as 'images/{sha256}', followed by 'image_urls.jsonl' and 'memes.jsonl' with one JSON object per line.
+The url mappings and memes are streamed from the database with server-side cursors and the images are fetched a few at a time,
+so the memory usage depends neither on the number of memes nor on the total size of the images. All rows are read in one
+read-only REPEATABLE READ transaction, so the archive is a consistent snapshot even while the api keeps creating and deleting memes. Archives ending in '.gz' are compressed.
+The vote history, the hourly vote buckets and the hot scores are not exported, so trending and hot rankings start empty after an import.
+
+Usage: python -m Tools.exportMemes {archive}
+"""
+
+import asyncio
+import io
+import json
+import tarfile
+import tempfile
+import time
+from sys import argv
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncConnection
+from src.pg import engine, close_connection, StoredImage, ImageUrl, Meme
+
+# The number of rows fetched from the database at once
+BATCH_SIZE = 500
+# The number of images fetched from the database at once. Images can be several megabytes each, so they are fetched in small pages
+# instead of through a server-side cursor, which always buffers at least 50 rows with asyncpg
+IMAGE_BATCH_SIZE = 8
+
+MEME_COLUMNS = [
+    Meme.id,
+    Meme.url,
+    Meme.caption,
+    Meme.upvotes,
+    Meme.image_hash,
+    Meme.original_hash,
+    Meme.bytes_saved,
+    Meme.phash,
+    Meme.original_id
+]
+
+
+def add_file(archive: tarfile.TarFile, name: str, data: bytes, headers: dict | None = None):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(time.time())
+    if headers:
+        info.pax_headers = headers
+    archive.addfile(info, io.BytesIO(data))
+
+async def write_jsonl(archive: tarfile.TarFile, connection: AsyncConnection, name: str, columns: list):
+    """Streams the given columns of all rows into a temporary file and adds it to the archive as JSON lines
+    """
+
+    count = 0
+    with tempfile.TemporaryFile() as file:
+        stmt = select(*columns).order_by(columns[0]).execution_options(yield_per=BATCH_SIZE)
+        result = await connection.stream(stmt)
+        async for row in result:
+            file.write(json.dumps(row._asdict(), separators=(",", ":")).encode("utf-8") + b"\n")
+            count += 1
+
+        info = tarfile.TarInfo(name)
+        info.size = file.tell()
+        info.mtime = int(time.time())
+        file.seek(0)
+        archive.addfile(info, file)
+
+    return count
+
+async def export_memes(path: str):
+    start = time.perf_counter()
+    mode = "w|gz" if path.endswith(".gz") else "w|"
+
+    with tarfile.open(path, mode, format=tarfile.PAX_FORMAT) as archive:
+        # Every section is read from the same snapshot, so no meme references an image or url that is missing from the archive
+        async with engine.connect() as connection:
+            connection = await connection.execution_options(isolation_level="REPEATABLE READ", postgresql_readonly=True)
+            async with connection.begin():
+                # Images come first so an import can insert them before the memes that reference them
+                images = 0
+                last_hash = ""
+                while True:
+                    stmt = select(StoredImage.hash, StoredImage.content_type, StoredImage.data).where(StoredImage.hash > last_hash).order_by(StoredImage.hash).limit(IMAGE_BATCH_SIZE)
+                    rows = (await connection.execute(stmt)).all()
+                    if not rows:
+                        break
+                    for hash, content_type, data in rows:
+                        add_file(archive, f"images/{hash}", data, {"CMG.content_type": content_type or ""})
+                        images += 1
+                    last_hash = rows[-1].hash
+                    # Release the page before the next one is fetched
+                    del rows
+
+                urls = await write_jsonl(archive, connection, "image_urls.jsonl", [ImageUrl.url, ImageUrl.hash])
+                memes = await write_jsonl(archive, connection, "memes.jsonl", MEME_COLUMNS)
+
+    await close_connection()
+    print(f"Exported {memes} memes, {images} images and {urls} urls in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    if len(argv) != 2:
+        print("Usage: python -m Tools.exportMemes {archive}")
+        exit(1)
+
+    asyncio.run(export_memes(argv[1]))
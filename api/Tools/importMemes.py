@@ -0,0 +1,139 @@
+"""
+A tool that imports an archive created by exportMemes.py. The archive is read and decompressed in a separate thread while the previous batch is written to the database with COPY,
+so reading and inserting overlap. Memes keep their ids; memes whose id already exists are skipped. The import runs in a single transaction.
+
+Usage: python -m Tools.importMemes {archive}
+"""
+
+import asyncio
+import json
+import tarfile
+import threading
+import time
+from sys import argv
+import asyncpg
+from src.pg import DATABASE_DSN, DATABASE_SCHEMA, create_table, close_connection
+
+# A batch is written once it holds this many rows or this many bytes of images
+BATCH_ROWS = 5000
+BATCH_BYTES = 32 * 1024 * 1024
+# The number of decoded batches that may wait for the database
+QUEUE_SIZE = 4
+
+IMAGE_COLUMNS = ["hash", "data", "content_type"]
+URL_COLUMNS = ["url", "hash"]
+MEME_COLUMNS = ["id", "url", "caption", "upvotes", "image_hash", "original_hash", "bytes_saved", "phash", "original_id"]
+
+# Moves the rows of a staging table into the real table. Rows that already exist are skipped
+MERGE_STATEMENTS = {
+    "images": "INSERT INTO images (hash, data, content_type, refcount) SELECT hash, data, content_type, 0 FROM import_images ON CONFLICT (hash) DO NOTHING",
+    "image_urls": "INSERT INTO image_urls (url, hash) SELECT url, hash FROM import_image_urls ON CONFLICT (url) DO NOTHING",
+    "memes": f"INSERT INTO memes ({', '.join(MEME_COLUMNS)}) SELECT {', '.join(MEME_COLUMNS)} FROM import_memes ON CONFLICT (id) DO NOTHING"
+}
+
+
+def read_archive(path: str, queue: asyncio.Queue, loop: asyncio.AbstractEventLoop):
+    """Reads the archive in batches and puts (table, columns, rows) tuples into the queue. Runs in its own thread.
+    A final None marks the end of the archive, an exception is put into the queue if reading fails
+    """
+
+    def put(item):
+        asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    try:
+        with tarfile.open(path, "r|*") as archive:
+            images = []
+            size = 0
+            for member in archive:
+                file = archive.extractfile(member)
+                if file is None:
+                    continue
+
+                if member.name.startswith("images/"):
+                    data = file.read()
+                    images.append((member.name[len("images/"):], data, member.pax_headers.get("CMG.content_type") or None))
+                    size += len(data)
+                    if len(images) >= BATCH_ROWS or size >= BATCH_BYTES:
+                        put(("images", IMAGE_COLUMNS, images))
+                        images = []
+                        size = 0
+                    continue
+
+                if images:
+                    put(("images", IMAGE_COLUMNS, images))
+                    images = []
+                    size = 0
+
+                if member.name in ("image_urls.jsonl", "memes.jsonl"):
+                    table = member.name[:-len(".jsonl")]
+                    columns = URL_COLUMNS if table == "image_urls" else MEME_COLUMNS
+                    rows = []
+                    for line in file:
+                        entry = json.loads(line)
+                        rows.append(tuple(entry[column] for column in columns))
+                        if len(rows) >= BATCH_ROWS:
+                            put((table, columns, rows))
+                            rows = []
+                    if rows:
+                        put((table, columns, rows))
+
+            if images:
+                put(("images", IMAGE_COLUMNS, images))
+        put(None)
+    except Exception as e:
+        put(e)
+
+async def import_memes(path: str):
+    start = time.perf_counter()
+    await create_table()
+    await close_connection()
+
+    queue: asyncio.Queue = asyncio.Queue(QUEUE_SIZE)
+    reader = threading.Thread(target=read_archive, args=(path, queue, asyncio.get_running_loop()), daemon=True)
+    reader.start()
+
+    counts = {table: 0 for table in MERGE_STATEMENTS}
+    connection = await asyncpg.connect(DATABASE_DSN, server_settings={"search_path": DATABASE_SCHEMA} if DATABASE_SCHEMA is not None else None)
+    try:
+        async with connection.transaction():
+            for table in MERGE_STATEMENTS:
+                await connection.execute(f"CREATE TEMP TABLE import_{table} (LIKE {table}) ON COMMIT DROP")
+
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+
+                table, columns, rows = item
+                await connection.copy_records_to_table(f"import_{table}", records=rows, columns=columns)
+                result = await connection.execute(MERGE_STATEMENTS[table])
+                await connection.execute(f"TRUNCATE import_{table}")
+                counts[table] += int(result.split()[-1])
+
+            # The reference counts are derived from the memes instead of being imported
+            await connection.execute("""
+                WITH counts AS (
+                    SELECT hash, count(*) AS refcount FROM (
+                        SELECT image_hash AS hash FROM memes
+                        UNION ALL
+                        SELECT original_hash FROM memes WHERE original_hash IS NOT NULL
+                    ) refs GROUP BY hash
+                )
+                UPDATE images SET refcount = counts.refcount FROM counts WHERE counts.hash = images.hash
+            """)
+            await connection.execute("SELECT setval(pg_get_serial_sequence('memes', 'id'), GREATEST((SELECT max(id) FROM memes), 1))")
+    finally:
+        await connection.close()
+
+    reader.join()
+    print(f"Imported {counts['memes']} memes, {counts['images']} images and {counts['image_urls']} urls in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    if len(argv) != 2:
+        print("Usage: python -m Tools.importMemes {archive}")
+        exit(1)
+
+    asyncio.run(import_memes(argv[1]))
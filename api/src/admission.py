@@ -0,0 +1,142 @@
+"""
+Contains the admission queue that bounds how much expensive work, such as OCR, runs and waits at the same time
+"""
+
+import asyncio
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+
+class QueueFullError(Exception):
+    """Raised when work is not admitted because the queue is full
+    """
+
+    def __init__(self, name: str, retry_after: int):
+        super().__init__(f"The {name} queue is full")
+        self.retry_after = retry_after
+
+
+class AdmissionQueue:
+    """Runs at most `concurrency` units of work at once and lets at most `max_queue` more wait for a slot.
+    Work that arrives when both are exhausted is rejected immediately instead of waiting without limit, so
+    clients can back off and retry later instead of timing out.
+    """
+
+    def __init__(self, name: str, concurrency: int, max_queue: int):
+        """
+        Args:
+            name (str): The name of the queue, used in errors and statistics
+            concurrency (int): The maximum number of units of work running at once
+            max_queue (int): The maximum number of units of work waiting for a slot
+        """
+
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+        if max_queue < 0:
+            raise ValueError("max_queue must not be negative")
+
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.running = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_service = 0.0
+        self.completed = 0
+        self._waiters: deque[asyncio.Future] = deque()
+
+    @property
+    def waiting(self) -> int:
+        return sum(1 for waiter in self._waiters if not waiter.done())
+
+    @property
+    def saturated(self) -> bool:
+        """True if new work would be rejected
+        """
+
+        return self.running >= self.concurrency and self.waiting >= self.max_queue
+
+    def check(self):
+        """Rejects work early, before anything is done for it, if it would not be admitted right now
+
+        Raises:
+            QueueFullError: If all slots are taken and the queue is full
+        """
+
+        if self.saturated:
+            self.rejected += 1
+            raise QueueFullError(self.name, self.retry_after())
+
+    def retry_after(self) -> int:
+        """Estimates the number of seconds until a slot is likely to be free, based on the average service time
+        """
+
+        average = self.total_service / self.completed if self.completed else 1.0
+        return max(1, math.ceil(average * (self.waiting + 1) / self.concurrency))
+
+    def _release(self):
+        # Hand the slot directly to the next waiter so work that arrives later cannot overtake the queue
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.running -= 1
+
+    @asynccontextmanager
+    async def admit(self):
+        """Waits for a slot and holds it for the duration of the block
+
+        Raises:
+            QueueFullError: If all slots are taken and the queue is full
+        """
+
+        start = time.perf_counter()
+        if self.running < self.concurrency and not self.waiting:
+            self.running += 1
+        elif self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise QueueFullError(self.name, self.retry_after())
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # The slot was already handed to this waiter, pass it on
+                if waiter.done() and not waiter.cancelled():
+                    self._release()
+                raise
+
+        admitted = time.perf_counter()
+        wait = admitted - start
+        self.admitted += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+        try:
+            yield
+        finally:
+            self.total_service += time.perf_counter() - admitted
+            self.completed += 1
+            self._release()
+
+    def stats(self) -> dict:
+        """Returns the current load and the queue-wait metrics
+        """
+
+        return {
+            "name": self.name,
+            "concurrency": self.concurrency,
+            "max_queue": self.max_queue,
+            "running": self.running,
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "average_wait": self.total_wait / self.admitted if self.admitted else 0.0,
+            "max_wait": self.max_wait
+        }
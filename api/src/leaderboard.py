@@ -0,0 +1,154 @@
+"""
+Contains the broadcaster that pushes changes of the top 10 memes to connected clients as Server-Sent Events
+"""
+
+import asyncio
+import json
+from typing import Awaitable, Callable
+
+
+def format_event(event: str, data) -> str:
+    """Formats a Server-Sent Event
+
+    Args:
+        event (str): The event name
+        data: The json serializable event data
+
+    Returns:
+        str: The encoded event
+    """
+
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+class Leaderboard:
+    """Keeps the current top 10 ranking in memory and broadcasts the difference to all subscribers whenever it changes.
+
+    Votes only mark the ranking as stale. A single background task refetches it, at most once per min_interval,
+    so bursts of votes result in one query and one message per subscriber no matter how many clients are connected.
+    Every message is encoded once and the same string is handed to every subscriber.
+    """
+
+    def __init__(self, fetch_ranks: Callable[[], Awaitable[list[tuple[int, int]]]], min_interval: float = 0.1, queue_size: int = 100):
+        """
+        Args:
+            fetch_ranks (Callable): Returns the current top memes as (id, upvotes) pairs ordered by rank
+            min_interval (float): The minimum number of seconds between two refreshes
+            queue_size (int): The number of messages buffered per subscriber before it is resynchronized with a snapshot
+        """
+
+        self.fetch_ranks = fetch_ranks
+        self.min_interval = min_interval
+        self.queue_size = queue_size
+        self.ranks: list[tuple[int, int]] = []
+        self._subscribers: set[asyncio.Queue] = set()
+        self._stale = asyncio.Event()
+
+    @property
+    def subscriber_count(self) -> int:
+        return len(self._subscribers)
+
+    def subscribe(self) -> asyncio.Queue:
+        """Registers a new subscriber
+
+        Returns:
+            asyncio.Queue: Receives the encoded events. None means the subscriber missed messages and needs a new snapshot
+        """
+
+        queue = asyncio.Queue(self.queue_size)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self._subscribers.discard(queue)
+
+    def invalidate(self):
+        """Marks the ranking as stale so it is refetched by the background task
+        """
+
+        self._stale.set()
+
+    def snapshot(self) -> str:
+        """Returns the current ranking as an encoded 'snapshot' event
+        """
+
+        return format_event("snapshot", [
+            {"id": id, "rank": rank, "upvotes": upvotes} for rank, (id, upvotes) in enumerate(self.ranks, start=1)
+        ])
+
+    def diff(self, old: list[tuple[int, int]], new: list[tuple[int, int]]) -> dict | None:
+        """Computes the changes between two rankings
+
+        Returns:
+            dict | None: The memes whose rank or upvotes changed and the ids that left the ranking, or None if nothing changed
+        """
+
+        old_positions = {id: (rank, upvotes) for rank, (id, upvotes) in enumerate(old, start=1)}
+        new_ids = set()
+        changed = []
+        for rank, (id, upvotes) in enumerate(new, start=1):
+            new_ids.add(id)
+            if old_positions.get(id) != (rank, upvotes):
+                changed.append({"id": id, "rank": rank, "upvotes": upvotes})
+
+        removed = [id for id in old_positions if id not in new_ids]
+        if not changed and not removed:
+            return None
+        return {"changed": changed, "removed": removed}
+
+    def publish(self, message: str):
+        """Hands an encoded event to every subscriber. Subscribers whose queue is full are emptied and told to resynchronize
+        """
+
+        for queue in self._subscribers:
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+    async def refresh(self):
+        """Refetches the ranking and publishes the changes
+        """
+
+        ranks = await self.fetch_ranks()
+        changes = self.diff(self.ranks, ranks)
+        self.ranks = ranks
+        if changes is not None:
+            self.publish(format_event("diff", changes))
+
+    async def run(self):
+        """Refreshes the ranking whenever it is marked as stale. Runs until cancelled
+        """
+
+        self._stale.set()
+        while True:
+            await self._stale.wait()
+            self._stale.clear()
+            try:
+                await self.refresh()
+            except Exception as e:
+                print("Failed to refresh the leaderboard:", e)
+            await asyncio.sleep(self.min_interval)
+
+    async def stream(self, keepalive: float = 15):
+        """Yields the Server-Sent Events for one client: a snapshot followed by the diffs
+
+        Args:
+            keepalive (float): The number of seconds after which a comment is sent if nothing changed
+        """
+
+        queue = self.subscribe()
+        try:
+            yield self.snapshot()
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), keepalive)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+
+                yield self.snapshot() if message is None else message
+        finally:
+            self.unsubscribe(queue)
@@ -2,24 +2,142 @@
 Contains the main FastAPI application code and routes
 """
 
-import pg as pg
-from fastapi import FastAPI
+import storage
+import similarity
+import transcode
+import leaderboard
+import singleflight
+import admission
+import render
+import serialize
+import profiling
+from fastapi import FastAPI, Header, Response
+from fastapi.responses import StreamingResponse, JSONResponse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from pydantic import BaseModel
-from typing import Optional
+from typing import Optional, TypedDict
 import io
 import easyocr
+from PIL import Image
 
 
 import json
 import requests
 import base64
+import asyncio
+import os
+import hashlib
+from datetime import datetime, timedelta, timezone
 from enum import Enum
 
-app = FastAPI()
+# The storage backend selected with CMG_STORAGE
+db = storage.load_backend()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Creates or migrates the tables, starts the leaderboard broadcaster and the vote compactor and subscribes to the votes of all workers
+    """
+
+    await db.create_table()
+
+    refresher = asyncio.create_task(top_memes.run())
+    compactor = asyncio.create_task(run_periodically(db.compact_votes, VOTE_COMPACT_INTERVAL))
+    key_cleaner = asyncio.create_task(run_periodically(db.delete_expired_idempotency_keys, IDEMPOTENCY_CLEANUP_INTERVAL))
+    vote_listener_task = asyncio.create_task(listen_for_votes())
+
+    yield
+
+    refresher.cancel()
+    compactor.cancel()
+    key_cleaner.cancel()
+    vote_listener_task.cancel()
+    try:
+        await vote_listener_task
+    except asyncio.CancelledError:
+        pass
+
+app = FastAPI(lifespan=lifespan)
+if profiling.PROFILING:
+    app.add_middleware(profiling.ProfilingMiddleware)
 
 reader = easyocr.Reader(["de"])
 
 
+class DuplicatePolicy(str, Enum):
+    # Store near-duplicates like any other meme
+    allow = "allow"
+    # Refuse to store near-duplicates
+    reject = "reject"
+    # Store near-duplicates and link them to the original meme
+    link = "link"
+    # Link near-duplicates and reuse the caption of the original meme instead of running OCR
+    reuse_caption = "reuse_caption"
+
+# The maximum hamming distance between two perceptual hashes for the images to be considered near-duplicates
+DUPLICATE_DISTANCE = int(os.getenv("CMG_DUPLICATE_DISTANCE", "4"))
+# What to do when a new meme is a near-duplicate of an existing one. Can be overridden per request
+DUPLICATE_POLICY = DuplicatePolicy(os.getenv("CMG_DUPLICATE_POLICY", DuplicatePolicy.allow.value))
+
+# Transcode uploaded images to WebP (animated WebP for GIFs) before storing them
+TRANSCODE_IMAGES = os.getenv("CMG_TRANSCODE_IMAGES", "0") == "1"
+# The WebP quality between 0 and 100
+WEBP_QUALITY = int(os.getenv("CMG_WEBP_QUALITY", "80"))
+# Keep the uploaded image next to the transcoded one. Can be overridden per request
+KEEP_ORIGINAL = os.getenv("CMG_KEEP_ORIGINAL", "0") == "1"
+
+top_memes = leaderboard.Leaderboard(db.get_top_ten_ranks)
+
+# Identical concurrent work is only done once: reads by meme id, downloads by url and OCR by image hash
+meme_reads = singleflight.SingleFlight("meme_reads")
+url_downloads = singleflight.SingleFlight("url_downloads")
+ocr_runs = singleflight.SingleFlight("ocr_runs")
+renders = singleflight.SingleFlight("renders")
+
+# The maximum number of OCR runs at once and the maximum number of requests waiting for one
+OCR_CONCURRENCY = int(os.getenv("CMG_OCR_CONCURRENCY", "2"))
+OCR_QUEUE_DEPTH = int(os.getenv("CMG_OCR_QUEUE_DEPTH", "16"))
+
+# OCR runs in its own threads so it cannot take the threads needed by downloads and transcoding
+ocr_queue = admission.AdmissionQueue("ocr", OCR_CONCURRENCY, OCR_QUEUE_DEPTH)
+ocr_executor = ThreadPoolExecutor(OCR_CONCURRENCY, thread_name_prefix="ocr")
+
+# The delay before the first attempt to reopen the connection that listens for votes. It doubles after every failed attempt up to the maximum
+LISTEN_RETRY_DELAY = 1
+LISTEN_MAX_RETRY_DELAY = 60
+# The open connection that listens for the votes of all workers, None while it is being reopened
+vote_listener = None
+
+similarity_index = similarity.HashIndex(DUPLICATE_DISTANCE)
+similarity_index_loaded = False
+# The highest id of the memes loaded from the database. Memes with a greater id were created since, possibly by other workers
+similarity_index_last_id = 0
+similarity_index_lock = asyncio.Lock()
+
+
+class TrendingWindow(str, Enum):
+    hour = "hour"
+    day = "day"
+    week = "week"
+
+TRENDING_WINDOWS = {
+    TrendingWindow.hour: timedelta(hours=1),
+    TrendingWindow.day: timedelta(days=1),
+    TrendingWindow.week: timedelta(weeks=1)
+}
+
+# The number of seconds between two runs of the vote compactor that rolls votes up into the trending rankings
+VOTE_COMPACT_INTERVAL = float(os.getenv("CMG_VOTE_COMPACT_INTERVAL", "30"))
+
+# How long the outcome of a request with an Idempotency-Key header is kept
+IDEMPOTENCY_TTL = timedelta(hours=float(os.getenv("CMG_IDEMPOTENCY_TTL_HOURS", "24")))
+# How long a request with an Idempotency-Key may take before a retry with the same key is allowed to do the work again
+IDEMPOTENCY_LEASE = timedelta(minutes=5)
+# How long a duplicate request waits for the outcome of the request that is still in progress
+IDEMPOTENCY_WAIT_TIMEOUT = 60
+IDEMPOTENCY_CLEANUP_INTERVAL = 3600
+
 class VoteType(str, Enum):
     upvote = "upvote"
     downvote = "downvote"
@@ -39,9 +157,14 @@ class MemeCreationData(BaseModel):
     url: Optional[str] = ""
     image: Optional[str] = ""
     caption: Optional[str] = ""
-
-class MemeResponseData(BaseModel):
-    """Data returned in json format by the api
+    # Overrides the configured duplicate policy for this request
+    on_duplicate: Optional[DuplicatePolicy] = None
+    # Overrides whether the uploaded image is kept when it is transcoded
+    keep_original: Optional[bool] = None
+
+class MemeResponseData(TypedDict):
+    """Data returned in json format by the api. The data is serialized by the serialize module without validation,
+    which adds the base64 encoded image as the field 'image'
     """
 
     # A unique identifier for the meme
@@ -52,8 +175,67 @@ class MemeResponseData(BaseModel):
     caption: str
     # The number of upvotes the meme has
     upvotes: int
-    # The base64 encoded image
-    image: str
+    # The id of the meme this meme is a near-duplicate of
+    original_id: Optional[int]
+    # The mime type of the image
+    image_type: Optional[str]
+    # The number of bytes saved by transcoding the uploaded image
+    bytes_saved: int
+    # The score of the meme in the requested ranking, e.g. the number of votes within the trending window
+    score: Optional[float]
+
+class AdmissionStatsData(BaseModel):
+    """Data returned in json format by the api for the statistics of an admission queue
+    """
+
+    # The name of the queue
+    name: str
+    # The maximum number of requests running at once
+    concurrency: int
+    # The maximum number of requests waiting
+    max_queue: int
+    # The number of requests currently running
+    running: int
+    # The number of requests currently waiting
+    waiting: int
+    # The number of requests that were admitted
+    admitted: int
+    # The number of requests that were rejected with '503 Service Unavailable'
+    rejected: int
+    # The average and maximum number of seconds admitted requests waited in the queue
+    average_wait: float
+    max_wait: float
+
+class CoalescingStatsData(BaseModel):
+    """Data returned in json format by the api for the statistics of one deduplicated operation
+    """
+
+    # The name of the operation
+    name: str
+    # The number of calls
+    calls: int
+    # The number of calls that awaited the result of an identical call instead of doing the work
+    coalesced: int
+    # The number of distinct calls currently running
+    inflight: int
+
+class TranscodeStatsData(BaseModel):
+    """Data returned in json format by the api for the transcoding statistics
+    """
+
+    # The number of memes whose image was transcoded
+    transcoded: int
+    # The total number of bytes saved by transcoding
+    bytes_saved: int
+
+class SimilarMemeData(BaseModel):
+    """Data returned in json format by the api for a near-duplicate meme
+    """
+
+    # The unique identifier of the similar meme
+    id: int
+    # The hamming distance between the perceptual hashes of both images
+    distance: int
 
 def createSuccessResponse(data=None):
     if data is None:
@@ -64,6 +246,16 @@ def createErrorResponse(error):
     print("Error:", error)
     return {"status": "error", "error": error}
 
+def createBusyResponse(error: admission.QueueFullError) -> JSONResponse:
+    """Creates a '503 Service Unavailable' response telling the client when to retry
+    """
+
+    return JSONResponse(
+        createErrorResponse("The server is busy. Please retry later or provide a caption."),
+        status_code=503,
+        headers={"Retry-After": str(error.retry_after)}
+    )
+
 
 def get_url_content(url: str) -> bytes | None:
     """Fetches the content of a url
@@ -95,6 +287,199 @@ def get_text_from_image(image: bytes) -> str:
 
     extracted = reader.readtext(image, detail=0)
     return " ".join(extracted)
+
+async def run_periodically(task, interval: float):
+    """Runs a maintenance task, such as the vote compactor, every `interval` seconds. Runs until cancelled
+
+    Args:
+        task: The coroutine function to run
+        interval (float): The number of seconds between two runs
+    """
+
+    while True:
+        try:
+            await task()
+        except Exception as e:
+            print(f"Failed to run {task.__name__}:", e)
+        await asyncio.sleep(interval)
+
+async def listen_for_votes():
+    """Listens for the votes handled by all workers so the leaderboard stream sees them. Votes are announced through
+    postgres. When the connection is lost, e.g. because the database restarted, it is reopened with exponential backoff.
+    Runs until cancelled
+    """
+
+    global vote_listener
+
+    delay = LISTEN_RETRY_DELAY
+    while True:
+        lost = asyncio.Event()
+        try:
+            listener = await db.listen(db.VOTES_CHANNEL, lambda *args: top_memes.invalidate(), lost.set)
+        except Exception as e:
+            print(f"Failed to listen for votes, retrying in {delay}s. Until then the leaderboard stream only sees votes of this worker:", e)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, LISTEN_MAX_RETRY_DELAY)
+            continue
+
+        vote_listener = listener
+        # Votes announced while no connection was listening were missed
+        top_memes.invalidate()
+        try:
+            await lost.wait()
+            print("Lost the connection that listens for votes, reconnecting")
+            delay = LISTEN_RETRY_DELAY
+        finally:
+            vote_listener = None
+            try:
+                await listener.close()
+            except Exception as e:
+                print("Failed to close the connection that listened for votes:", e)
+
+async def render_and_store(id: int, width: int | None, style: render.CaptionStyle, format: str) -> tuple[bytes, str] | None:
+    """Draws the caption of a meme onto its image in a worker thread and caches the result
+
+    Returns:
+        tuple[bytes, str] | None: The encoded image and its mime type or None if the meme does not exist
+    """
+
+    meme = await fetch_meme(id)
+    if meme is None:
+        return None
+
+    data = await asyncio.to_thread(render.render_meme, meme.stored_image.data, meme.caption, style, width, format)
+    content_type = Image.MIME[format]
+    await db.store_rendered_image(id, width or 0, style.value, format, data, content_type)
+    return data, content_type
+
+async def run_ocr(image: bytes) -> str:
+    """Extracts text from an image once a slot in the OCR admission queue is free
+
+    Raises:
+        admission.QueueFullError: If the OCR queue is full
+    """
+
+    async with ocr_queue.admit():
+        return await asyncio.get_running_loop().run_in_executor(ocr_executor, get_text_from_image, image)
+
+async def fetch_meme(id: int) -> storage.Meme | None:
+    """Retrieves a meme by its id. Concurrent reads of the same meme share a single query
+    """
+
+    return await meme_reads.do(id, db.get_meme_by_id, id)
+
+async def load_url_image(url: str) -> bytes | None:
+    """Returns the image from a url. Images from urls that were already fetched are served from the database instead of being downloaded again
+    """
+
+    content = await db.get_image_by_url(url)
+    if content is None:
+        content = await asyncio.to_thread(get_url_content, url)
+    return content
+
+async def create_meme_data(meme: storage.Meme, accept: str | None, score: float | None = None) -> tuple[MemeResponseData, bytes]:
+    """Builds the response data of a meme. If the Accept header does not allow the type of the served image and
+    the uploaded image was kept, the uploaded image is returned instead
+
+    Args:
+        meme (storage.Meme): The meme
+        accept (str | None): The value of the Accept header
+        score (float | None): The score of the meme in the requested ranking
+
+    Returns:
+        tuple[MemeResponseData, bytes]: The response data and the raw image
+    """
+
+    image = meme.stored_image.data
+    image_type = meme.image_type
+    if meme.original_hash is not None and not transcode.accepts_image_type(accept, image_type):
+        original = await db.get_image(meme.original_hash) # type: ignore
+        if original is not None:
+            image, image_type = original
+
+    data: MemeResponseData = {
+        "id": meme.id, # type: ignore
+        "url": meme.url, # type: ignore
+        "caption": meme.caption, # type: ignore
+        "upvotes": meme.upvotes, # type: ignore
+        "original_id": meme.original_id, # type: ignore
+        "image_type": image_type,
+        "bytes_saved": meme.bytes_saved or 0, # type: ignore
+        "score": score
+    }
+    return data, image # type: ignore
+
+async def create_ranked_response(ranks: list[tuple[int, float]], accept: str | None) -> Response:
+    """Builds the response of a ranking
+
+    Args:
+        ranks (list[tuple[int, float]]): (id, score) pairs ordered by rank
+        accept (str | None): The value of the Accept header
+
+    Returns:
+        Response: A success response containing the memes that still exist, with their score
+    """
+
+    scores = dict(ranks)
+    memes = await db.get_memes_by_ids([id for id, _ in ranks])
+    return serialize.memes_response(
+        [await create_meme_data(meme, accept, scores[meme.id]) for meme in memes],
+        headers={"Vary": "Accept"}
+    )
+
+async def get_similarity_index() -> similarity.HashIndex:
+    """Returns the in-memory perceptual hash index. The index is loaded from the database on first use and the memes
+    created since the last call, also by other workers, are added before it is returned
+    """
+
+    global similarity_index_loaded, similarity_index_last_id
+
+    async with similarity_index_lock:
+        if not similarity_index_loaded:
+            similarity_index.clear()
+            similarity_index_last_id = 0
+
+        for id, phash in await db.get_all_phashes(similarity_index_last_id):
+            similarity_index.add(id, phash)
+            similarity_index_last_id = id
+        similarity_index_loaded = True
+
+    return similarity_index
+
+async def find_similar_memes(phash: int, distance: int, exclude: int | None = None) -> list[tuple[int, int]]:
+    """Finds the memes whose image is a near-duplicate of the image with the given hash
+
+    The candidates from the in-memory index are checked against the database so entries of memes that were
+    deleted or replaced since the index was loaded are corrected instead of being returned.
+
+    Args:
+        phash (int): The perceptual hash of the image
+        distance (int): The maximum hamming distance
+        exclude (int | None): A meme id that should not be part of the result
+
+    Returns:
+        list[tuple[int, int]]: (id, distance) pairs sorted by distance
+    """
+
+    index = await get_similarity_index()
+    candidates = [id for id, _ in index.query(phash, distance) if id != exclude]
+    if not candidates:
+        return []
+
+    stored = await db.get_phashes_by_ids(candidates)
+    matches = []
+    for id in candidates:
+        if id not in stored:
+            index.remove(id)
+            continue
+
+        index.add(id, stored[id])
+        d = similarity.hamming_distance(stored[id], phash)
+        if d <= distance:
+            matches.append((id, d))
+
+    matches.sort(key=lambda match: (match[1], match[0]))
+    return matches
         
     
     
@@ -102,14 +487,72 @@ def get_text_from_image(image: bytes) -> str:
 
 
 @app.post("/api/meme/")
-async def create_meme(meme: MemeCreationData) -> dict:
+async def create_meme(meme: MemeCreationData, idempotency_key: str | None = Header(None)):
     """Creates a new meme and stores it in the database.
 
     Args:
         meme (MemeCreationData): Data must be passed in JSON format in the request body.
+        idempotency_key (str | None): The optional Idempotency-Key header. Requests with the same key are only executed once and later requests receive the stored response
 
     Returns:
-        dict: A success response or an error response.
+        dict: A success response containing the id of the new meme or an error response.
+    """
+
+    if idempotency_key is None:
+        return await create_meme_once(meme)
+
+    if idempotency_key == "" or len(idempotency_key) > 255:
+        return JSONResponse(createErrorResponse("The Idempotency-Key must be between 1 and 255 characters long"), status_code=400)
+
+    fingerprint = hashlib.sha256(meme.model_dump_json().encode("utf-8")).hexdigest()
+    waited = 0.0
+    while True:
+        claimed, record = await db.claim_idempotency_key(idempotency_key, fingerprint, IDEMPOTENCY_TTL, IDEMPOTENCY_LEASE)
+        if claimed:
+            break
+        if record is None:
+            continue
+
+        if record.fingerprint != fingerprint:
+            return JSONResponse(createErrorResponse("The Idempotency-Key was already used for a different request"), status_code=422)
+
+        if record.status_code is not None:
+            return JSONResponse(record.response, status_code=record.status_code, headers={"Idempotent-Replayed": "true"})
+
+        # The first request with this key is still in progress
+        if waited >= IDEMPOTENCY_WAIT_TIMEOUT:
+            return JSONResponse(createErrorResponse("A request with this Idempotency-Key is still in progress"), status_code=409)
+        await asyncio.sleep(0.1)
+        waited += 0.1
+
+    try:
+        response = await create_meme_once(meme)
+    except BaseException:
+        await db.release_idempotency_key(idempotency_key)
+        raise
+
+    if isinstance(response, JSONResponse):
+        status_code = response.status_code
+        body = json.loads(response.body)
+    else:
+        status_code = 200
+        body = response
+
+    # A busy server is temporary, so a retry should do the work instead of receiving the stored rejection
+    if status_code == 503:
+        await db.release_idempotency_key(idempotency_key)
+    else:
+        await db.complete_idempotency_key(idempotency_key, status_code, body)
+    return response
+
+async def create_meme_once(meme: MemeCreationData) -> dict | JSONResponse:
+    """Does the work of creating a meme: fetches the image, extracts the caption if none is provided and stores the meme
+
+    Args:
+        meme (MemeCreationData): The request body
+
+    Returns:
+        dict | JSONResponse: A success response containing the id of the new meme, an error response or a '503 Service Unavailable' response
     """
     
     # Ensure that either the url or the image is provided
@@ -122,111 +565,296 @@ async def create_meme(meme: MemeCreationData) -> dict:
 
     if not url_set and not image_set:
         return createErrorResponse("Either the url or image must be provided")
+
+    # Requests that will need OCR are turned away before any work is done if the OCR queue is full.
+    # Requests with a caption never enter the OCR queue, so they are not slowed down by OCR load
+    policy = meme.on_duplicate or DUPLICATE_POLICY
+    if meme.caption == "" and policy != DuplicatePolicy.reuse_caption:
+        try:
+            ocr_queue.check()
+        except admission.QueueFullError as e:
+            return createBusyResponse(e)
     
     # Prefer URL over image
     if url_set and image_set:
         image_set = False
     
     if url_set:
-        content = get_url_content(meme.url) # type: ignore
+        with profiling.stage("download"):
+            content = await url_downloads.do(meme.url, load_url_image, meme.url)
         if content is None:
             return createErrorResponse("Failed to fetch URL content for " + meme.url) # type: ignore
         
-        meme.image = base64.b64encode(content).decode("utf-8")
         image_bytes = content
     else:
         try:
-            image_bytes = base64.b64decode(meme.image) # type: ignore
+            # Uploads can be several megabytes, decode them without blocking the event loop
+            with profiling.stage("decode"):
+                image_bytes = await asyncio.to_thread(base64.b64decode, meme.image) # type: ignore
         except Exception as e:
             return createErrorResponse("Invalid base64 image")
 
+    # Look for near-duplicates before running OCR so their caption can be reused
+    try:
+        with profiling.stage("phash"):
+            phash = await asyncio.to_thread(similarity.dhash, image_bytes)
+    except Exception as e:
+        phash = None
+
+    original_id = None
+    if phash is not None and policy != DuplicatePolicy.allow:
+        with profiling.stage("duplicates"):
+            matches = await find_similar_memes(phash, DUPLICATE_DISTANCE)
+        if matches:
+            original_id = matches[0][0]
+
+            if policy == DuplicatePolicy.reject:
+                return createErrorResponse(f"Meme is a duplicate of meme {original_id}")
+
+            if policy == DuplicatePolicy.reuse_caption and meme.caption == "":
+                original = await fetch_meme(original_id)
+                if original is not None:
+                    meme.caption = original.caption
+
     # Use easyocr to extract text from the image
     if meme.caption == "":
-        text = get_text_from_image(image_bytes)
+        image_hash = hashlib.sha256(image_bytes).hexdigest()
+        try:
+            with profiling.stage("ocr"):
+                text = await ocr_runs.do(image_hash, run_ocr, image_bytes)
+        except admission.QueueFullError as e:
+            return createBusyResponse(e)
         if text == "":
             return createErrorResponse("Failed to extract text from image. Make sure the provided image is not too large. Please choose another image or provide a caption.")
         
         meme.caption = text
         
-    await pg.create_meme(meme.url, meme.caption, meme.image) # type: ignore
-    return createSuccessResponse()
+    # Transcode the image to a compact format without blocking the event loop
+    content_type = transcode.detect_content_type(image_bytes)
+    stored_bytes = image_bytes
+    stored_type = content_type
+    if TRANSCODE_IMAGES:
+        with profiling.stage("transcode"):
+            stored_bytes, stored_type = await asyncio.to_thread(transcode.transcode, image_bytes, content_type, WEBP_QUALITY)
+
+    original_image = None
+    bytes_saved = 0
+    if stored_bytes is not image_bytes:
+        bytes_saved = len(image_bytes) - len(stored_bytes)
+        print(f"Transcoded {content_type} to {stored_type}: {len(image_bytes)} -> {len(stored_bytes)} bytes ({bytes_saved} saved)")
+
+        keep_original = KEEP_ORIGINAL if meme.keep_original is None else meme.keep_original
+        if keep_original:
+            original_image = image_bytes
+
+    with profiling.stage("store"):
+        id = await db.create_meme(
+            meme.url, # type: ignore
+            meme.caption, # type: ignore
+            stored_bytes,
+            stored_type,
+            phash,
+            original_id,
+            original_image,
+            content_type,
+            bytes_saved
+        )
+    # The index is loaded when it is first queried. The id is not remembered as loaded, so memes that other workers
+    # created with lower ids but committed later are still picked up by the next update
+    if phash is not None and similarity_index_loaded:
+        similarity_index.add(id, phash)
+    top_memes.invalidate()
+
+    return createSuccessResponse({"id": id})
 
 @app.get("/api/meme/{id}")
-async def get_meme_by_id(id: int) -> dict:
+async def get_meme_by_id(id: int, accept: str | None = Header(None)):
     """Retrieves a meme by its id
 
     Args:
         id (int): The unique identifier of the meme
+        accept (str | None): The Accept header. Used to choose between the transcoded and the uploaded image
 
     Returns:
-        dict: A success response containing the meme data or an error response
+        Response | dict: A success response containing the meme data or an error response
     """
 
-    meme = await pg.get_meme_by_id(id)
+    meme = await fetch_meme(id)
     if meme is None:
         return createErrorResponse("Meme not found")
     
-    return createSuccessResponse(MemeResponseData(
-        id=meme.id,
-        url=meme.url,
-        caption=meme.caption,
-        upvotes=meme.upvotes,
-        image=meme.image
-        )
-    )
+    return serialize.meme_response(*await create_meme_data(meme, accept), headers={"Vary": "Accept"})
+
+@app.get("/api/meme/{id}/rendered")
+async def get_rendered_meme(id: int, width: int | None = None, style: render.CaptionStyle = render.CaptionStyle.classic, accept: str | None = Header(None)):
+    """Returns the image of a meme with its caption drawn onto it. Every combination of size, style and format is only rendered once and then served from the database
+
+    Args:
+        id (int): The unique identifier of the meme
+        width (int | None): The width of the image in pixels. Defaults to the width of the stored image, but at most 1024
+        style (render.CaptionStyle): Where to place the caption
+        accept (str | None): The Accept header. WebP is returned if it lists 'image/webp', JPEG otherwise
+
+    Returns:
+        Response: The image, or an error response in json format
+    """
+
+    if width is not None and (width < 16 or width > render.MAX_WIDTH):
+        return createErrorResponse(f"Width must be between 16 and {render.MAX_WIDTH}")
+
+    format = "WEBP" if accept is not None and "image/webp" in accept.lower() else "JPEG"
+
+    rendered = await db.get_rendered_image(id, width or 0, style.value, format)
+    if rendered is None:
+        try:
+            rendered = await renders.do((id, width, style, format), render_and_store, id, width, style, format)
+        except Exception as e:
+            return createErrorResponse("Failed to render meme: " + str(e))
+
+    if rendered is None:
+        return createErrorResponse("Meme not found")
+
+    data, content_type = rendered
+    return Response(content=data, media_type=content_type, headers={"Cache-Control": "public, max-age=86400", "Vary": "Accept"})
+
+@app.get("/api/meme/{id}/similar")
+async def get_similar_memes(id: int, distance: int = DUPLICATE_DISTANCE) -> dict:
+    """Retrieves the memes whose image is a near-duplicate of the image of the given meme
+
+    Args:
+        id (int): The unique identifier of the meme
+        distance (int): The maximum hamming distance between the perceptual hashes. Must not exceed the configured duplicate distance
+
+    Returns:
+        dict: A success response containing the similar memes sorted by distance or an error response
+    """
+
+    if distance < 0 or distance > DUPLICATE_DISTANCE:
+        return createErrorResponse(f"Distance must be between 0 and {DUPLICATE_DISTANCE}")
+
+    meme = await fetch_meme(id)
+    if meme is None:
+        return createErrorResponse("Meme not found")
+
+    phash = db.get_phash(meme)
+    if phash is None:
+        return createErrorResponse("Meme has no image hash")
+
+    matches = await find_similar_memes(phash, distance, exclude=id)
+    return createSuccessResponse([SimilarMemeData(id=match_id, distance=d) for match_id, d in matches])
 
 @app.post("/api/meme/{id}/vote/")
 async def vote_meme(id: int, vote: VoteData) -> dict:
 
     if vote.type == VoteType.upvote:
-        res = await pg.upvote_meme(id)
+        res = await db.upvote_meme(id)
     elif vote.type == VoteType.downvote:
-        res = await pg.downvote_meme(id)
+        res = await db.downvote_meme(id)
     else:
         return createErrorResponse("Invalid vote type")
 
     if not res:
         return createErrorResponse("Meme not found")
     
+    top_memes.invalidate()
     return createSuccessResponse()
 
 @app.get("/api/meme/top/")
-async def get_top_memes():
+async def get_top_memes(accept: str | None = Header(None)):
     """Retrieves the top 10 memes by upvotes
 
     Returns:
-        dict: A success response containing the top 10 memes (or less) or an error response if there was an issue fetching the memes
+        Response | dict: A success response containing the top 10 memes (or less) or an error response if there was an issue fetching the memes
     """
 
-    memes = await pg.get_top_ten_memes()
+    memes = await db.get_top_ten_memes()
     if memes is None:
         return createErrorResponse("Error fetching memes")
     
-    return createSuccessResponse([MemeResponseData(
-        id=meme.id,
-        url=meme.url,
-        caption=meme.caption,
-        upvotes=meme.upvotes,
-        image=meme.image
-        ) for meme in memes])
+    return serialize.memes_response([await create_meme_data(meme, accept) for meme in memes], headers={"Vary": "Accept"})
+
+@app.get("/api/meme/top/stream")
+async def stream_top_memes():
+    """Streams the top 10 memes as Server-Sent Events. A 'snapshot' event with the full ranking is sent first, followed by a 'diff' event whenever a rank or upvote count changes
+
+    Returns:
+        StreamingResponse: The event stream
+    """
+
+    return StreamingResponse(
+        top_memes.stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/api/meme/trending/{window}/")
+async def get_trending_memes(window: TrendingWindow, accept: str | None = Header(None)):
+    """Retrieves the top 10 memes by net votes within the last hour, day or week. Votes are rolled up periodically, so the most recent votes may not be counted yet
+
+    Args:
+        window (TrendingWindow): 'hour', 'day' or 'week'
+
+    Returns:
+        Response: A success response containing the top 10 memes (or less) with their net votes in the window as score
+    """
+
+    ranks = await db.get_trending_ranks(datetime.now(timezone.utc) - TRENDING_WINDOWS[window])
+    return await create_ranked_response(ranks, accept)
+
+@app.get("/api/meme/hot/")
+async def get_hot_memes(accept: str | None = Header(None)):
+    """Retrieves the top 10 memes by their time-decayed score, in which every vote loses half of its weight per half-life
+
+    Returns:
+        Response: A success response containing the top 10 memes (or less) with their hot score
+    """
+
+    ranks = await db.get_hot_ranks()
+    return await create_ranked_response(ranks, accept)
 
 @app.get("/api/meme/random/")
-async def get_random_meme():
+async def get_random_meme(accept: str | None = Header(None)):
     """Returns a random meme
 
     Returns:
-        dict: A success response containing a random meme or an error response if there was an issue fetching the meme
+        Response | dict: A success response containing a random meme or an error response if there was an issue fetching the meme
     """
 
-    meme = await pg.get_random_meme()
+    meme = await db.get_random_meme()
     if meme is None:
         return createErrorResponse("Error fetching meme")
     
-    return createSuccessResponse(MemeResponseData(
-        id=meme.id,
-        url=meme.url,
-        caption=meme.caption,
-        upvotes=meme.upvotes,
-        image=meme.image
-        )
-    )
\ No newline at end of file
+    return serialize.meme_response(*await create_meme_data(meme, accept), headers={"Vary": "Accept"})
+
+@app.get("/api/meme/stats/")
+async def get_transcode_stats():
+    """Returns how many memes were transcoded and how many bytes that saved in total
+
+    Returns:
+        dict: A success response containing the transcoding statistics
+    """
+
+    transcoded, bytes_saved = await db.get_total_bytes_saved()
+    return createSuccessResponse(TranscodeStatsData(transcoded=transcoded, bytes_saved=bytes_saved))
+
+@app.get("/api/meme/stats/admission/")
+async def get_admission_stats():
+    """Returns the load and queue-wait metrics of the OCR admission queue of this worker
+
+    Returns:
+        dict: A success response containing the admission statistics
+    """
+
+    return createSuccessResponse(AdmissionStatsData(**ocr_queue.stats()))
+
+@app.get("/api/meme/stats/coalescing/")
+async def get_coalescing_stats():
+    """Returns how many reads, downloads and OCR runs of this worker were coalesced with an identical concurrent call
+
+    Returns:
+        dict: A success response containing the statistics of every deduplicated operation
+    """
+
+    return createSuccessResponse([
+        CoalescingStatsData(**flight.stats()) for flight in (meme_reads, url_downloads, ocr_runs, renders)
+    ])
\ No newline at end of file
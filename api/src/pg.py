@@ -6,10 +6,16 @@ This file contains the code that interacts with the postgres database
 import asyncio
 from contextlib import asynccontextmanager
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, AsyncEngine
-from sqlalchemy.orm import sessionmaker, DeclarativeBase
-from sqlalchemy import Column, Integer, String, select, func
+from sqlalchemy.orm import sessionmaker, DeclarativeBase, relationship
+from sqlalchemy import Column, Integer, BigInteger, SmallInteger, Float, String, LargeBinary, ForeignKey, DateTime, select, update, delete, func, text, literal, extract
+from sqlalchemy.dialects.postgresql import insert, JSONB
+from sqlalchemy.schema import CreateIndex
 import os
 import urllib.parse
+import hashlib
+import base64
+import asyncpg
+from datetime import datetime, timedelta, timezone
 
 if os.getenv("DOCKER_NET") is not None:
     # use docker network if running in docker
@@ -23,21 +29,167 @@ password = "9&SVyC59J@o#"
 database = "cmg"
 
 DATABASE_URL = f"postgresql+asyncpg://{urllib.parse.quote(user)}:{urllib.parse.quote(password)}@{host}:{port}/{database}"
-
-engine : AsyncEngine = create_async_engine(DATABASE_URL, echo=True)
+# The same database as a plain asyncpg dsn, used for the LISTEN connection
+DATABASE_DSN = f"postgresql://{urllib.parse.quote(user)}:{urllib.parse.quote(password)}@{host}:{port}/{database}"
+
+# The channel on which every vote is announced with the id of the meme as payload
+VOTES_CHANNEL = "meme_votes"
+
+# The time after which a vote has lost half of its weight in the hot score
+HOT_HALF_LIFE = timedelta(hours=float(os.getenv("CMG_HOT_HALF_LIFE_HOURS", "12")))
+# How long raw vote events are kept after they were rolled up into hourly buckets
+VOTE_EVENT_RETENTION = timedelta(hours=float(os.getenv("CMG_VOTE_EVENT_RETENTION_HOURS", "48")))
+# How long hourly vote buckets are kept. Must cover the longest trending window
+VOTE_BUCKET_RETENTION = timedelta(days=float(os.getenv("CMG_VOTE_BUCKET_RETENTION_DAYS", "30")))
+# Votes younger than this are not rolled up yet so that transactions still in flight are not missed
+VOTE_ROLLUP_LAG = timedelta(seconds=10)
+
+# The schema that contains the tables. The tests use one schema per worker so they can run in parallel
+DATABASE_SCHEMA = os.getenv("CMG_DATABASE_SCHEMA")
+
+engine : AsyncEngine = create_async_engine(
+    DATABASE_URL,
+    echo=True,
+    connect_args={"server_settings": {"search_path": DATABASE_SCHEMA}} if DATABASE_SCHEMA is not None else {}
+)
 SessionFactory = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False) # type: ignore -- supresses the 'no overload' error
 
 
 class Base(DeclarativeBase):
     pass
 
+class StoredImage(Base):
+    """An image stored once per distinct content, addressed by the SHA-256 hash of its bytes
+    """
+
+    __tablename__ = "images"
+    hash = Column(String(64), primary_key=True)
+    data = Column(LargeBinary)
+    # The mime type of the image
+    content_type = Column(String)
+    # The number of memes that use this image. The image is deleted when it drops to 0
+    refcount = Column(Integer)
+
+class ImageUrl(Base):
+    """Maps a url to the image that was downloaded from it so the url does not have to be fetched again
+    """
+
+    __tablename__ = "image_urls"
+    url = Column(String, primary_key=True)
+    hash = Column(String(64), ForeignKey("images.hash", ondelete="CASCADE"), index=True)
+
 class Meme(Base):
     __tablename__ = "memes"
     id = Column(Integer, primary_key=True, index=True)
     url = Column(String)
-    image = Column(String)
+    # The image that is served by default
+    image_hash = Column(String(64), ForeignKey("images.hash"), index=True)
+    # The image as it was uploaded, if it was transcoded and the original was kept
+    original_hash = Column(String(64), ForeignKey("images.hash"), nullable=True)
+    # The number of bytes saved by transcoding the uploaded image
+    bytes_saved = Column(Integer, default=0)
     caption = Column(String)
-    upvotes = Column(Integer)
+    upvotes = Column(Integer, index=True)
+    # The perceptual hash of the image, stored as a signed 64 bit integer
+    phash = Column(BigInteger, nullable=True, index=True)
+    # The id of the meme this meme is a near-duplicate of, if it was linked on creation
+    original_id = Column(Integer, nullable=True)
+
+    stored_image = relationship(StoredImage, lazy="joined", foreign_keys=[image_hash])
+
+    @property
+    def image(self) -> str:
+        """The base64 encoded image
+        """
+
+        return base64.b64encode(self.stored_image.data).decode("utf-8")
+
+    @property
+    def image_type(self) -> str:
+        """The mime type of the image
+        """
+
+        return self.stored_image.content_type
+
+class RenderedImage(Base):
+    """A meme with its caption drawn onto the image, cached per size, style and format
+    """
+
+    __tablename__ = "rendered_images"
+    meme_id = Column(Integer, ForeignKey("memes.id", ondelete="CASCADE"), primary_key=True)
+    # The requested width, 0 for the default width
+    width = Column(Integer, primary_key=True)
+    style = Column(String, primary_key=True)
+    format = Column(String, primary_key=True)
+    data = Column(LargeBinary)
+    content_type = Column(String)
+
+class IdempotencyKey(Base):
+    """The outcome of a request that was sent with an Idempotency-Key header
+    """
+
+    __tablename__ = "idempotency_keys"
+    key = Column(String, primary_key=True)
+    # The SHA-256 hash of the request body, to detect keys that are reused for different requests
+    fingerprint = Column(String(64))
+    # The HTTP status code and body of the response. Both are null while the request is in progress
+    status_code = Column(Integer, nullable=True)
+    response = Column(JSONB, nullable=True)
+    # The request is considered abandoned if it is still in progress after this time
+    locked_until = Column(DateTime(timezone=True))
+    expires_at = Column(DateTime(timezone=True), index=True)
+
+class VoteEvent(Base):
+    """An append-only record of a single vote. Raw events are rolled up into VoteBucket and HotScore and deleted after the retention period
+    """
+
+    __tablename__ = "vote_events"
+    id = Column(BigInteger, primary_key=True)
+    meme_id = Column(Integer)
+    # +1 for an upvote, -1 for a downvote
+    delta = Column(SmallInteger)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
+
+class VoteBucket(Base):
+    """The sum of the votes of a meme within one hour
+    """
+
+    __tablename__ = "vote_buckets"
+    meme_id = Column(Integer, primary_key=True)
+    hour = Column(DateTime(timezone=True), primary_key=True, index=True)
+    votes = Column(Integer)
+
+class HotScore(Base):
+    """The time-decayed score of a meme. Every vote adds 2^((time of vote - epoch) / half-life), so all scores
+    decay at the same rate and their order never has to be recomputed. The epoch is stored in VoteRollupState
+    """
+
+    __tablename__ = "hot_scores"
+    meme_id = Column(Integer, primary_key=True, autoincrement=False)
+    score = Column(Float, index=True)
+
+class VoteRollupState(Base):
+    """The single row of bookkeeping for the vote compactor
+    """
+
+    __tablename__ = "vote_rollup_state"
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    # All vote events created before this time have been rolled up
+    watermark = Column(DateTime(timezone=True))
+    # The reference time of the hot scores
+    hot_epoch = Column(DateTime(timezone=True))
+
+def _to_signed64(value: int) -> int:
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+def _to_unsigned64(value: int) -> int:
+    return value + (1 << 64) if value < 0 else value
+
+def get_phash(meme: Meme) -> int | None:
+    """Returns the unsigned perceptual hash of a meme or None if it has no hash
+    """
+
+    return None if meme.phash is None else _to_unsigned64(meme.phash) # type: ignore
 
 async def init_connection():
     """Reconnects to the database. This function is needed to run the tests. The connection is already established when this module is imported
@@ -52,40 +204,390 @@ async def close_connection():
     await engine.dispose()
 
 async def create_table():
-    """Creates the 'memes' table if it does not already exist
+    """Creates the 'memes', 'images' and 'image_urls' tables if they do not already exist and migrates a 'memes' table
+    of an older version to the current layout
     """
 
 
     async with engine.begin() as conn:
+        if DATABASE_SCHEMA is not None:
+            await conn.execute(text(f'CREATE SCHEMA IF NOT EXISTS "{DATABASE_SCHEMA}"'))
         await conn.run_sync(Base.metadata.create_all)
 
+    await migrate_db()
+
+# The columns that were added to the 'memes' table after its first version. create_all does not alter existing tables
+MEME_COLUMN_MIGRATIONS = [
+    "ALTER TABLE memes ADD COLUMN IF NOT EXISTS image_hash VARCHAR(64) REFERENCES images (hash)",
+    "ALTER TABLE memes ADD COLUMN IF NOT EXISTS original_hash VARCHAR(64) REFERENCES images (hash)",
+    "ALTER TABLE memes ADD COLUMN IF NOT EXISTS bytes_saved INTEGER",
+    "ALTER TABLE memes ADD COLUMN IF NOT EXISTS phash BIGINT",
+    "ALTER TABLE memes ADD COLUMN IF NOT EXISTS original_id INTEGER"
+]
+
+# The number of memes whose images are moved into the 'images' table at once
+MIGRATION_BATCH_SIZE = 100
+
+def _guess_content_type(image: bytes) -> str:
+    """Detects the mime type of an image stored before the mime type was stored, from the signature of its format
+    """
+
+    if image.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if image.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if image.startswith(b"GIF8"):
+        return "image/gif"
+    if image.startswith(b"RIFF") and image[8:12] == b"WEBP":
+        return "image/webp"
+    if image.startswith(b"BM"):
+        return "image/bmp"
+    return "application/octet-stream"
+
+async def migrate_db():
+    """Migrates a 'memes' table that stores the base64 encoded image of every meme in its 'image' column. The images are moved
+    into the 'images' table with one reference per meme, the urls are mapped to their images and the 'image' column is dropped.
+    Everything runs in one transaction, so a failed migration leaves the old table untouched. Does nothing if the table is up to date
+    """
+
+    async with get_session() as session:
+        async with session.begin():
+            # Other api workers may start at the same time
+            await session.execute(text("SELECT pg_advisory_xact_lock(hashtext('cmg_migrate_db'))"))
+
+            for statement in MEME_COLUMN_MIGRATIONS:
+                await session.execute(text(statement))
+            for index in Meme.__table__.indexes:
+                await session.execute(CreateIndex(index, if_not_exists=True))
+
+            stmt = text("SELECT 1 FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = 'memes' AND column_name = 'image'")
+            if (await session.execute(stmt)).first() is None:
+                return
+
+            print("Moving the images of the memes into the 'images' table")
+            last_id = 0
+            migrated = 0
+            while True:
+                stmt = text("SELECT id, url, image FROM memes WHERE id > :last_id AND image IS NOT NULL ORDER BY id LIMIT :limit")
+                rows = (await session.execute(stmt, {"last_id": last_id, "limit": MIGRATION_BATCH_SIZE})).all()
+                if not rows:
+                    break
+
+                for id, url, image in rows:
+                    try:
+                        data = base64.b64decode(image)
+                    except ValueError as e:
+                        raise ValueError(f"The image of meme {id} is not valid base64") from e
+
+                    hash = await _add_image_reference(session, data, _guess_content_type(data))
+                    if url:
+                        stmt = insert(ImageUrl).values(url=url, hash=hash).on_conflict_do_nothing(index_elements=[ImageUrl.url])
+                        await session.execute(stmt)
+                    await session.execute(update(Meme).where(Meme.id == id).values(image_hash=hash, bytes_saved=0))
+
+                last_id = rows[-1].id
+                migrated += len(rows)
+
+            await session.execute(text("ALTER TABLE memes DROP COLUMN image"))
+            print(f"Migrated the images of {migrated} memes")
+
 async def destroy_db():
-    """Drops the 'memes' table if it exists
+    """Drops the 'memes', 'images' and 'image_urls' tables if they exist
     """
 
     async with engine.begin() as conn:
         # drop table if it exists
         await conn.run_sync(Base.metadata.drop_all)
 
+async def clear_db():
+    """Deletes all rows and restarts the ids. This is much faster than destroy_db and create_table and is needed to run the tests.
+    Unlike TRUNCATE, deleting the rows does not lock out concurrent readers such as the background tasks of a running api
+    """
+
+    async with engine.begin() as conn:
+        for table in reversed(Base.metadata.sorted_tables):
+            await conn.execute(table.delete())
+        await conn.execute(text("SELECT setval(oid, 1, false) FROM pg_class WHERE relkind = 'S' AND relnamespace = current_schema()::regnamespace"))
+
 @asynccontextmanager
 async def get_session():
     async with SessionFactory() as session: # type: ignore -- supresses the 'no overload' error
         yield session
 
-async def create_meme(url: str, caption: str, image: str):
-    """Stores a meme in the database
+async def _add_image_reference(session: AsyncSession, image: bytes, content_type: str) -> str:
+    """Stores an image if its content is not stored yet and increments its reference count
+
+    Args:
+        session (AsyncSession): The session of the current transaction
+        image (bytes): The raw image data
+        content_type (str): The mime type of the image
+
+    Returns:
+        str: The SHA-256 hash of the image
+    """
+
+    hash = hashlib.sha256(image).hexdigest()
+
+    # Try the update first so the image data is only sent to the database if it is not stored yet
+    stmt = update(StoredImage).where(StoredImage.hash == hash).values(refcount=StoredImage.refcount + 1).returning(StoredImage.hash)
+    result = await session.execute(stmt)
+    if result.first() is None:
+        stmt = insert(StoredImage).values(hash=hash, data=image, content_type=content_type, refcount=1)
+        stmt = stmt.on_conflict_do_update(index_elements=[StoredImage.hash], set_={"refcount": StoredImage.refcount + 1})
+        await session.execute(stmt)
+
+    return hash
+
+async def _release_image_reference(session: AsyncSession, hash: str):
+    """Decrements the reference count of an image and deletes the image when it is no longer used
+
+    Args:
+        session (AsyncSession): The session of the current transaction
+        hash (str): The SHA-256 hash of the image
+    """
+
+    stmt = update(StoredImage).where(StoredImage.hash == hash).values(refcount=StoredImage.refcount - 1).returning(StoredImage.refcount)
+    refcount = (await session.execute(stmt)).scalar()
+    if refcount is not None and refcount <= 0:
+        await session.execute(delete(ImageUrl).where(ImageUrl.hash == hash))
+        await session.execute(delete(StoredImage).where(StoredImage.hash == hash))
+
+async def create_meme(
+        url: str,
+        caption: str,
+        image: bytes,
+        content_type: str,
+        phash: int | None = None,
+        original_id: int | None = None,
+        original_image: bytes | None = None,
+        original_content_type: str | None = None,
+        bytes_saved: int = 0
+    ) -> int:
+    """Stores a meme in the database. The image is only stored once for all memes with the same image content
 
     Args:
         url (str): the url to an image. The database does not verify that the url is valid. 
         caption (str): A caption for the meme
-        image (str): The base64 encoded image
+        image (bytes): The raw image data that is served by default
+        content_type (str): The mime type of the image
+        phash (int | None): The unsigned 64 bit perceptual hash of the image
+        original_id (int | None): The id of the meme this meme is a near-duplicate of
+        original_image (bytes | None): The uploaded image, if it was transcoded and should be kept
+        original_content_type (str | None): The mime type of the uploaded image
+        bytes_saved (int): The number of bytes saved by transcoding the uploaded image
+
+    Returns:
+        int: The id of the new meme
     """
     async with get_session() as session:
         async with session.begin():
-            meme = Meme(url=url, caption=caption, upvotes=0, image=image)
+            hash = await _add_image_reference(session, image, content_type)
+            original_hash = None
+            if original_image is not None:
+                original_hash = await _add_image_reference(session, original_image, original_content_type or content_type)
+
+            if url:
+                # Remember which image the url points to so it does not have to be downloaded again
+                url_hash = original_hash or hash
+                stmt = insert(ImageUrl).values(url=url, hash=url_hash)
+                stmt = stmt.on_conflict_do_update(index_elements=[ImageUrl.url], set_={"hash": url_hash})
+                await session.execute(stmt)
+
+            meme = Meme(
+                url=url,
+                caption=caption,
+                upvotes=0,
+                image_hash=hash,
+                original_hash=original_hash,
+                bytes_saved=bytes_saved,
+                phash=None if phash is None else _to_signed64(phash),
+                original_id=original_id
+            )
             session.add(meme)
+            await session.flush()
+            id = meme.id
+            await session.commit()
+            return id
+
+async def delete_meme(id: int) -> bool:
+    """Deletes a meme and releases its reference to the stored image. The image is deleted when no other meme uses it
+
+    Args:
+        id (int): The unique identifier of the meme
+
+    Returns:
+        bool: True if the meme was found and deleted, False otherwise
+    """
+
+    async with get_session() as session:
+        async with session.begin():
+            stmt = delete(Meme).where(Meme.id == id).returning(Meme.image_hash, Meme.original_hash)
+            row = (await session.execute(stmt)).first()
+            if row is None:
+                return False
+
+            await session.execute(delete(HotScore).where(HotScore.meme_id == id))
+            await session.execute(delete(RenderedImage).where(RenderedImage.meme_id == id))
+
+            await _release_image_reference(session, row.image_hash)
+            if row.original_hash is not None:
+                await _release_image_reference(session, row.original_hash)
+
+            await session.commit()
+            return True
+
+async def get_image(hash: str) -> tuple[bytes, str] | None:
+    """Returns a stored image by its hash
+
+    Args:
+        hash (str): The SHA-256 hash of the image
+
+    Returns:
+        tuple[bytes, str] | None: The raw image data and its mime type or None if the image does not exist
+    """
+
+    async with get_session() as session:
+        async with session.begin():
+            stmt = select(StoredImage.data, StoredImage.content_type).where(StoredImage.hash == hash)
+            row = (await session.execute(stmt)).first()
+            return None if row is None else (row.data, row.content_type)
+
+async def get_total_bytes_saved() -> tuple[int, int]:
+    """Returns the number of transcoded memes and the total number of bytes saved by transcoding
+    """
+
+    async with get_session() as session:
+        async with session.begin():
+            stmt = select(func.count(Meme.id), func.coalesce(func.sum(Meme.bytes_saved), 0)).where(Meme.bytes_saved > 0)
+            count, total = (await session.execute(stmt)).one()
+            return count, total
+
+async def get_rendered_image(meme_id: int, width: int, style: str, format: str) -> tuple[bytes, str] | None:
+    """Returns a cached rendering of a meme
+
+    Args:
+        meme_id (int): The unique identifier of the meme
+        width (int): The requested width, 0 for the default width
+        style (str): The caption style
+        format (str): The image format
+
+    Returns:
+        tuple[bytes, str] | None: The encoded image and its mime type or None if this combination was not rendered yet
+    """
+
+    async with get_session() as session:
+        async with session.begin():
+            stmt = select(RenderedImage.data, RenderedImage.content_type).where(
+                RenderedImage.meme_id == meme_id,
+                RenderedImage.width == width,
+                RenderedImage.style == style,
+                RenderedImage.format == format
+            )
+            row = (await session.execute(stmt)).first()
+            return None if row is None else (row.data, row.content_type)
+
+async def store_rendered_image(meme_id: int, width: int, style: str, format: str, data: bytes, content_type: str):
+    """Caches a rendering of a meme. If the combination was already cached, the existing rendering is kept
+    """
+
+    async with get_session() as session:
+        async with session.begin():
+            stmt = insert(RenderedImage).values(
+                meme_id=meme_id,
+                width=width,
+                style=style,
+                format=format,
+                data=data,
+                content_type=content_type
+            )
+            await session.execute(stmt.on_conflict_do_nothing())
             await session.commit()
 
+# Idempotency
+
+async def claim_idempotency_key(key: str, fingerprint: str, ttl: timedelta, lease: timedelta) -> tuple[bool, IdempotencyKey | None]:
+    """Tries to become the request that does the work for an idempotency key. Expired keys and keys whose request
+    was abandoned, e.g. because the worker crashed, can be claimed again
+
+    Args:
+        key (str): The idempotency key
+        fingerprint (str): The SHA-256 hash of the request body
+        ttl (timedelta): How long the outcome is kept
+        lease (timedelta): How long the request may stay in progress before it is considered abandoned
+
+    Returns:
+        tuple[bool, IdempotencyKey | None]: (True, None) if the key was claimed. Otherwise (False, record) with the
+        record of the request that claimed it, or (False, None) if that record disappeared in the meantime
+    """
+
+    async with get_session() as session:
+        async with session.begin():
+            now = func.now()
+            await session.execute(delete(IdempotencyKey).where(
+                IdempotencyKey.key == key,
+                (IdempotencyKey.expires_at < now) | (IdempotencyKey.status_code.is_(None) & (IdempotencyKey.locked_until < now))
+            ))
+
+            stmt = insert(IdempotencyKey).values(
+                key=key,
+                fingerprint=fingerprint,
+                locked_until=now + lease,
+                expires_at=now + ttl
+            ).on_conflict_do_nothing().returning(IdempotencyKey.key)
+            if (await session.execute(stmt)).first() is not None:
+                await session.commit()
+                return True, None
+
+            record = (await session.execute(select(IdempotencyKey).where(IdempotencyKey.key == key))).scalar()
+            return False, record
+
+async def complete_idempotency_key(key: str, status_code: int, response: dict):
+    """Stores the outcome of the request that claimed an idempotency key
+    """
+
+    async with get_session() as session:
+        async with session.begin():
+            stmt = update(IdempotencyKey).where(IdempotencyKey.key == key).values(status_code=status_code, response=response)
+            await session.execute(stmt)
+            await session.commit()
+
+async def release_idempotency_key(key: str):
+    """Releases an idempotency key whose request failed without an outcome worth storing, so a retry does the work again
+    """
+
+    async with get_session() as session:
+        async with session.begin():
+            await session.execute(delete(IdempotencyKey).where(IdempotencyKey.key == key, IdempotencyKey.status_code.is_(None)))
+            await session.commit()
+
+async def delete_expired_idempotency_keys() -> int:
+    """Deletes the idempotency keys whose outcome expired
+
+    Returns:
+        int: The number of deleted keys
+    """
+
+    async with get_session() as session:
+        async with session.begin():
+            result = await session.execute(delete(IdempotencyKey).where(IdempotencyKey.expires_at < func.now()))
+            await session.commit()
+            return result.rowcount
+
+async def get_image_by_url(url: str) -> bytes | None:
+    """Returns the stored image that was previously downloaded from a url
+
+    Args:
+        url (str): The url of the image
+
+    Returns:
+        bytes | None: The raw image data or None if no image from this url is stored
+    """
+
+    async with get_session() as session:
+        async with session.begin():
+            stmt = select(StoredImage.data).join(ImageUrl, ImageUrl.hash == StoredImage.hash).where(ImageUrl.url == url)
+            result = await session.execute(stmt)
+            return result.scalar()
 
 async def get_meme_by_id(id: int):
     """Retrieves a meme by its unique id
@@ -97,6 +599,32 @@ async def get_meme_by_id(id: int):
             result = await session.execute(stmt)
             return result.scalars().first()
 
+async def get_phashes_by_ids(ids: list[int]) -> dict[int, int]:
+    """Returns the unsigned perceptual hashes of the memes with the given ids. Ids that do not exist or have no hash are ignored
+    """
+
+    if not ids:
+        return {}
+
+    async with get_session() as session:
+        async with session.begin():
+            stmt = select(Meme.id, Meme.phash).where(Meme.id.in_(ids), Meme.phash.is_not(None))
+            result = await session.execute(stmt)
+            return {id: _to_unsigned64(phash) for id, phash in result.all()}
+
+async def get_all_phashes(after_id: int = 0) -> list[tuple[int, int]]:
+    """Returns the (id, unsigned perceptual hash) pairs of all memes that have a hash, ordered by id. Used to build the in-memory similarity index
+
+    Args:
+        after_id (int): Only memes with a greater id are returned, to update an index with the memes created since it was last updated
+    """
+
+    async with get_session() as session:
+        async with session.begin():
+            stmt = select(Meme.id, Meme.phash).where(Meme.id > after_id, Meme.phash.is_not(None)).order_by(Meme.id)
+            result = await session.execute(stmt)
+            return [(id, _to_unsigned64(phash)) for id, phash in result.all()]
+
 async def get_all_memes():
     """Returns all memes in the database. Used for testing purposes
     """
@@ -114,9 +642,33 @@ async def get_top_ten_memes():
 
     async with get_session() as session:
         async with session.begin():
-            stmt = select(Meme).order_by(Meme.upvotes.desc()).limit(10)
+            stmt = select(Meme).order_by(Meme.upvotes.desc(), Meme.id).limit(10)
             result = await session.execute(stmt)
             return result.scalars().all()
+
+async def get_memes_by_ids(ids: list[int]) -> list[Meme]:
+    """Retrieves the memes with the given ids in the given order. Ids that do not exist are skipped
+    """
+
+    if not ids:
+        return []
+
+    async with get_session() as session:
+        async with session.begin():
+            stmt = select(Meme).where(Meme.id.in_(ids))
+            result = await session.execute(stmt)
+            memes = {meme.id: meme for meme in result.scalars().all()}
+            return [memes[id] for id in ids if id in memes]
+
+async def get_top_ten_ranks() -> list[tuple[int, int]]:
+    """Returns the (id, upvotes) pairs of the top 10 memes by upvotes without loading the images
+    """
+
+    async with get_session() as session:
+        async with session.begin():
+            stmt = select(Meme.id, Meme.upvotes).order_by(Meme.upvotes.desc(), Meme.id).limit(10)
+            result = await session.execute(stmt)
+            return [(id, upvotes) for id, upvotes in result.all()]
         
 async def get_random_meme():
     """Returns a random meme
@@ -130,6 +682,31 @@ async def get_random_meme():
 
 # Upvote
 
+async def _record_vote(session: AsyncSession, id: int, delta: int):
+    """Appends a vote to the vote event log and announces it on the votes channel. The notification is delivered to all listeners when the transaction commits
+    """
+
+    session.add(VoteEvent(meme_id=id, delta=delta))
+    await session.execute(text("SELECT pg_notify(:channel, :payload)"), {"channel": VOTES_CHANNEL, "payload": str(id)})
+
+async def listen(channel: str, callback, on_lost=None) -> asyncpg.Connection:
+    """Opens a dedicated connection that listens for notifications on a channel
+
+    Args:
+        channel (str): The channel to listen on
+        callback: Called with (connection, pid, channel, payload) for every notification
+        on_lost: Called without arguments when the connection is closed, e.g. because the database restarted
+
+    Returns:
+        asyncpg.Connection: The connection. Closing it stops listening
+    """
+
+    connection = await asyncpg.connect(DATABASE_DSN)
+    if on_lost is not None:
+        connection.add_termination_listener(lambda connection: on_lost())
+    await connection.add_listener(channel, callback)
+    return connection
+
 async def upvote_meme(id: int) -> bool:
     """Increments the upvotes of a meme by 1
 
@@ -148,6 +725,7 @@ async def upvote_meme(id: int) -> bool:
             if meme is None:
                 return False
             meme.upvotes += 1
+            await _record_vote(session, id, 1)
             await session.commit()
             return True
         
@@ -172,8 +750,113 @@ async def downvote_meme(id: int) -> bool:
             
             if meme.upvotes > 0:
                 meme.upvotes -= 1
+                await _record_vote(session, id, -1)
 
             await session.commit()
             return True
 
+# Trending
+
+async def compact_votes() -> int:
+    """Rolls the vote events that arrived since the last run up into the hourly buckets and the hot scores, then
+    deletes events and buckets that are older than their retention period. Concurrent runs, e.g. from several
+    workers, are serialized by locking the bookkeeping row, so every event is counted exactly once
+
+    Returns:
+        int: The number of memes whose hot score changed
+    """
+
+    async with get_session() as session:
+        async with session.begin():
+            now = (await session.execute(select(func.now()))).scalar()
+
+            stmt = insert(VoteRollupState).values(id=1, watermark=datetime.fromtimestamp(0, timezone.utc), hot_epoch=now)
+            await session.execute(stmt.on_conflict_do_nothing(index_elements=[VoteRollupState.id]))
+            state = (await session.execute(select(VoteRollupState).where(VoteRollupState.id == 1).with_for_update())).scalar_one()
+
+            # Keep the weights of new votes far away from overflowing by moving the epoch forward once in a while
+            half_life = HOT_HALF_LIFE.total_seconds()
+            elapsed = (now - state.hot_epoch).total_seconds()
+            if elapsed > 256 * half_life:
+                await session.execute(update(HotScore).values(score=HotScore.score * 2 ** (-elapsed / half_life)))
+                await session.execute(delete(HotScore).where(HotScore.score == 0))
+                state.hot_epoch = now
+
+            start = state.watermark
+            end = now - VOTE_ROLLUP_LAG
+            batch = select(VoteEvent).where(VoteEvent.created_at >= start, VoteEvent.created_at < end).subquery()
+
+            hour = func.date_trunc("hour", batch.c.created_at)
+            buckets = select(batch.c.meme_id, hour, func.sum(batch.c.delta)).group_by(batch.c.meme_id, hour)
+            stmt = insert(VoteBucket).from_select([VoteBucket.meme_id, VoteBucket.hour, VoteBucket.votes], buckets)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[VoteBucket.meme_id, VoteBucket.hour],
+                set_={"votes": VoteBucket.votes + stmt.excluded.votes}
+            )
+            await session.execute(stmt)
+
+            weight = func.power(literal(2.0), extract("epoch", batch.c.created_at - literal(state.hot_epoch)) / half_life)
+            scores = select(batch.c.meme_id, func.sum(batch.c.delta * weight)).group_by(batch.c.meme_id)
+            stmt = insert(HotScore).from_select([HotScore.meme_id, HotScore.score], scores)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[HotScore.meme_id],
+                set_={"score": HotScore.score + stmt.excluded.score}
+            ).returning(HotScore.meme_id)
+            updated = len((await session.execute(stmt)).all())
+
+            state.watermark = end
+
+            await session.execute(delete(VoteEvent).where(VoteEvent.created_at < end - VOTE_EVENT_RETENTION))
+            await session.execute(delete(VoteBucket).where(VoteBucket.hour < end - VOTE_BUCKET_RETENTION))
+
+            await session.commit()
+            return updated
+
+async def get_trending_ranks(since: datetime, limit: int = 10) -> list[tuple[int, int]]:
+    """Returns the memes with the most net votes since a point in time, based on the hourly buckets
+
+    Args:
+        since (datetime): The start of the window. Votes are counted per full hour, so the hour containing this time is included
+        limit (int): The maximum number of memes
+
+    Returns:
+        list[tuple[int, int]]: (id, votes) pairs ordered by votes
+    """
+
+    async with get_session() as session:
+        async with session.begin():
+            votes = func.sum(VoteBucket.votes)
+            stmt = (
+                select(VoteBucket.meme_id, votes)
+                .where(VoteBucket.hour >= func.date_trunc("hour", literal(since)))
+                .group_by(VoteBucket.meme_id)
+                .having(votes > 0)
+                .order_by(votes.desc(), VoteBucket.meme_id)
+                .limit(limit)
+            )
+            result = await session.execute(stmt)
+            return [(id, votes) for id, votes in result.all()]
+
+async def get_hot_ranks(limit: int = 10) -> list[tuple[int, float]]:
+    """Returns the memes with the highest time-decayed score
+
+    Args:
+        limit (int): The maximum number of memes
+
+    Returns:
+        list[tuple[int, float]]: (id, score) pairs ordered by score. The score is the number of votes, each weighted by 2^(-age / half-life)
+    """
+
+    async with get_session() as session:
+        async with session.begin():
+            state = (await session.execute(select(VoteRollupState.hot_epoch, func.now()).where(VoteRollupState.id == 1))).first()
+            if state is None:
+                return []
+
+            stmt = select(HotScore.meme_id, HotScore.score).where(HotScore.score > 0).order_by(HotScore.score.desc(), HotScore.meme_id).limit(limit)
+            result = await session.execute(stmt)
 
+            # Scale the scores from the epoch to the current time
+            hot_epoch, now = state
+            factor = 2 ** (-(now - hot_epoch).total_seconds() / HOT_HALF_LIFE.total_seconds())
+            return [(id, score * factor) for id, score in result.all()]
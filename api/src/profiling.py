@@ -0,0 +1,301 @@
+"""
+Contains the opt-in profiling mode that records the memory used by each stage of a request and a CPU sampling profile of slow requests.
+The results are written to a local directory for offline analysis
+"""
+
+import asyncio
+import json
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+
+# Enables the profiling mode. Without it, the middleware is not installed and stages cost a single lookup
+PROFILING = os.getenv("CMG_PROFILING", "0") == "1"
+# The fraction of requests that are profiled. Requests with the header 'X-Profile: 1' are always profiled
+PROFILE_SAMPLE_RATE = float(os.getenv("CMG_PROFILE_SAMPLE_RATE", "0"))
+# The directory the profiles are written to
+PROFILE_DIR = os.getenv("CMG_PROFILE_DIR", "profiles")
+# A CPU profile is only written for profiled requests that take at least this long
+PROFILE_SLOW_SECONDS = float(os.getenv("CMG_PROFILE_SLOW_MS", "500")) / 1000
+# Profiling stops after this long even if the request is still running, since it slows down the whole process
+PROFILE_MAX_SECONDS = float(os.getenv("CMG_PROFILE_MAX_MS", "30000")) / 1000
+# The number of seconds between two stack samples
+SAMPLE_INTERVAL = 0.005
+
+PROFILE_HEADER = b"x-profile"
+# Responses of this type, such as the leaderboard stream, do not end, so profiling stops once their headers are sent
+STREAM_CONTENT_TYPE = b"text/event-stream"
+
+
+class Stage:
+    """The time and memory used by one stage of a request. All sizes are in bytes and relative to the traced memory when the stage started
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = time.perf_counter()
+        self.duration = 0.0
+        self.base = tracemalloc.get_traced_memory()[0]
+        # The highest traced memory seen while the stage was running
+        self.high = self.base
+        # The traced memory when the stage ended
+        self.end = self.base
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "duration": self.duration,
+            "peak": self.high - self.base,
+            "retained": self.end - self.base
+        }
+
+
+class RequestProfile:
+    """Collects the stages of one profiled request
+    """
+
+    def __init__(self, method: str, path: str):
+        self.method = method
+        self.path = path
+        self.started_at = datetime.now(timezone.utc)
+        self.start = time.perf_counter()
+        self.base = tracemalloc.get_traced_memory()[0]
+        self.high = self.base
+        self.stages: list[Stage] = []
+        self._open: list[Stage] = []
+        # Set when profiling stopped. Stages that run afterwards are not measured
+        self.closed = False
+
+    def _fold_peak(self):
+        """Records the current peak in the request and all open stages and resets it, so the next stage starts with a fresh peak
+        """
+
+        peak = tracemalloc.get_traced_memory()[1]
+        self.high = max(self.high, peak)
+        for stage in self._open:
+            stage.high = max(stage.high, peak)
+        tracemalloc.reset_peak()
+
+    @contextmanager
+    def stage(self, name: str):
+        if self.closed:
+            yield
+            return
+
+        self._fold_peak()
+        stage = Stage(name)
+        self._open.append(stage)
+        try:
+            yield
+        finally:
+            # Stages that were still running when profiling stopped were already reported as unfinished
+            if not self.closed:
+                self._fold_peak()
+                self._open.remove(stage)
+                stage.duration = time.perf_counter() - stage.start
+                stage.end = tracemalloc.get_traced_memory()[0]
+                self.stages.append(stage)
+
+    def finish(self) -> dict:
+        self._fold_peak()
+        self.closed = True
+
+        # Stages that are still running when profiling stops early are reported up to now
+        unfinished = []
+        for stage in self._open:
+            stage.duration = time.perf_counter() - stage.start
+            stage.end = tracemalloc.get_traced_memory()[0]
+            unfinished.append({**stage.to_dict(), "unfinished": True})
+
+        return {
+            "method": self.method,
+            "path": self.path,
+            "started_at": self.started_at.isoformat(),
+            "duration": time.perf_counter() - self.start,
+            "peak": self.high - self.base,
+            "stages": [stage.to_dict() for stage in self.stages] + unfinished
+        }
+
+
+class StackSampler:
+    """Samples the stacks of all threads in a background thread and counts them in the folded format of flame graph tools
+    """
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks: Counter[str] = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+current_profile: ContextVar[RequestProfile | None] = ContextVar("current_profile", default=None)
+# Only one request is profiled at a time, since tracemalloc measures the whole process
+profiling_active = False
+
+
+@contextmanager
+def stage(name: str):
+    """Measures a stage of the current request if it is profiled. Does nothing otherwise
+
+    Args:
+        name (str): The name of the stage, e.g. 'download' or 'ocr'
+    """
+
+    profile = current_profile.get()
+    if profile is None:
+        yield
+        return
+
+    with profile.stage(name):
+        yield
+
+
+def write_profile(directory: str, name: str, report: dict, folded: str | None):
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, f"{name}.json"), "w") as f:
+        json.dump(report, f, indent=2)
+    if folded is not None:
+        with open(os.path.join(directory, f"{name}.folded"), "w") as f:
+            f.write(folded)
+
+
+class ProfilingMiddleware:
+    """Profiles sampled requests and requests with the header 'X-Profile: 1'. Concurrent requests are also counted
+    while a request is profiled, so the numbers are most accurate at low load. The name of the profile is returned in
+    the 'X-Profile-Id' header. Profiling stops early for event streams and for requests that exceed the maximum duration
+    """
+
+    def __init__(
+            self,
+            app,
+            sample_rate: float = PROFILE_SAMPLE_RATE,
+            profile_dir: str = PROFILE_DIR,
+            slow_seconds: float = PROFILE_SLOW_SECONDS,
+            max_seconds: float = PROFILE_MAX_SECONDS
+        ):
+        """
+        Args:
+            app: The ASGI app to profile
+            sample_rate (float): The fraction of requests that are profiled
+            profile_dir (str): The directory the profiles are written to
+            slow_seconds (float): A CPU profile is only written for requests that take at least this long
+            max_seconds (float): Profiling stops after this long, even if the request is still running
+        """
+
+        self.app = app
+        self.sample_rate = sample_rate
+        self.profile_dir = profile_dir
+        self.slow_seconds = slow_seconds
+        self.max_seconds = max_seconds
+
+    async def write(self, name: str, report: dict, folded: str | None):
+        try:
+            await asyncio.to_thread(write_profile, self.profile_dir, name, report, folded)
+        except OSError as e:
+            print("Failed to write the profile:", e)
+
+    def should_profile(self, scope) -> bool:
+        if scope["type"] != "http" or profiling_active:
+            return False
+        if (PROFILE_HEADER, b"1") in scope["headers"]:
+            return True
+        return random.random() < self.sample_rate
+
+    async def __call__(self, scope, receive, send):
+        global profiling_active
+
+        if not self.should_profile(scope):
+            return await self.app(scope, receive, send)
+
+        profiling_active = True
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        sampler = StackSampler()
+        sampler.start()
+
+        profile = RequestProfile(scope["method"], scope["path"])
+        name = f"{profile.started_at.strftime('%Y%m%dT%H%M%S%f')}-{os.getpid()}-{scope['method'].lower()}{scope['path'].replace('/', '_')}"
+        status = None
+        writing: asyncio.Task | None = None
+
+        def stop(reason: str):
+            """Stops tracing and sampling and starts writing the profile. Only the first call has an effect
+
+            Args:
+                reason (str): Why profiling stopped: 'response', 'event-stream' or 'max-duration'
+            """
+
+            global profiling_active
+            nonlocal writing
+
+            if writing is not None:
+                return
+            timer.cancel()
+            sampler.stop()
+            report = profile.finish()
+            report["status"] = status
+            report["stopped_by"] = reason
+            if started_tracing:
+                tracemalloc.stop()
+            profiling_active = False
+
+            folded = sampler.folded() if report["duration"] >= self.slow_seconds else None
+            writing = asyncio.get_running_loop().create_task(self.write(name, report, folded))
+
+        timer = asyncio.get_running_loop().call_later(self.max_seconds, stop, "max-duration")
+
+        async def send_with_id(message):
+            nonlocal status
+            streaming = False
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = message.get("headers", [])
+                streaming = any(key.lower() == b"content-type" and value.startswith(STREAM_CONTENT_TYPE) for key, value in headers)
+                message = {**message, "headers": [*headers, (b"x-profile-id", name.encode("utf-8"))]}
+            await send(message)
+            if streaming:
+                stop("event-stream")
+
+        token = current_profile.set(profile)
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            current_profile.reset(token)
+            stop("response")
+            await writing
@@ -0,0 +1,151 @@
+"""
+Contains the code that draws the caption of a meme onto its image
+"""
+
+import io
+import os
+from enum import Enum
+from functools import lru_cache
+from PIL import Image, ImageDraw, ImageFont
+
+# A TrueType font in the style of Impact. Falls back to Pillow's bundled font if the file does not exist
+FONT_PATH = os.getenv("CMG_FONT_PATH", "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf")
+# Rendered images are never wider than this
+MAX_WIDTH = 2048
+# The width used if none is requested and the image is wider
+DEFAULT_MAX_WIDTH = 1024
+
+
+class CaptionStyle(str, Enum):
+    # Text before the first '|' or line break at the top, the rest at the bottom. Without a separator, all text is at the bottom
+    classic = "classic"
+    # All text at the top
+    top = "top"
+    # All text at the bottom
+    bottom = "bottom"
+
+
+@lru_cache(maxsize=128)
+def get_font(size: int) -> ImageFont.FreeTypeFont | ImageFont.ImageFont:
+    """Loads the caption font in a given size. Fonts are cached, which also keeps FreeType's rendered glyphs
+    cached between requests
+
+    Args:
+        size (int): The font size in pixels
+    """
+
+    try:
+        return ImageFont.truetype(FONT_PATH, size)
+    except OSError:
+        return ImageFont.load_default(size)
+
+
+def split_caption(caption: str, style: CaptionStyle) -> tuple[str, str]:
+    """Splits a caption into the top and bottom text
+
+    Returns:
+        tuple[str, str]: The top and bottom text in upper case
+    """
+
+    caption = caption.strip().upper()
+    if style == CaptionStyle.top:
+        return caption, ""
+    if style == CaptionStyle.bottom:
+        return "", caption
+
+    for separator in ("|", "\n"):
+        if separator in caption:
+            top, bottom = caption.split(separator, 1)
+            return top.strip(), bottom.strip()
+    return "", caption
+
+
+def wrap_text(text: str, font, max_width: float) -> list[str]:
+    """Wraps text into lines that fit into a width. Single words wider than the width get their own line
+    """
+
+    lines = []
+    line = ""
+    for word in text.split():
+        candidate = f"{line} {word}" if line else word
+        if line and font.getlength(candidate) > max_width:
+            lines.append(line)
+            line = word
+        else:
+            line = candidate
+    if line:
+        lines.append(line)
+    return lines
+
+
+def fit_text(text: str, width: int, height: int) -> tuple[ImageFont.FreeTypeFont | ImageFont.ImageFont, list[str]]:
+    """Finds the largest font size at which the text fits into the width and a third of the height
+
+    Returns:
+        tuple: The font and the wrapped lines
+    """
+
+    max_width = width * 0.94
+    max_height = height / 3
+    size = max(12, height // 7)
+    while True:
+        font = get_font(size)
+        lines = wrap_text(text, font, max_width)
+        widest = max(font.getlength(line) for line in lines)
+        if (widest <= max_width and len(lines) * size * 1.1 <= max_height) or size <= 12:
+            return font, lines
+        size = max(12, int(size * 0.9))
+
+
+def draw_text_block(draw: ImageDraw.ImageDraw, text: str, width: int, height: int, at_top: bool):
+    """Draws white text with a black outline, centered horizontally, at the top or bottom of the image
+    """
+
+    font, lines = fit_text(text, width, height)
+    size = font.size if isinstance(font, ImageFont.FreeTypeFont) else 12
+    line_height = size * 1.1
+    stroke = max(1, size // 15)
+    margin = height * 0.02
+
+    y = margin if at_top else height - margin - line_height * len(lines)
+    for line in lines:
+        x = (width - font.getlength(line)) / 2
+        draw.text((x, y), line, font=font, fill="white", stroke_width=stroke, stroke_fill="black")
+        y += line_height
+
+
+def render_meme(image: bytes, caption: str, style: CaptionStyle, width: int | None, format: str) -> bytes:
+    """Draws a caption onto an image in the classic top/bottom meme style. Only the first frame of animated images is used
+
+    Args:
+        image (bytes): The raw image data
+        caption (str): The caption
+        style (CaptionStyle): Where to place the caption
+        width (int | None): The width of the output. Defaults to the image width, but at most DEFAULT_MAX_WIDTH
+        format (str): The Pillow format of the output, 'JPEG' or 'WEBP'
+
+    Returns:
+        bytes: The encoded image
+    """
+
+    with Image.open(io.BytesIO(image)) as img:
+        img.seek(0)
+        canvas = img.convert("RGB")
+
+    if width is None:
+        width = min(canvas.width, DEFAULT_MAX_WIDTH)
+    width = max(1, min(width, MAX_WIDTH))
+    if width != canvas.width:
+        height = max(1, round(canvas.height * width / canvas.width))
+        canvas = canvas.resize((width, height), Image.Resampling.LANCZOS)
+
+    top, bottom = split_caption(caption, style)
+    draw = ImageDraw.Draw(canvas)
+    if top:
+        draw_text_block(draw, top, canvas.width, canvas.height, at_top=True)
+    if bottom:
+        draw_text_block(draw, bottom, canvas.width, canvas.height, at_top=False)
+
+    out = io.BytesIO()
+    canvas.save(out, format, quality=90)
+    return out.getvalue()
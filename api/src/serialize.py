@@ -0,0 +1,90 @@
+"""
+Contains the fast path that serializes memes to json. Responses are encoded directly to bytes with orjson and the images
+are base64 encoded in chunks while the response is sent, so no string holding all images is ever built
+"""
+
+import base64
+import orjson
+from typing import AsyncIterator
+from fastapi.responses import StreamingResponse
+
+# The number of image bytes encoded at once and the size of the chunks that are sent. A multiple of 3, so the
+# base64 encoded chunks can be concatenated without padding in between
+CHUNK_SIZE = 3 * 64 * 1024
+
+
+def base64_length(size: int) -> int:
+    """Returns the length of the base64 encoding of `size` bytes
+    """
+
+    return (size + 2) // 3 * 4
+
+
+def meme_segments(memes: list[tuple[dict, bytes]], many: bool) -> list[bytes | memoryview]:
+    """Splits a success response containing memes into segments. Bytes are sent as they are, memoryviews are images
+    that are base64 encoded while sending. The image of every meme is added as the last field, 'image'
+
+    Args:
+        memes (list[tuple[dict, bytes]]): The fields and the raw image of every meme
+        many (bool): Whether the data is a list of memes or a single meme
+
+    Returns:
+        list[bytes | memoryview]: The segments
+    """
+
+    segments: list[bytes | memoryview] = [b'{"status":"success","data":[' if many else b'{"status":"success","data":']
+    for i, (fields, image) in enumerate(memes):
+        head = orjson.dumps(fields)
+        segments.append((b"," if i else b"") + head[:-1] + b',"image":"')
+        segments.append(memoryview(image))
+        segments.append(b'"}')
+    segments.append(b"]}" if many else b"}")
+    return segments
+
+
+async def encode_segments(segments: list[bytes | memoryview]) -> AsyncIterator[bytes]:
+    """Yields the response in chunks of about CHUNK_SIZE bytes
+    """
+
+    buffer = bytearray()
+    for segment in segments:
+        if isinstance(segment, memoryview):
+            for start in range(0, len(segment), CHUNK_SIZE):
+                buffer += base64.b64encode(segment[start:start + CHUNK_SIZE])
+                if len(buffer) >= CHUNK_SIZE:
+                    yield bytes(buffer)
+                    buffer.clear()
+        else:
+            buffer += segment
+
+    if buffer:
+        yield bytes(buffer)
+
+
+def memes_response(memes: list[tuple[dict, bytes]], many: bool = True, headers: dict | None = None) -> StreamingResponse:
+    """Creates a success response containing memes. The response is not validated against a model, the fields must
+    already be json serializable. The length of the response is known in advance and sent as Content-Length
+
+    Args:
+        memes (list[tuple[dict, bytes]]): The fields and the raw image of every meme
+        many (bool): Whether the data is a list of memes or a single meme. A single meme must be the only entry of `memes`
+        headers (dict | None): Additional response headers
+
+    Returns:
+        StreamingResponse: The response
+    """
+
+    segments = meme_segments(memes, many)
+    length = sum(base64_length(len(segment)) if isinstance(segment, memoryview) else len(segment) for segment in segments)
+    return StreamingResponse(
+        encode_segments(segments),
+        media_type="application/json",
+        headers={**(headers or {}), "Content-Length": str(length)}
+    )
+
+
+def meme_response(fields: dict, image: bytes, headers: dict | None = None) -> StreamingResponse:
+    """Creates a success response containing a single meme. See `memes_response`
+    """
+
+    return memes_response([(fields, image)], many=False, headers=headers)
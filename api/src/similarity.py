@@ -0,0 +1,147 @@
+"""
+Contains the perceptual hashing code and the in-memory index used to detect near-duplicate memes
+"""
+
+import io
+from PIL import Image
+
+HASH_BITS = 64
+# JPEGs are decoded at the smallest scale (down to 1/8) that is still at least this large, which is much faster than decoding every pixel
+DRAFT_SIZE = (72, 64)
+
+
+def dhash(image: bytes) -> int:
+    """Computes the 64 bit difference hash (dHash) of an image. Reposts of the same image with a different compression or size produce the same or a very similar hash
+
+    Args:
+        image (bytes): The raw image data. Only the first frame of animated images is used
+
+    Returns:
+        int: The unsigned 64 bit hash
+    """
+
+    with Image.open(io.BytesIO(image)) as img:
+        img.seek(0)
+        img.draft("L", DRAFT_SIZE)
+        pixels = list(img.convert("L").resize((9, 8), Image.Resampling.LANCZOS).getdata())
+
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def hamming_distance(a: int, b: int) -> int:
+    """Returns the number of differing bits between two hashes
+    """
+
+    return (a ^ b).bit_count()
+
+
+class HashIndex:
+    """A multi-index hashing structure for hamming distance queries.
+
+    The 64 bit hashes are split into max_distance + 1 chunks. Two hashes within max_distance of each other must
+    match exactly on at least one chunk (pigeonhole principle), so a query only has to compare against the hashes
+    sharing a chunk with it instead of scanning every stored hash.
+    """
+
+    def __init__(self, max_distance: int = 4):
+        """
+        Args:
+            max_distance (int): The largest distance that can be queried
+        """
+
+        if max_distance < 0 or max_distance >= HASH_BITS:
+            raise ValueError(f"max_distance must be between 0 and {HASH_BITS - 1}")
+
+        self.max_distance = max_distance
+        chunk_count = max_distance + 1
+
+        # (shift, mask) for every chunk. The first chunks get the extra bits if 64 is not divisible by chunk_count
+        self._chunks = []
+        shift = 0
+        for i in range(chunk_count):
+            width = HASH_BITS // chunk_count + (1 if i < HASH_BITS % chunk_count else 0)
+            self._chunks.append((shift, (1 << width) - 1))
+            shift += width
+
+        self._tables: list[dict[int, list[int]]] = [{} for _ in self._chunks]
+        self._hashes: dict[int, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._hashes)
+
+    def __contains__(self, id: int) -> bool:
+        return id in self._hashes
+
+    def add(self, id: int, hash: int):
+        """Adds a hash to the index. An existing entry with the same id is replaced
+
+        Args:
+            id (int): The id of the meme the hash belongs to
+            hash (int): The unsigned 64 bit hash
+        """
+
+        if id in self._hashes:
+            self.remove(id)
+
+        self._hashes[id] = hash
+        for table, (shift, mask) in zip(self._tables, self._chunks):
+            table.setdefault((hash >> shift) & mask, []).append(id)
+
+    def remove(self, id: int):
+        """Removes a hash from the index if it exists
+        """
+
+        hash = self._hashes.pop(id, None)
+        if hash is None:
+            return
+
+        for table, (shift, mask) in zip(self._tables, self._chunks):
+            key = (hash >> shift) & mask
+            bucket = table[key]
+            bucket.remove(id)
+            if not bucket:
+                del table[key]
+
+    def clear(self):
+        """Removes all hashes from the index
+        """
+
+        self._hashes.clear()
+        for table in self._tables:
+            table.clear()
+
+    def query(self, hash: int, distance: int | None = None) -> list[tuple[int, int]]:
+        """Finds all stored hashes within a hamming distance of the given hash
+
+        Args:
+            hash (int): The unsigned 64 bit hash to search for
+            distance (int | None): The maximum distance. Defaults to the max_distance of the index
+
+        Returns:
+            list[tuple[int, int]]: (id, distance) pairs sorted by distance, then by id
+        """
+
+        if distance is None:
+            distance = self.max_distance
+        if distance > self.max_distance:
+            raise ValueError(f"distance must not exceed {self.max_distance}")
+
+        seen = set()
+        matches = []
+        for table, (shift, mask) in zip(self._tables, self._chunks):
+            for id in table.get((hash >> shift) & mask, ()):
+                if id in seen:
+                    continue
+                seen.add(id)
+                d = (self._hashes[id] ^ hash).bit_count()
+                if d <= distance:
+                    matches.append((id, d))
+
+        matches.sort(key=lambda match: (match[1], match[0]))
+        return matches
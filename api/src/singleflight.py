@@ -0,0 +1,63 @@
+"""
+Contains the single-flight helper that deduplicates identical concurrent work
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Hashable
+
+
+class SingleFlight:
+    """Deduplicates concurrent calls by key. The first caller for a key (the leader) starts the work and every
+    caller that arrives while it is still running (a follower) awaits the same result instead of repeating it.
+
+    The work runs in its own task, so a leader whose request is cancelled does not cancel the work for its followers.
+    Results are not cached: once the work finished, the next call for the key starts new work.
+    """
+
+    def __init__(self, name: str):
+        """
+        Args:
+            name (str): The name of the deduplicated operation, used in the statistics
+        """
+
+        self.name = name
+        self.calls = 0
+        self.coalesced = 0
+        self._inflight: dict[Hashable, asyncio.Task] = {}
+
+    async def do(self, key: Hashable, fn: Callable[..., Awaitable[Any]], *args) -> Any:
+        """Runs fn(*args) unless work for the same key is already running, in which case its result is awaited instead
+
+        Args:
+            key (Hashable): Identifies the work
+            fn (Callable): The coroutine function that does the work
+            *args: The arguments passed to fn
+
+        Returns:
+            Any: The result of the work. Exceptions raised by the work are raised for every caller
+        """
+
+        self.calls += 1
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(fn(*args))
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+
+        return await asyncio.shield(task)
+
+    def _finish(self, key: Hashable, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+
+        # Mark the exception as retrieved in case every caller was cancelled
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> dict:
+        """Returns the number of calls, how many of them were coalesced and how many are currently in flight
+        """
+
+        return {"name": self.name, "calls": self.calls, "coalesced": self.coalesced, "inflight": len(self._inflight)}
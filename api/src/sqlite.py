@@ -0,0 +1,732 @@
+"""
+This file contains the embedded storage backend for single-node deployments. Memes are stored in a SQLite database in WAL mode
+and images are stored as files next to it, addressed by the SHA-256 hash of their content. It implements the same functions as pg
+"""
+
+import asyncio
+import base64
+import hashlib
+import json
+import math
+import os
+import shutil
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+# The directory that contains the database and the image files
+DATA_DIR = os.getenv("CMG_SQLITE_DIR", "data")
+
+# The same settings as in pg
+VOTES_CHANNEL = "meme_votes"
+HOT_HALF_LIFE = timedelta(hours=float(os.getenv("CMG_HOT_HALF_LIFE_HOURS", "12")))
+VOTE_EVENT_RETENTION = timedelta(hours=float(os.getenv("CMG_VOTE_EVENT_RETENTION_HOURS", "48")))
+VOTE_BUCKET_RETENTION = timedelta(days=float(os.getenv("CMG_VOTE_BUCKET_RETENTION_DAYS", "30")))
+VOTE_ROLLUP_LAG = timedelta(seconds=10)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    hash TEXT PRIMARY KEY,
+    content_type TEXT,
+    refcount INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS image_urls (
+    url TEXT PRIMARY KEY,
+    hash TEXT NOT NULL REFERENCES images (hash) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS ix_image_urls_hash ON image_urls (hash);
+CREATE TABLE IF NOT EXISTS memes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    url TEXT,
+    image_hash TEXT REFERENCES images (hash),
+    original_hash TEXT REFERENCES images (hash),
+    bytes_saved INTEGER NOT NULL DEFAULT 0,
+    caption TEXT,
+    upvotes INTEGER NOT NULL DEFAULT 0,
+    phash INTEGER,
+    original_id INTEGER
+);
+CREATE INDEX IF NOT EXISTS ix_memes_upvotes ON memes (upvotes DESC, id);
+CREATE TABLE IF NOT EXISTS rendered_images (
+    meme_id INTEGER NOT NULL,
+    width INTEGER NOT NULL,
+    style TEXT NOT NULL,
+    format TEXT NOT NULL,
+    content_type TEXT,
+    PRIMARY KEY (meme_id, width, style, format)
+);
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key TEXT PRIMARY KEY,
+    fingerprint TEXT,
+    status_code INTEGER,
+    response TEXT,
+    locked_until REAL,
+    expires_at REAL
+);
+CREATE INDEX IF NOT EXISTS ix_idempotency_keys_expires_at ON idempotency_keys (expires_at);
+CREATE TABLE IF NOT EXISTS vote_events (
+    id INTEGER PRIMARY KEY,
+    meme_id INTEGER,
+    delta INTEGER,
+    created_at REAL
+);
+CREATE INDEX IF NOT EXISTS ix_vote_events_created_at ON vote_events (created_at);
+CREATE TABLE IF NOT EXISTS vote_buckets (
+    meme_id INTEGER,
+    hour INTEGER,
+    votes INTEGER,
+    PRIMARY KEY (meme_id, hour)
+);
+CREATE INDEX IF NOT EXISTS ix_vote_buckets_hour ON vote_buckets (hour);
+CREATE TABLE IF NOT EXISTS hot_scores (
+    meme_id INTEGER PRIMARY KEY,
+    score REAL
+);
+CREATE INDEX IF NOT EXISTS ix_hot_scores_score ON hot_scores (score);
+CREATE TABLE IF NOT EXISTS vote_rollup_state (
+    id INTEGER PRIMARY KEY,
+    watermark REAL,
+    hot_epoch REAL
+);
+"""
+
+TABLES = ["image_urls", "rendered_images", "memes", "images", "idempotency_keys", "vote_events", "vote_buckets", "hot_scores", "vote_rollup_state"]
+
+MEME_COLUMNS = "memes.id, memes.url, memes.caption, memes.upvotes, memes.image_hash, memes.original_hash, memes.bytes_saved, memes.phash, memes.original_id, images.content_type"
+MEME_SELECT = f"SELECT {MEME_COLUMNS} FROM memes JOIN images ON images.hash = memes.image_hash"
+
+# All queries run in this thread, one at a time, so the event loop never waits for the disk
+executor = ThreadPoolExecutor(1, thread_name_prefix="sqlite")
+connection: sqlite3.Connection | None = None
+
+
+class StoredImage:
+    """An image stored as a file, addressed by the SHA-256 hash of its content
+    """
+
+    def __init__(self, hash: str, data: bytes, content_type: str):
+        self.hash = hash
+        self.data = data
+        self.content_type = content_type
+
+class Meme:
+    def __init__(self, row: sqlite3.Row, stored_image: StoredImage):
+        self.id = row["id"]
+        self.url = row["url"]
+        self.caption = row["caption"]
+        self.upvotes = row["upvotes"]
+        self.image_hash = row["image_hash"]
+        self.original_hash = row["original_hash"]
+        self.bytes_saved = row["bytes_saved"]
+        self.phash = row["phash"]
+        self.original_id = row["original_id"]
+        self.stored_image = stored_image
+
+    @property
+    def image(self) -> str:
+        """The base64 encoded image
+        """
+
+        return base64.b64encode(self.stored_image.data).decode("utf-8")
+
+    @property
+    def image_type(self) -> str:
+        """The mime type of the image
+        """
+
+        return self.stored_image.content_type
+
+class IdempotencyKey:
+    """The outcome of a request that was sent with an Idempotency-Key header
+    """
+
+    def __init__(self, fingerprint: str, status_code: int | None, response: dict | None):
+        self.fingerprint = fingerprint
+        self.status_code = status_code
+        self.response = response
+
+class Listener:
+    """Stands in for the listening connection of pg. A single node handles all votes itself, so there is nothing to listen to
+    """
+
+    async def close(self):
+        pass
+
+def _to_signed64(value: int) -> int:
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+def _to_unsigned64(value: int) -> int:
+    return value + (1 << 64) if value < 0 else value
+
+def get_phash(meme: Meme) -> int | None:
+    """Returns the unsigned perceptual hash of a meme or None if it has no hash
+    """
+
+    return None if meme.phash is None else _to_unsigned64(meme.phash)
+
+# Connection
+
+def _connect() -> sqlite3.Connection:
+    os.makedirs(DATA_DIR, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(DATA_DIR, "memes.db"), isolation_level=None, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode = WAL")
+    # Commits are durable once the WAL is checkpointed, which is safe against application crashes
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.execute("PRAGMA busy_timeout = 5000")
+    conn.create_function("power", 2, math.pow, deterministic=True)
+    # An embedded database has no separate setup step, so the tables are created when it is opened
+    conn.executescript(SCHEMA)
+    return conn
+
+def _call(function, args):
+    global connection
+
+    if connection is None:
+        connection = _connect()
+    return function(connection, *args)
+
+async def _run(function, *args):
+    """Runs a function with the connection as first argument in the database thread
+    """
+
+    return await asyncio.get_running_loop().run_in_executor(executor, _call, function, args)
+
+@contextmanager
+def _transaction(conn: sqlite3.Connection):
+    """Runs a block in a write transaction. The write lock is taken immediately, so concurrent writers of other processes wait instead of failing later
+    """
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+def _close(conn: sqlite3.Connection):
+    global connection
+
+    conn.close()
+    connection = None
+
+async def init_connection():
+    """Reopens the database, e.g. after DATA_DIR was changed. This function is needed to run the tests
+    """
+
+    await close_connection()
+
+async def close_connection():
+    """Closes the database. It is reopened on the next query
+    """
+
+    if connection is not None:
+        await _run(_close)
+
+def _create_table(conn: sqlite3.Connection):
+    conn.executescript(SCHEMA)
+
+async def create_table():
+    """Creates the tables if they do not already exist
+    """
+
+    await _run(_create_table)
+
+def _destroy_db(conn: sqlite3.Connection):
+    for table in TABLES:
+        conn.execute(f"DROP TABLE IF EXISTS {table}")
+    shutil.rmtree(os.path.join(DATA_DIR, "images"), ignore_errors=True)
+    shutil.rmtree(os.path.join(DATA_DIR, "rendered"), ignore_errors=True)
+
+async def destroy_db():
+    """Drops all tables and deletes all image files
+    """
+
+    await _run(_destroy_db)
+
+def _clear_db(conn: sqlite3.Connection):
+    with _transaction(conn):
+        for table in TABLES:
+            conn.execute(f"DELETE FROM {table}")
+        # Restarts the ids of the memes
+        conn.execute("DELETE FROM sqlite_sequence")
+    shutil.rmtree(os.path.join(DATA_DIR, "images"), ignore_errors=True)
+    shutil.rmtree(os.path.join(DATA_DIR, "rendered"), ignore_errors=True)
+
+async def clear_db():
+    """Deletes all rows and image files and restarts the ids. This function is needed to run the tests
+    """
+
+    await _run(_clear_db)
+
+# Image files
+
+def _image_path(hash: str) -> str:
+    return os.path.join(DATA_DIR, "images", hash[:2], hash)
+
+def _rendered_path(meme_id: int, width: int, style: str, format: str) -> str:
+    return os.path.join(DATA_DIR, "rendered", str(meme_id), f"{width}-{style}.{format.lower()}")
+
+def _write_file(path: str, data: bytes):
+    """Writes a file atomically, so a crash never leaves a partially written image behind
+    """
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as f:
+        f.write(data)
+    os.replace(temporary, path)
+
+def _read_file(path: str) -> bytes | None:
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def _add_image_reference(conn: sqlite3.Connection, image: bytes, content_type: str) -> str:
+    """Stores an image if its content is not stored yet and increments its reference count. Must run in a transaction
+
+    Returns:
+        str: The SHA-256 hash of the image
+    """
+
+    hash = hashlib.sha256(image).hexdigest()
+    if conn.execute("UPDATE images SET refcount = refcount + 1 WHERE hash = ?", (hash,)).rowcount == 0:
+        # The file is written before the row, so a stored row always has its file
+        _write_file(_image_path(hash), image)
+        conn.execute("INSERT INTO images (hash, content_type, refcount) VALUES (?, ?, 1)", (hash, content_type))
+    return hash
+
+def _release_image_reference(conn: sqlite3.Connection, hash: str) -> bool:
+    """Decrements the reference count of an image and deletes its row when it is no longer used. Must run in a transaction
+
+    Returns:
+        bool: True if the image is no longer used and its file should be deleted after the transaction committed
+    """
+
+    conn.execute("UPDATE images SET refcount = refcount - 1 WHERE hash = ?", (hash,))
+    row = conn.execute("SELECT refcount FROM images WHERE hash = ?", (hash,)).fetchone()
+    if row is not None and row["refcount"] <= 0:
+        conn.execute("DELETE FROM images WHERE hash = ?", (hash,))
+        return True
+    return False
+
+def _load_meme(row: sqlite3.Row) -> Meme:
+    data = _read_file(_image_path(row["image_hash"])) or b""
+    return Meme(row, StoredImage(row["image_hash"], data, row["content_type"]))
+
+# Memes
+
+def _create_meme(conn, url, caption, image, content_type, phash, original_id, original_image, original_content_type, bytes_saved) -> int:
+    with _transaction(conn):
+        hash = _add_image_reference(conn, image, content_type)
+        original_hash = None
+        if original_image is not None:
+            original_hash = _add_image_reference(conn, original_image, original_content_type or content_type)
+
+        if url:
+            # Remember which image the url points to so it does not have to be downloaded again
+            conn.execute(
+                "INSERT INTO image_urls (url, hash) VALUES (?, ?) ON CONFLICT (url) DO UPDATE SET hash = excluded.hash",
+                (url, original_hash or hash)
+            )
+
+        cursor = conn.execute(
+            "INSERT INTO memes (url, caption, upvotes, image_hash, original_hash, bytes_saved, phash, original_id) VALUES (?, ?, 0, ?, ?, ?, ?, ?)",
+            (url, caption, hash, original_hash, bytes_saved, None if phash is None else _to_signed64(phash), original_id)
+        )
+        return cursor.lastrowid # type: ignore
+
+async def create_meme(
+        url: str,
+        caption: str,
+        image: bytes,
+        content_type: str,
+        phash: int | None = None,
+        original_id: int | None = None,
+        original_image: bytes | None = None,
+        original_content_type: str | None = None,
+        bytes_saved: int = 0
+    ) -> int:
+    """Stores a meme. The image is only stored once for all memes with the same image content. See pg.create_meme
+    """
+
+    return await _run(_create_meme, url, caption, image, content_type, phash, original_id, original_image, original_content_type, bytes_saved)
+
+def _delete_meme(conn: sqlite3.Connection, id: int) -> bool:
+    with _transaction(conn):
+        row = conn.execute("SELECT image_hash, original_hash FROM memes WHERE id = ?", (id,)).fetchone()
+        if row is None:
+            return False
+
+        conn.execute("DELETE FROM memes WHERE id = ?", (id,))
+        conn.execute("DELETE FROM hot_scores WHERE meme_id = ?", (id,))
+        conn.execute("DELETE FROM rendered_images WHERE meme_id = ?", (id,))
+
+        unused = [row["image_hash"]] if _release_image_reference(conn, row["image_hash"]) else []
+        if row["original_hash"] is not None and _release_image_reference(conn, row["original_hash"]):
+            unused.append(row["original_hash"])
+
+    # Files are only deleted once the transaction committed, so a rollback never loses an image
+    for hash in unused:
+        try:
+            os.remove(_image_path(hash))
+        except FileNotFoundError:
+            pass
+    shutil.rmtree(os.path.join(DATA_DIR, "rendered", str(id)), ignore_errors=True)
+    return True
+
+async def delete_meme(id: int) -> bool:
+    """Deletes a meme and releases its reference to the stored image. The image is deleted when no other meme uses it
+
+    Args:
+        id (int): The unique identifier of the meme
+
+    Returns:
+        bool: True if the meme was found and deleted, False otherwise
+    """
+
+    return await _run(_delete_meme, id)
+
+def _get_meme_by_id(conn: sqlite3.Connection, id: int) -> Meme | None:
+    row = conn.execute(f"{MEME_SELECT} WHERE memes.id = ?", (id,)).fetchone()
+    return None if row is None else _load_meme(row)
+
+async def get_meme_by_id(id: int) -> Meme | None:
+    """Retrieves a meme by its unique id
+    """
+
+    return await _run(_get_meme_by_id, id)
+
+def _get_memes(conn: sqlite3.Connection, query: str, params: tuple = ()) -> list[Meme]:
+    return [_load_meme(row) for row in conn.execute(query, params).fetchall()]
+
+async def get_memes_by_ids(ids: list[int]) -> list[Meme]:
+    """Retrieves the memes with the given ids in the given order. Ids that do not exist are skipped
+    """
+
+    if not ids:
+        return []
+
+    placeholders = ", ".join("?" for _ in ids)
+    memes = {meme.id: meme for meme in await _run(_get_memes, f"{MEME_SELECT} WHERE memes.id IN ({placeholders})", tuple(ids))}
+    return [memes[id] for id in ids if id in memes]
+
+async def get_all_memes() -> list[Meme]:
+    """Returns all memes in the database. Used for testing purposes
+    """
+
+    return await _run(_get_memes, f"{MEME_SELECT} ORDER BY memes.id")
+
+async def get_top_ten_memes() -> list[Meme]:
+    """Returns the top 10 memes by upvotes
+    """
+
+    return await _run(_get_memes, f"{MEME_SELECT} ORDER BY memes.upvotes DESC, memes.id LIMIT 10")
+
+def _fetch_pairs(conn: sqlite3.Connection, query: str, params: tuple = ()) -> list[tuple]:
+    return [tuple(row) for row in conn.execute(query, params).fetchall()]
+
+async def get_top_ten_ranks() -> list[tuple[int, int]]:
+    """Returns the (id, upvotes) pairs of the top 10 memes by upvotes without loading the images
+    """
+
+    return await _run(_fetch_pairs, "SELECT id, upvotes FROM memes ORDER BY upvotes DESC, id LIMIT 10")
+
+async def get_random_meme() -> Meme | None:
+    """Returns a random meme
+    """
+
+    memes = await _run(_get_memes, f"{MEME_SELECT} ORDER BY random() LIMIT 1")
+    return memes[0] if memes else None
+
+async def get_phashes_by_ids(ids: list[int]) -> dict[int, int]:
+    """Returns the unsigned perceptual hashes of the memes with the given ids. Ids that do not exist or have no hash are ignored
+    """
+
+    if not ids:
+        return {}
+
+    placeholders = ", ".join("?" for _ in ids)
+    rows = await _run(_fetch_pairs, f"SELECT id, phash FROM memes WHERE id IN ({placeholders}) AND phash IS NOT NULL", tuple(ids))
+    return {id: _to_unsigned64(phash) for id, phash in rows}
+
+async def get_all_phashes(after_id: int = 0) -> list[tuple[int, int]]:
+    """Returns the (id, unsigned perceptual hash) pairs of all memes that have a hash, ordered by id. Used to build the in-memory similarity index
+
+    Args:
+        after_id (int): Only memes with a greater id are returned, to update an index with the memes created since it was last updated
+    """
+
+    rows = await _run(_fetch_pairs, "SELECT id, phash FROM memes WHERE id > ? AND phash IS NOT NULL ORDER BY id", (after_id,))
+    return [(id, _to_unsigned64(phash)) for id, phash in rows]
+
+# Images
+
+def _get_image(conn: sqlite3.Connection, hash: str) -> tuple[bytes, str] | None:
+    row = conn.execute("SELECT content_type FROM images WHERE hash = ?", (hash,)).fetchone()
+    if row is None:
+        return None
+    data = _read_file(_image_path(hash))
+    return None if data is None else (data, row["content_type"])
+
+async def get_image(hash: str) -> tuple[bytes, str] | None:
+    """Returns a stored image by its hash
+
+    Args:
+        hash (str): The SHA-256 hash of the image
+
+    Returns:
+        tuple[bytes, str] | None: The raw image data and its mime type or None if the image does not exist
+    """
+
+    return await _run(_get_image, hash)
+
+def _get_image_by_url(conn: sqlite3.Connection, url: str) -> bytes | None:
+    row = conn.execute("SELECT hash FROM image_urls WHERE url = ?", (url,)).fetchone()
+    return None if row is None else _read_file(_image_path(row["hash"]))
+
+async def get_image_by_url(url: str) -> bytes | None:
+    """Returns the stored image that was previously downloaded from a url
+
+    Args:
+        url (str): The url of the image
+
+    Returns:
+        bytes | None: The raw image data or None if no image from this url is stored
+    """
+
+    return await _run(_get_image_by_url, url)
+
+async def get_total_bytes_saved() -> tuple[int, int]:
+    """Returns the number of transcoded memes and the total number of bytes saved by transcoding
+    """
+
+    rows = await _run(_fetch_pairs, "SELECT count(id), coalesce(sum(bytes_saved), 0) FROM memes WHERE bytes_saved > 0")
+    return rows[0]
+
+def _get_rendered_image(conn: sqlite3.Connection, meme_id: int, width: int, style: str, format: str) -> tuple[bytes, str] | None:
+    row = conn.execute(
+        "SELECT content_type FROM rendered_images WHERE meme_id = ? AND width = ? AND style = ? AND format = ?",
+        (meme_id, width, style, format)
+    ).fetchone()
+    if row is None:
+        return None
+    data = _read_file(_rendered_path(meme_id, width, style, format))
+    return None if data is None else (data, row["content_type"])
+
+async def get_rendered_image(meme_id: int, width: int, style: str, format: str) -> tuple[bytes, str] | None:
+    """Returns a cached rendering of a meme
+
+    Returns:
+        tuple[bytes, str] | None: The encoded image and its mime type or None if this combination was not rendered yet
+    """
+
+    return await _run(_get_rendered_image, meme_id, width, style, format)
+
+def _store_rendered_image(conn: sqlite3.Connection, meme_id: int, width: int, style: str, format: str, data: bytes, content_type: str):
+    with _transaction(conn):
+        # The meme may have been deleted while it was rendered
+        if conn.execute("SELECT 1 FROM memes WHERE id = ?", (meme_id,)).fetchone() is None:
+            return
+        cursor = conn.execute(
+            "INSERT OR IGNORE INTO rendered_images (meme_id, width, style, format, content_type) VALUES (?, ?, ?, ?, ?)",
+            (meme_id, width, style, format, content_type)
+        )
+        if cursor.rowcount:
+            _write_file(_rendered_path(meme_id, width, style, format), data)
+
+async def store_rendered_image(meme_id: int, width: int, style: str, format: str, data: bytes, content_type: str):
+    """Caches a rendering of a meme. If the combination was already cached, the existing rendering is kept
+    """
+
+    await _run(_store_rendered_image, meme_id, width, style, format, data, content_type)
+
+# Idempotency
+
+def _claim_idempotency_key(conn: sqlite3.Connection, key: str, fingerprint: str, ttl: timedelta, lease: timedelta) -> tuple[bool, IdempotencyKey | None]:
+    now = time.time()
+    with _transaction(conn):
+        conn.execute(
+            "DELETE FROM idempotency_keys WHERE key = ? AND (expires_at < ? OR (status_code IS NULL AND locked_until < ?))",
+            (key, now, now)
+        )
+        cursor = conn.execute(
+            "INSERT OR IGNORE INTO idempotency_keys (key, fingerprint, locked_until, expires_at) VALUES (?, ?, ?, ?)",
+            (key, fingerprint, now + lease.total_seconds(), now + ttl.total_seconds())
+        )
+        if cursor.rowcount:
+            return True, None
+
+        row = conn.execute("SELECT fingerprint, status_code, response FROM idempotency_keys WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return False, None
+        response = None if row["response"] is None else json.loads(row["response"])
+        return False, IdempotencyKey(row["fingerprint"], row["status_code"], response)
+
+async def claim_idempotency_key(key: str, fingerprint: str, ttl: timedelta, lease: timedelta) -> tuple[bool, IdempotencyKey | None]:
+    """Tries to become the request that does the work for an idempotency key. See pg.claim_idempotency_key
+    """
+
+    return await _run(_claim_idempotency_key, key, fingerprint, ttl, lease)
+
+def _execute(conn: sqlite3.Connection, query: str, params: tuple = ()) -> int:
+    with _transaction(conn):
+        return conn.execute(query, params).rowcount
+
+async def complete_idempotency_key(key: str, status_code: int, response: dict):
+    """Stores the outcome of the request that claimed an idempotency key
+    """
+
+    await _run(_execute, "UPDATE idempotency_keys SET status_code = ?, response = ? WHERE key = ?", (status_code, json.dumps(response), key))
+
+async def release_idempotency_key(key: str):
+    """Releases an idempotency key whose request failed without an outcome worth storing, so a retry does the work again
+    """
+
+    await _run(_execute, "DELETE FROM idempotency_keys WHERE key = ? AND status_code IS NULL", (key,))
+
+async def delete_expired_idempotency_keys() -> int:
+    """Deletes the idempotency keys whose outcome expired
+
+    Returns:
+        int: The number of deleted keys
+    """
+
+    return await _run(_execute, "DELETE FROM idempotency_keys WHERE expires_at < ?", (time.time(),))
+
+# Votes
+
+def _vote(conn: sqlite3.Connection, id: int, delta: int) -> bool:
+    with _transaction(conn):
+        row = conn.execute("SELECT upvotes FROM memes WHERE id = ?", (id,)).fetchone()
+        if row is None:
+            return False
+        if row["upvotes"] + delta < 0:
+            return True
+
+        conn.execute("UPDATE memes SET upvotes = upvotes + ? WHERE id = ?", (delta, id))
+        conn.execute("INSERT INTO vote_events (meme_id, delta, created_at) VALUES (?, ?, ?)", (id, delta, time.time()))
+        return True
+
+async def upvote_meme(id: int) -> bool:
+    """Increments the upvotes of a meme by 1
+
+    Returns:
+        bool: True if the meme was found and upvoted, False otherwise
+    """
+
+    return await _run(_vote, id, 1)
+
+async def downvote_meme(id: int) -> bool:
+    """Decrements the upvotes of a meme by 1. The upvotes never drop below 0
+
+    Returns:
+        bool: True if the meme was found, False otherwise
+    """
+
+    return await _run(_vote, id, -1)
+
+async def listen(channel: str, callback, on_lost=None) -> Listener:
+    """Does nothing. Every vote is handled by this process, which already refreshes its leaderboard. Running several
+    workers on the same database is supported, but their leaderboard streams only see their own votes
+    """
+
+    return Listener()
+
+# Trending
+
+def _compact_votes(conn: sqlite3.Connection) -> int:
+    now = time.time()
+    half_life = HOT_HALF_LIFE.total_seconds()
+
+    with _transaction(conn):
+        conn.execute("INSERT OR IGNORE INTO vote_rollup_state (id, watermark, hot_epoch) VALUES (1, 0, ?)", (now,))
+        state = conn.execute("SELECT watermark, hot_epoch FROM vote_rollup_state WHERE id = 1").fetchone()
+        start = state["watermark"]
+        hot_epoch = state["hot_epoch"]
+
+        # Keep the weights of new votes far away from overflowing by moving the epoch forward once in a while
+        elapsed = now - hot_epoch
+        if elapsed > 256 * half_life:
+            conn.execute("UPDATE hot_scores SET score = score * ?", (2 ** (-elapsed / half_life),))
+            conn.execute("DELETE FROM hot_scores WHERE score = 0")
+            hot_epoch = now
+
+        end = now - VOTE_ROLLUP_LAG.total_seconds()
+        conn.execute("""
+            INSERT INTO vote_buckets (meme_id, hour, votes)
+            SELECT meme_id, CAST(created_at / 3600 AS INTEGER) * 3600 AS bucket, sum(delta) FROM vote_events
+            WHERE created_at >= ? AND created_at < ? GROUP BY meme_id, bucket
+            ON CONFLICT (meme_id, hour) DO UPDATE SET votes = votes + excluded.votes
+        """, (start, end))
+
+        updated = conn.execute(
+            "SELECT count(DISTINCT meme_id) FROM vote_events WHERE created_at >= ? AND created_at < ?", (start, end)
+        ).fetchone()[0]
+        conn.execute("""
+            INSERT INTO hot_scores (meme_id, score)
+            SELECT meme_id, sum(delta * power(2.0, (created_at - ?) / ?)) FROM vote_events
+            WHERE created_at >= ? AND created_at < ? GROUP BY meme_id
+            ON CONFLICT (meme_id) DO UPDATE SET score = score + excluded.score
+        """, (hot_epoch, half_life, start, end))
+
+        conn.execute("UPDATE vote_rollup_state SET watermark = ?, hot_epoch = ? WHERE id = 1", (end, hot_epoch))
+        conn.execute("DELETE FROM vote_events WHERE created_at < ?", (end - VOTE_EVENT_RETENTION.total_seconds(),))
+        conn.execute("DELETE FROM vote_buckets WHERE hour < ?", (end - VOTE_BUCKET_RETENTION.total_seconds(),))
+        return updated
+
+async def compact_votes() -> int:
+    """Rolls the vote events that arrived since the last run up into the hourly buckets and the hot scores, then
+    deletes events and buckets that are older than their retention period. See pg.compact_votes
+
+    Returns:
+        int: The number of memes whose hot score changed
+    """
+
+    return await _run(_compact_votes)
+
+async def get_trending_ranks(since: datetime, limit: int = 10) -> list[tuple[int, int]]:
+    """Returns the memes with the most net votes since a point in time, based on the hourly buckets
+
+    Args:
+        since (datetime): The start of the window. Votes are counted per full hour, so the hour containing this time is included
+        limit (int): The maximum number of memes
+
+    Returns:
+        list[tuple[int, int]]: (id, votes) pairs ordered by votes
+    """
+
+    hour = int(since.timestamp() // 3600 * 3600)
+    return await _run(_fetch_pairs, """
+        SELECT meme_id, sum(votes) AS total FROM vote_buckets WHERE hour >= ?
+        GROUP BY meme_id HAVING total > 0 ORDER BY total DESC, meme_id LIMIT ?
+    """, (hour, limit))
+
+def _get_hot_ranks(conn: sqlite3.Connection, limit: int) -> list[tuple[int, float]]:
+    state = conn.execute("SELECT hot_epoch FROM vote_rollup_state WHERE id = 1").fetchone()
+    if state is None:
+        return []
+
+    rows = conn.execute("SELECT meme_id, score FROM hot_scores WHERE score > 0 ORDER BY score DESC, meme_id LIMIT ?", (limit,)).fetchall()
+
+    # Scale the scores from the epoch to the current time
+    factor = 2 ** (-(time.time() - state["hot_epoch"]) / HOT_HALF_LIFE.total_seconds())
+    return [(row["meme_id"], row["score"] * factor) for row in rows]
+
+async def get_hot_ranks(limit: int = 10) -> list[tuple[int, float]]:
+    """Returns the memes with the highest time-decayed score
+
+    Args:
+        limit (int): The maximum number of memes
+
+    Returns:
+        list[tuple[int, float]]: (id, score) pairs ordered by score. The score is the number of votes, each weighted by 2^(-age / half-life)
+    """
+
+    return await _run(_get_hot_ranks, limit)
@@ -0,0 +1,129 @@
+"""
+Contains the interface of the storage backends and selects the backend that is used by the api.
+The backends are modules that implement the functions of the Storage protocol: pg for Postgres and sqlite for the embedded single-node backend
+"""
+
+import os
+from datetime import datetime, timedelta
+from typing import Any, Callable, Protocol, Sequence
+
+# 'postgres' or 'sqlite'
+STORAGE_BACKEND = os.getenv("CMG_STORAGE", "postgres")
+
+
+class StoredImage(Protocol):
+    hash: Any
+    data: Any
+    # The mime type of the image
+    content_type: Any
+
+
+class Meme(Protocol):
+    id: Any
+    url: Any
+    caption: Any
+    upvotes: Any
+    # The image that is served by default
+    image_hash: Any
+    # The uploaded image, if it was transcoded and the original was kept
+    original_hash: Any
+    bytes_saved: Any
+    # The signed 64 bit perceptual hash. Use get_phash to get the unsigned hash
+    phash: Any
+    original_id: Any
+    stored_image: Any
+
+    @property
+    def image(self) -> str: ...
+
+    @property
+    def image_type(self) -> str: ...
+
+
+class IdempotencyRecord(Protocol):
+    fingerprint: Any
+    status_code: Any
+    response: Any
+
+
+class Listener(Protocol):
+    async def close(self) -> Any: ...
+
+
+class Storage(Protocol):
+    """The operations the api needs from a storage backend. See the pg module for the documentation of every function
+    """
+
+    VOTES_CHANNEL: str
+    Meme: Any
+
+    # Setup
+    async def init_connection(self) -> None: ...
+    async def close_connection(self) -> None: ...
+    async def create_table(self) -> None: ...
+    async def destroy_db(self) -> None: ...
+    async def clear_db(self) -> None: ...
+
+    # Memes
+    async def create_meme(
+        self,
+        url: str,
+        caption: str,
+        image: bytes,
+        content_type: str,
+        phash: int | None = None,
+        original_id: int | None = None,
+        original_image: bytes | None = None,
+        original_content_type: str | None = None,
+        bytes_saved: int = 0
+    ) -> int: ...
+    async def delete_meme(self, id: int) -> bool: ...
+    async def get_meme_by_id(self, id: int) -> Meme | None: ...
+    async def get_memes_by_ids(self, ids: list[int]) -> list: ...
+    async def get_all_memes(self) -> Sequence: ...
+    async def get_top_ten_memes(self) -> Sequence: ...
+    async def get_top_ten_ranks(self) -> list[tuple[int, int]]: ...
+    async def get_random_meme(self) -> Meme | None: ...
+    def get_phash(self, meme) -> int | None: ...
+    async def get_phashes_by_ids(self, ids: list[int]) -> dict[int, int]: ...
+    async def get_all_phashes(self, after_id: int = 0) -> list[tuple[int, int]]: ...
+
+    # Images
+    async def get_image(self, hash: str) -> tuple[bytes, str] | None: ...
+    async def get_image_by_url(self, url: str) -> bytes | None: ...
+    async def get_total_bytes_saved(self) -> tuple[int, int]: ...
+    async def get_rendered_image(self, meme_id: int, width: int, style: str, format: str) -> tuple[bytes, str] | None: ...
+    async def store_rendered_image(self, meme_id: int, width: int, style: str, format: str, data: bytes, content_type: str) -> None: ...
+
+    # Idempotency
+    async def claim_idempotency_key(self, key: str, fingerprint: str, ttl: timedelta, lease: timedelta) -> tuple[bool, IdempotencyRecord | None]: ...
+    async def complete_idempotency_key(self, key: str, status_code: int, response: dict) -> None: ...
+    async def release_idempotency_key(self, key: str) -> None: ...
+    async def delete_expired_idempotency_keys(self) -> int: ...
+
+    # Votes
+    async def upvote_meme(self, id: int) -> bool: ...
+    async def downvote_meme(self, id: int) -> bool: ...
+    async def listen(self, channel: str, callback: Callable, on_lost: Callable | None = None) -> Listener: ...
+    async def compact_votes(self) -> int: ...
+    async def get_trending_ranks(self, since: datetime, limit: int = 10) -> list[tuple[int, int]]: ...
+    async def get_hot_ranks(self, limit: int = 10) -> list[tuple[int, float]]: ...
+
+
+def load_backend(name: str = STORAGE_BACKEND) -> Storage:
+    """Imports a storage backend. Only the selected backend is imported, so the embedded backend works without the Postgres drivers
+
+    Args:
+        name (str): 'postgres' or 'sqlite'
+
+    Returns:
+        Storage: The backend module
+    """
+
+    if name == "postgres":
+        import pg
+        return pg # type: ignore
+    if name == "sqlite":
+        import sqlite
+        return sqlite # type: ignore
+    raise ValueError(f"Unknown storage backend '{name}'. Use 'postgres' or 'sqlite'")
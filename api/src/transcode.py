@@ -0,0 +1,123 @@
+"""
+Contains the code that transcodes uploaded images to compact formats
+"""
+
+import io
+from PIL import Image
+
+WEBP_CONTENT_TYPE = "image/webp"
+DEFAULT_CONTENT_TYPE = "application/octet-stream"
+
+
+def detect_content_type(image: bytes) -> str:
+    """Detects the mime type of an image
+
+    Args:
+        image (bytes): The raw image data
+
+    Returns:
+        str: The mime type, or 'application/octet-stream' if the data is not an image Pillow can read
+    """
+
+    try:
+        with Image.open(io.BytesIO(image)) as img:
+            return Image.MIME.get(img.format or "", DEFAULT_CONTENT_TYPE)
+    except Exception:
+        return DEFAULT_CONTENT_TYPE
+
+
+def to_webp(image: bytes, quality: int) -> bytes:
+    """Transcodes an image to WebP. Animated images such as GIFs are transcoded to animated WebP
+
+    Args:
+        image (bytes): The raw image data
+        quality (int): The WebP quality between 0 and 100
+
+    Returns:
+        bytes: The WebP encoded image
+
+    Raises:
+        PIL.UnidentifiedImageError: If the data is not an image Pillow can read
+    """
+
+    out = io.BytesIO()
+    with Image.open(io.BytesIO(image)) as img:
+        if getattr(img, "is_animated", False):
+            img.save(out, "WEBP", save_all=True, quality=quality)
+        else:
+            if img.mode not in ("RGB", "RGBA"):
+                img = img.convert("RGBA" if "transparency" in img.info or img.mode in ("LA", "PA") else "RGB")
+            img.save(out, "WEBP", quality=quality)
+    return out.getvalue()
+
+
+def transcode(image: bytes, content_type: str, quality: int) -> tuple[bytes, str]:
+    """Transcodes an image to WebP if that makes it smaller. Images that are already WebP, cannot be read or would grow are returned unchanged
+
+    Args:
+        image (bytes): The raw image data
+        content_type (str): The mime type of the image as returned by detect_content_type
+        quality (int): The WebP quality between 0 and 100
+
+    Returns:
+        tuple[bytes, str]: The image to store and its mime type
+    """
+
+    if content_type in (WEBP_CONTENT_TYPE, DEFAULT_CONTENT_TYPE):
+        return image, content_type
+
+    try:
+        webp = to_webp(image, quality)
+    except Exception as e:
+        print("Failed to transcode image:", e)
+        return image, content_type
+
+    if len(webp) >= len(image):
+        return image, content_type
+    return webp, WEBP_CONTENT_TYPE
+
+
+def accepts_image_type(accept: str | None, content_type: str) -> bool:
+    """Checks whether an Accept header allows an image type. Headers that do not mention any image type, such as
+    'application/json', accept every image type since the image is embedded in the json response
+
+    Args:
+        accept (str | None): The value of the Accept header
+        content_type (str): The mime type of the image
+
+    Returns:
+        bool: False if the header lists image types and the given type is not one of them or has a quality of 0
+    """
+
+    if not accept:
+        return True
+
+    # The quality of the exact type takes precedence over the quality of 'image/*'
+    exact_q = None
+    wildcard_q = None
+    mentions_images = False
+    for media_range in accept.split(","):
+        params = [param.strip() for param in media_range.split(";")]
+        media_type = params[0].lower()
+        if not media_type.startswith("image/"):
+            continue
+
+        mentions_images = True
+        q = 1.0
+        for param in params[1:]:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    pass
+
+        if media_type == content_type:
+            exact_q = q
+        elif media_type == "image/*":
+            wildcard_q = q
+
+    if not mentions_images:
+        return True
+
+    q = exact_q if exact_q is not None else wildcard_q
+    return q is not None and q > 0